@@ -0,0 +1,91 @@
+"""
+An in-process stand-in for a PodioOAuth2Session, answering requests from synthetic data.
+
+Only the endpoints needed by the benchmarks are implemented:
+ - GET  /app/{app_id}/
+ - POST /item/app/{app_id}/filter/
+ - GET  /item/{item_id}
+
+The items are serialized to JSON once up front, so that the time spent in the
+mock "server" stays small compared to the code that is measured. The JSON
+decoding of every page still happens in response.json(), like with requests.
+"""
+import json
+import re
+
+from tetrapod.synthetic import make_app_config, make_items
+
+APP_RE = re.compile(r'^https://api\.podio\.com/app/(?P<app_id>\d+)/?$')
+FILTER_RE = re.compile(r'^https://api\.podio\.com/item/app/(?P<app_id>\d+)/filter/?$')
+ITEM_RE = re.compile(r'^https://api\.podio\.com/item/(?P<item_id>\d+)/?$')
+
+
+class MockResponse(object):
+
+    def __init__(self, status_code: int, content: bytes, headers: dict = None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {'Content-Type': 'application/json'}
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception('HTTP %d' % self.status_code)
+
+
+class MockPodioSession(object):
+    """Serves the apps added with add_app() and counts the requests."""
+
+    def __init__(self):
+        self.apps = {}
+        self.app_configs = {}
+        self.items_by_id = {}
+        self.num_requests = 0
+
+    def add_app(self, app_id: int, num_items: int, num_fields: int, seed: int = 0):
+        app_config = make_app_config(app_id, num_fields=num_fields)
+        self.app_configs[app_id] = app_config
+        serialized = []
+        for item_data in make_items(app_config, num_items, seed=seed):
+            text = json.dumps(item_data)
+            serialized.append(text)
+            self.items_by_id[item_data['item_id']] = text
+        self.apps[app_id] = serialized
+        return app_config
+
+    def request(self, method, url, **kwargs):
+        self.num_requests += 1
+        match = FILTER_RE.match(url)
+        if match and method == 'POST':
+            items = self.apps[int(match.group('app_id'))]
+            body = kwargs.get('json') or {}
+            offset, limit = body.get('offset', 0), body.get('limit', 30)
+            page = items[offset:offset + limit]
+            content = '{"total": %d, "filtered": %d, "items": [%s]}' \
+                      % (len(items), len(items), ', '.join(page))
+            return MockResponse(200, content.encode('utf-8'))
+        match = APP_RE.match(url)
+        if match and method == 'GET':
+            app_config = self.app_configs[int(match.group('app_id'))]
+            return MockResponse(200, json.dumps(app_config).encode('utf-8'))
+        match = ITEM_RE.match(url)
+        if match and method == 'GET':
+            item = self.items_by_id.get(int(match.group('item_id')))
+            if item is None:
+                return MockResponse(404, b'{"error": "not_found"}')
+            return MockResponse(200, item.encode('utf-8'))
+        return MockResponse(404, b'{"error": "not_found"}')
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the hot paths of tetrapod: field access, SearchableList, pagination,
+the SQLite cache, the pandas loader and the import time of the tpod command. Run them from the repository root:
+
+    python -m benchmarks.run --scale small
+    python -m benchmarks.run --scale medium --save-baseline
+    python -m benchmarks.run --scale medium --compare
+
+All data is synthetic (see tetrapod.synthetic) and served by an in-process mock of
+the Podio API (see benchmarks.mock_api), so no Podio account is needed.
+
+The baseline is stored in benchmarks/baseline.json, separately for every scale.
+With --compare the exit code is 1 if any benchmark got slower than the baseline
+by more than --tolerance, and 2 if there is no baseline for the scale. Timings
+depend on the machine, so the baseline is not part of the repository: save it on
+the machine that runs the comparisons, e.g. before a change.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+
+from benchmarks.mock_api import MockPodioSession
+from tetrapod.cache import CachedItemStorage
+from tetrapod.helpers import SearchableList, iterate_resource
+from tetrapod.items import AccessorPlan, Item, fetch_field, profile_fields
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# name -> (number of items, number of fields)
+# All the items are kept in memory (serialized for the mock API and parsed for the
+# field access benchmarks), and iterate_resource() and SearchableList hold a whole
+# app by design. The peak memory is about 5 KB per item and field, i.e. about
+# 2.5 GB for medium and 3 GB for large. wide covers apps with many fields with
+# few items (about 0.5 GB).
+SCALES = {
+    'tiny': (200, 10),
+    'small': (1000, 10),
+    'wide': (500, 200),
+    'medium': (10000, 50),
+    'large': (30000, 20),
+}
+
+APP_ID = 1001
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """
+    Register a benchmark. The decorated function gets the context and returns a tuple
+    (callable that is timed, number of operations it performs).
+    """
+    def decorator(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return decorator
+
+
+class Context(object):
+
+    def __init__(self, num_items: int, num_fields: int, seed: int = 0):
+        self.num_items = num_items
+        self.num_fields = num_fields
+        self.podio = MockPodioSession()
+        self.app_config = self.podio.add_app(APP_ID, num_items, num_fields, seed=seed)
+        self.items = [json.loads(text) for text in self.podio.apps[APP_ID]]
+        self.rng = random.Random(seed)
+        # One descriptor per field type (plus the parameterized variants), as long as
+        # the app has a field of that type.
+        self.descriptors = []
+        seen_types = set()
+        for field in self.app_config['fields']:
+            if field['type'] in seen_types:
+                continue
+            seen_types.add(field['type'])
+            self.descriptors.append(field['external_id'])
+            if field['type'] == 'date':
+                self.descriptors.append(field['external_id'] + '__start_dt')
+            elif field['type'] == 'category':
+                self.descriptors.append(field['external_id'] + '__choices')
+            elif field['type'] == 'number':
+                self.descriptors.append(field['external_id'] + '__float')
+
+    def make_storage(self, natural_key='text-0') -> CachedItemStorage:
+        storage = CachedItemStorage(sqlite3.connect(':memory:'), self.podio)
+        storage.cache_app(APP_ID, ['text-0'], natural_key)
+        return storage
+
+    def sample_item_ids(self, num: int) -> list:
+        return [self.rng.choice(self.items)['item_id'] for _ in range(num)]
+
+
+@benchmark('fetch_field')
+def bench_fetch_field(ctx):
+    items, descriptors = ctx.items, ctx.descriptors
+
+    def run():
+        for item_data in items:
+            for descriptor in descriptors:
+                fetch_field(descriptor, item_data)
+    return run, len(items) * len(descriptors)
+
+
+@benchmark('accessor_plan')
+def bench_accessor_plan(ctx):
+    items = ctx.items
+    plan = AccessorPlan(ctx.descriptors, ctx.app_config)
+
+    def run():
+        for item_data in items:
+            plan.row(item_data)
+    return run, len(items) * len(ctx.descriptors)
+
+
+@benchmark('searchable_list_build')
+def bench_searchable_list_build(ctx):
+    items = ctx.items
+
+    def run():
+        payload = SearchableList()
+        for item_data in items:
+            payload.append(Item(item_data))
+    return run, len(items)
+
+
+@benchmark('searchable_list_search')
+def bench_searchable_list_search(ctx):
+    payload = SearchableList()
+    for item_data in ctx.items:
+        payload.append(Item(item_data))
+    titles = ['Item %d' % ctx.rng.randint(1, ctx.num_items) for _ in range(10000)]
+
+    def run():
+        for title in titles:
+            payload.search_first('text-0', title)
+    return run, len(titles)
+
+
+@benchmark('iterate_resource')
+def bench_iterate_resource(ctx):
+    url = 'https://api.podio.com/item/app/%d/filter/' % APP_ID
+
+    def run():
+        iterate_resource(ctx.podio, url, limit=500)
+    return run, ctx.num_items
+
+
+@benchmark('cache_app')
+def bench_cache_app(ctx):
+    def run():
+        ctx.make_storage()
+    return run, ctx.num_items
+
+
+@benchmark('cache_get_item')
+def bench_cache_get_item(ctx):
+    storage = ctx.make_storage()
+    item_ids = ctx.sample_item_ids(5000)
+
+    def run():
+        for item_id in item_ids:
+            storage.get_item(APP_ID, item_id)
+    return run, len(item_ids)
+
+
+@benchmark('cache_get_item_by_natural_key')
+def bench_cache_natural_key(ctx):
+    storage = ctx.make_storage()
+    keys = ['Item %d' % ctx.rng.randint(1, ctx.num_items) for _ in range(5000)]
+
+    def run():
+        for key in keys:
+            storage.get_item_by_natural_key(APP_ID, [key])
+    return run, len(keys)
+
+
+@benchmark('cache_get_item_by_join_ids')
+def bench_cache_join_ids(ctx):
+    storage = ctx.make_storage()
+    keys = ['Item %d' % ctx.rng.randint(1, ctx.num_items) for _ in range(1000)]
+
+    def run():
+        for key in keys:
+            storage.get_item_by_join_ids(APP_ID, {'text-0': key})
+    return run, len(keys)
+
+
+@benchmark('load_from_app')
+def bench_load_from_app(ctx):
+    try:
+        import tetrapod.dataframe
+    except ImportError:
+        return None, 0
+    external_ids = [field['external_id'] for field in ctx.app_config['fields'][:10]]
+
+    def run():
+        tetrapod.dataframe.load_from_app(ctx.podio, APP_ID, limit=500,
+                                         external_ids=external_ids)
+    return run, ctx.num_items
+
+
+@benchmark('import_tetrapod_cli')
+def bench_import_cli(ctx):
+    # A fresh interpreter every time, like every run of 'tpod' or of a cron script.
+    # The interpreter start itself is included in the timing.
+    command = [sys.executable, '-c', 'import tetrapod.cli']
+    num_runs = 5
+
+    def run():
+        for _ in range(num_runs):
+            subprocess.run(command, check=True)
+    return run, num_runs
+
+
+def run_benchmarks(ctx, repeat: int = 3, only: list = None) -> dict:
+    results = {}
+    for name, func in BENCHMARKS:
+        if only and name not in only:
+            continue
+        timings = []
+        ops = 0
+        for _ in range(repeat):
+            run, ops = func(ctx)
+            if run is None:
+                break
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+        if not timings:
+            print(f'{name:32s} skipped')
+            continue
+        best = min(timings)
+        results[name] = {'seconds': best, 'ops': ops}
+        print(f'{name:32s} {best:10.4f} s {ops / best:14.0f} ops/s')
+    return results
+
+
+def load_baseline() -> dict:
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE, mode='r') as fh:
+        return json.load(fh)
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Print the comparison and return the names of the benchmarks that regressed."""
+    regressions = []
+    print()
+    print(f'{"benchmark":32s} {"baseline":>10s} {"now":>10s} {"ratio":>8s}')
+    for name, result in results.items():
+        if name not in baseline:
+            print(f'{name:32s} {"-":>10s} {result["seconds"]:10.4f}')
+            continue
+        ratio = result['seconds'] / baseline[name]['seconds']
+        flag = ''
+        if ratio > 1.0 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f'{name:32s} {baseline[name]["seconds"]:10.4f} {result["seconds"]:10.4f} '
+              f'{ratio:8.2f}{flag}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the tetrapod benchmarks.')
+    parser.add_argument('--scale', choices=sorted(SCALES.keys()), default='small')
+    parser.add_argument('--items', type=int, help='Override the number of items of the scale.')
+    parser.add_argument('--fields', type=int, help='Override the number of fields of the scale.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Run every benchmark this often and keep the best time.')
+    parser.add_argument('--only', action='append', help='Only run this benchmark (repeatable).')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slowdown before --compare reports a regression.')
+    parser.add_argument('--profile-fields', action='store_true',
+                        help='Print the time spent per mediator and field param.')
+    args = parser.parse_args(argv)
+
+    num_items, num_fields = SCALES[args.scale]
+    num_items = args.items or num_items
+    num_fields = args.fields or num_fields
+    scale_key = f'{args.scale}' if not (args.items or args.fields) \
+        else f'{num_items}x{num_fields}'
+
+    print(f'Generating {num_items} items with {num_fields} fields ...')
+    ctx = Context(num_items, num_fields)
+    if args.profile_fields:
+        with profile_fields() as profiler:
+            results = run_benchmarks(ctx, repeat=args.repeat, only=args.only)
+        print()
+        print(profiler.report())
+    else:
+        results = run_benchmarks(ctx, repeat=args.repeat, only=args.only)
+
+    exit_code = 0
+    if args.compare:
+        baseline = load_baseline().get(scale_key, {})
+        if not baseline:
+            print(f'No baseline for scale {scale_key}, run with --save-baseline first.')
+            exit_code = 2
+        elif compare(results, baseline, args.tolerance):
+            exit_code = 1
+
+    if args.save_baseline:
+        all_baselines = load_baseline()
+        all_baselines.setdefault(scale_key, {}).update(results)
+        with open(BASELINE_FILE, mode='w') as fh:
+            json.dump(all_baselines, fh, indent=2, sort_keys=True)
+        print(f'Baseline for scale {scale_key} saved to {BASELINE_FILE}')
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,17 @@
 import json
 import os
+import sqlite3
+import tempfile
+import threading
 from unittest import TestCase
+from unittest.mock import MagicMock
 
 from tetrapod.cache import (
-    CachedItemStorage
+    CachedItemNotFound,
+    CachedItemStorage,
+    MemoryBackend,
+    SQLiteBackend,
+    SQLiteConnectionPool,
 )
 
 
@@ -13,3 +21,185 @@ class TestIterateArray(TestCase):
 
     def test_iterate_array(self):
         pass
+
+
+def make_item_data(app_id, item_id, title):
+    return {
+        'item_id': item_id,
+        'app': {'app_id': app_id},
+        'fields': [{
+            'type': 'text',
+            'external_id': 'title',
+            'values': [{'value': title}]
+        }]
+    }
+
+
+class CachedItemStorageTestCase(TestCase):
+    """Abstract base class for tests that need a storage with one cached app (app_id 1)."""
+
+    def make_backend(self):
+        return SQLiteBackend(sqlite3.connect(':memory:'))
+
+    def setUp(self):
+        self.podio = MagicMock()
+        self.storage = CachedItemStorage(self.make_backend(), self.podio)
+        self.storage.setup_app_cache(1, ['title'], 'title')
+        for item_id in (10, 11, 12):
+            self.storage.insert_item_data_into_db(
+                1, make_item_data(1, item_id, 'Item %d' % item_id), ['title'], ['title'])
+
+
+class TestDeleteItem(CachedItemStorageTestCase):
+
+    def test_delete_item(self):
+        self.podio.delete.return_value.status_code = 204
+        self.storage.delete_item(1, 10)
+        self.podio.delete.assert_called_once()
+        with self.assertRaises(CachedItemNotFound):
+            self.storage.get_item_by_natural_key(1, 'Item 10')
+        self.assertEqual([10], self.storage.get_tombstones(1))
+        self.assertEqual([], self.storage.get_tombstones(1, since='2999-01-01 00:00:00'))
+
+    def test_delete_items_bulk(self):
+        self.podio.post.return_value.status_code = 200
+        self.storage.delete_items(1, [10, 11, 12], chunk_size=2)
+        self.assertEqual(2, self.podio.post.call_count)
+        self.assertEqual({'item_ids': [12]}, self.podio.post.call_args[1]['json'])
+        self.assertEqual([10, 11, 12], self.storage.get_tombstones(1))
+        self.storage.purge_tombstones(1)
+        self.assertEqual([], self.storage.get_tombstones(1))
+
+    def test_delete_items_without_bulk_endpoint(self):
+        self.podio.post.return_value.status_code = 404
+        self.podio.delete.return_value.status_code = 204
+        self.storage.delete_items(1, [10, 11])
+        self.assertEqual(2, self.podio.delete.call_count)
+        self.assertEqual([10, 11], self.storage.get_tombstones(1))
+        self.assertEqual('Item 12', self.storage.get_item(1, 12)['title'])
+
+    def test_deleted_items_are_not_inserted_again(self):
+        self.podio.delete.return_value.status_code = 204
+        self.storage.delete_item(1, 10)
+        # A page that was downloaded before the deletion
+        page = [make_item_data(1, 10, 'Item 10'), make_item_data(1, 11, 'Item 11')]
+        self.assertEqual([11], [item['item_id'] for item in self.storage.drop_tombstoned(1, page)])
+        # Edited after the deletion, e.g. restored
+        page[0]['last_edit_on'] = '2999-01-01 00:00:00'
+        self.assertEqual(page, self.storage.drop_tombstoned(1, page))
+
+    def test_refresh_items(self):
+        self.podio.post.return_value.status_code = 200
+        self.podio.post.return_value.json.return_value = {
+            'total': 3, 'filtered': 2,
+            'items': [make_item_data(1, 12, 'Item 12 new'), make_item_data(1, 10, 'Item 10 new')],
+        }
+        self.assertEqual(2, self.storage.refresh_items(1, [10, 11, 12]))
+        self.podio.post.assert_called_once()
+        self.assertEqual({'item_id': [10, 11, 12]}, self.podio.post.call_args[1]['json']['filters'])
+        self.assertEqual('Item 10 new', self.storage.get_item(1, 10)['title'])
+        self.assertEqual('Item 12 new', self.storage.get_item(1, 12)['title'])
+        with self.assertRaises(CachedItemNotFound):
+            self.storage.get_item(1, 11)
+
+
+class TestDeleteItemMemoryBackend(TestDeleteItem):
+
+    def make_backend(self):
+        return MemoryBackend()
+
+
+class TestFindItems(CachedItemStorageTestCase):
+
+    def test_int_keyed_lookup(self):
+        self.assertEqual(11, self.storage.get_item_by_join_ids(1, {'item_id': 11}).item_id)
+        self.assertEqual(11, self.storage.get_item_by_join_ids(1, {'item_id': '11'}).item_id)
+        self.assertEqual(12, self.storage.get_item_by_join_ids(
+            1, {'item_id': 12, 'title': 'Item 12'}).item_id)
+        with self.assertRaises(CachedItemNotFound):
+            self.storage.get_item_by_join_ids(1, {'item_id': 12, 'title': 'Item 11'})
+        with self.assertRaises(CachedItemNotFound):
+            self.storage.get_item_by_join_ids(1, {'item_id': 13})
+
+
+class TestFindItemsMemoryBackend(TestFindItems):
+
+    def make_backend(self):
+        return MemoryBackend()
+
+
+class TestMemoryBackend(CachedItemStorageTestCase):
+
+    def make_backend(self):
+        return MemoryBackend(max_items=3)
+
+    def test_lookups(self):
+        self.assertEqual(11, self.storage.get_item(1, 11).item_id)
+        self.assertEqual(12, self.storage.get_item_by_natural_key(1, ['Item 12']).item_id)
+        self.assertEqual(10, self.storage.get_item_by_join_ids(1, {'title': 'Item 10'}).item_id)
+        with self.assertRaises(CachedItemNotFound):
+            self.storage.get_referenced_item(1, [11, 12], {'title': 'Item 10'})
+
+    def test_failed_put_keeps_the_old_row(self):
+        # Item 11 can't take the natural key of item 10
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.storage.insert_item_data_into_db(1, make_item_data(1, 11, 'Item 10'),
+                                                  ['title'], ['title'])
+        self.assertEqual('Item 11', self.storage.get_item(1, 11)['title'])
+        self.assertEqual(11, self.storage.get_item_by_natural_key(1, ['Item 11']).item_id)
+        self.assertEqual(10, self.storage.get_item_by_natural_key(1, ['Item 10']).item_id)
+
+    def test_lru_eviction(self):
+        # Touch item 10, so that item 11 is the least recently used one.
+        self.storage.get_item(1, 10)
+        self.storage.insert_item_data_into_db(1, make_item_data(1, 13, 'Item 13'),
+                                              ['title'], ['title'])
+        self.assertEqual(13, self.storage.get_item(1, 13).item_id)
+        self.assertEqual(10, self.storage.get_item(1, 10).item_id)
+        with self.assertRaises(CachedItemNotFound):
+            self.storage.get_item(1, 11)
+        with self.assertRaises(CachedItemNotFound):
+            self.storage.get_item_by_natural_key(1, ['Item 11'])
+
+
+class TestSQLiteConnectionPool(TestCase):
+
+    def setUp(self):
+        fd, self.db_filename = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        self.pool = SQLiteConnectionPool(self.db_filename)
+        self.storage = CachedItemStorage(self.pool, MagicMock())
+        self.storage.setup_app_cache(1, ['title'], None)
+        for item_id in range(20):
+            self.storage.insert_item_data_into_db(
+                1, make_item_data(1, item_id, 'Item %d' % item_id), ['title'])
+
+    def tearDown(self):
+        self.pool.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db_filename + suffix):
+                os.remove(self.db_filename + suffix)
+
+    def test_parallel_readers(self):
+        results = {}
+
+        def read(item_id):
+            results[item_id] = self.storage.get_item(1, item_id)['title']
+
+        threads = [threading.Thread(target=read, args=(i, )) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual('Item 7', results[7])
+        self.assertEqual(20, len(results))
+        self.assertEqual(20, len(self.pool._readers))
+
+    def test_read_only(self):
+        pool = SQLiteConnectionPool(self.db_filename, read_only=True)
+        storage = CachedItemStorage(pool, MagicMock())
+        storage.init_cache()
+        self.assertEqual('Item 3', storage.get_item(1, 3)['title'])
+        with self.assertRaises(sqlite3.OperationalError):
+            storage.remove_item_from_db(1, 3)
+        pool.close()
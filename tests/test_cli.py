@@ -1,5 +1,133 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
 from unittest import TestCase
+from unittest.mock import patch
+
+from click.testing import CliRunner
+
+from tetrapod.cli import cli
+from tetrapod.fakeserver import FakePodioServer
 
 
 class CLITestCase(TestCase):
-    pass
+
+    def test_lazy_imports(self):
+        # 'tpod --help' must not pay for requests, oauthlib or http.server
+        code = ('import sys, tetrapod.cli, tetrapod.cache; '
+                'print(",".join(m for m in ("requests", "requests_oauthlib", "oauthlib", '
+                '"http.server", "dateutil") if m in sys.modules))')
+        output = subprocess.check_output([sys.executable, '-c', code], text=True)
+        self.assertEqual('', output.strip())
+
+    def test_callback_handler(self):
+        from tetrapod import podio_auth
+        from http.server import BaseHTTPRequestHandler
+        self.assertTrue(issubclass(podio_auth.OAuth2CallbackHandler, BaseHTTPRequestHandler))
+        self.assertTrue(issubclass(podio_auth.MakeHandlerClass('id'),
+                                   podio_auth.OAuth2CallbackHandler))
+
+
+class TestSyncAndExportCommands(TestCase):
+
+    def setUp(self):
+        self.server = FakePodioServer().start()
+        self.server.add_app(1001, num_items=25, num_fields=2)
+        self.server.add_app(1002, num_items=5, num_fields=2)
+        patchers = [
+            patch.dict('os.environ', {'OAUTHLIB_INSECURE_TRANSPORT': '1',
+                                      'TETRAPOD_CLIENT_ID': 'fake',
+                                      'TETRAPOD_ACCESS_TOKEN': 'fake'}),
+            patch('tetrapod.podio_auth.TETRAPOD_API_URL', self.server.url),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.tmpdir.name, 'podio.sqlite3')
+        self.config_file = os.path.join(self.tmpdir.name, 'sync.ini')
+        with open(self.config_file, mode='w') as fh:
+            fh.write('[sync]\n'
+                     'database = %s\n'
+                     'limit = 10\n'
+                     '\n'
+                     '[app:1001]\n'
+                     'extra_fields = text-0\n'
+                     'natural_key = text-0\n'
+                     '\n'
+                     '[app:1002]\n' % self.database)
+
+    def tearDown(self):
+        self.server.stop()
+        self.tmpdir.cleanup()
+
+    def test_sync(self):
+        runner = CliRunner()
+        result = runner.invoke(cli, ['sync', self.config_file, '--mode', 'full'])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn('App 1001: 25 items', result.output)
+        self.assertIn('App 1002: 5 items', result.output)
+        with open(self.database + '.checkpoint.json') as fh:
+            checkpoint = json.load(fh)
+        self.assertTrue(checkpoint['run']['finished'])
+        self.assertEqual('done', checkpoint['apps']['1001']['status'])
+
+        # Nothing was edited since, so the incremental run downloads nothing.
+        result = runner.invoke(cli, ['sync', self.config_file])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn('App 1001: 0 items', result.output)
+
+    def test_sync_adaptive_page_size(self):
+        with open(self.config_file) as fh:
+            config = fh.read().replace('limit = 10', 'limit = auto')
+        with open(self.config_file, mode='w') as fh:
+            fh.write(config)
+        result = CliRunner().invoke(cli, ['sync', self.config_file, '--mode', 'full'])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn('App 1001: 25 items', result.output)
+        with open(self.database + '.checkpoint.json') as fh:
+            checkpoint = json.load(fh)
+        self.assertEqual(25, checkpoint['apps']['1001']['offset'])
+
+    def test_resume_interrupted_run(self):
+        checkpoint_file = self.database + '.checkpoint.json'
+        with open(checkpoint_file, mode='w') as fh:
+            json.dump({
+                'run': {'id': '2024-01-31 02:00:00', 'mode': 'full', 'finished': False},
+                'apps': {
+                    '1001': {'run': '2024-01-31 02:00:00', 'status': 'failed',
+                             'started_at': '2024-01-31 02:00:00', 'offset': 20,
+                             'since': None, 'clear': True},
+                    '1002': {'run': '2024-01-31 02:00:00', 'status': 'done',
+                             'started_at': '2024-01-31 02:00:00', 'offset': 5,
+                             'last_synced': '2024-01-31 02:00:00'},
+                }
+            }, fh)
+        result = CliRunner().invoke(cli, ['sync', self.config_file])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn('Resuming the full sync', result.output)
+        self.assertIn('App 1002: already done', result.output)
+        self.assertIn('App 1001: 5 items', result.output)
+        with open(checkpoint_file) as fh:
+            checkpoint = json.load(fh)
+        self.assertEqual('2024-01-31 02:00:00', checkpoint['apps']['1001']['last_synced'])
+        self.assertTrue(checkpoint['run']['finished'])
+
+    def test_export(self):
+        output = os.path.join(self.tmpdir.name, 'app.jsonl')
+        result = CliRunner().invoke(cli, ['export', '1001', '-o', output, '-f', 'text-0',
+                                          '--limit', '10'])
+        self.assertEqual(0, result.exit_code, result.output)
+        with open(output) as fh:
+            lines = [json.loads(line) for line in fh]
+        self.assertEqual(25, len(lines))
+        self.assertEqual(['item_id', 'text-0'], list(lines[0].keys()))
+
+        result = CliRunner().invoke(cli, ['sync', self.config_file])
+        self.assertEqual(0, result.exit_code, result.output)
+        result = CliRunner().invoke(cli, ['export', '1002', '--database', self.database,
+                                          '-o', '-'])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual(6, len(result.output.splitlines()))
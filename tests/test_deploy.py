@@ -0,0 +1,70 @@
+import configparser
+import json
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from tetrapod.deploy import (DEPLOYED, FAILED, UNCHANGED, DeployState, deploy_fields,
+                             project_fields)
+from tetrapod.fakeserver import FakePodioServer, FAKE_TOKEN
+from tetrapod.podio_auth import PodioOAuth2Session
+
+
+class TestDeploy(TestCase):
+
+    def setUp(self):
+        self.server = FakePodioServer().start()
+        patcher = patch.dict('os.environ', {'OAUTHLIB_INSECURE_TRANSPORT': '1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.podio = PodioOAuth2Session('fake', token=dict(FAKE_TOKEN), api_url=self.server.url)
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+        # A project with the calculation field of two apps
+        self.config = configparser.ConfigParser()
+        self.config['project'] = {'name': 'space', 'apps': 'app-1, app-2'}
+        for app_id, app_name in ((1001, 'app-1'), (1002, 'app-2')):
+            app_config = self.server.add_app(app_id, num_items=0, num_fields=8)
+            field = [f for f in app_config['fields'] if f['type'] == 'calculation'][0]
+            script = os.path.join(self.tmpdir.name, '%s.js' % app_name)
+            settings = os.path.join(self.tmpdir.name, '%s.json' % app_name)
+            with open(script, mode='w') as fh:
+                fh.write(field['config']['settings']['script'])
+            with open(settings, mode='w') as fh:
+                json.dump(field, fh)
+            self.config['space.%s' % app_name] = {'app_id': app_id,
+                                                  'fields': field['external_id']}
+            self.config['space.%s.%s' % (app_name, field['external_id'])] = {
+                'field_id': field['field_id'], 'script': script, 'settings': settings}
+        self.state_file = os.path.join(self.tmpdir.name, 'space.tpoddeploy.json')
+
+    def tearDown(self):
+        self.server.stop()
+        self.tmpdir.cleanup()
+
+    def deploy(self, **kwargs):
+        state = DeployState(self.state_file)
+        return [r.status for r in deploy_fields(self.podio, project_fields(self.config),
+                                                state, workers=2, **kwargs)]
+
+    def test_only_changed_fields(self):
+        self.assertEqual([DEPLOYED, DEPLOYED], self.deploy())
+        self.assertEqual([UNCHANGED, UNCHANGED], self.deploy())
+
+        with open(os.path.join(self.tmpdir.name, 'app-2.js'), mode='w') as fh:
+            fh.write('"Changed"')
+        num_requests = self.server.num_requests
+        self.assertEqual([UNCHANGED, DEPLOYED], self.deploy())
+        self.assertEqual(num_requests + 1, self.server.num_requests)
+        field = self.server.app_configs[1002]['fields'][6]
+        self.assertEqual('"Changed"', field['config']['settings']['script'])
+
+        self.assertEqual([DEPLOYED, DEPLOYED], self.deploy(force=True))
+
+    def test_failed_fields_are_retried(self):
+        self.config['space.app-2.calculation-6']['field_id'] = '999'
+        self.assertEqual([DEPLOYED, FAILED], self.deploy())
+        self.assertEqual([UNCHANGED, FAILED], self.deploy())
+        with open(self.state_file) as fh:
+            self.assertEqual(['1001/1001006'], list(json.load(fh).keys()))
@@ -0,0 +1,124 @@
+import csv
+import datetime
+import io
+import json
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+
+from tetrapod.export import export_app, parquet_column_kind, ParquetExportWriter
+from tetrapod.items import select_fields
+from tetrapod.fakeserver import FakePodioServer, FAKE_TOKEN
+from tetrapod.podio_auth import PodioOAuth2Session
+from tetrapod.sync import MultiAppCacheBuilder
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class TestExport(TestCase):
+
+    def setUp(self):
+        self.server = FakePodioServer().start()
+        self.app_config = self.server.add_app(1001, num_items=55, num_fields=4)
+        patcher = patch.dict('os.environ', {'OAUTHLIB_INSECURE_TRANSPORT': '1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.podio = PodioOAuth2Session('fake', token=dict(FAKE_TOKEN), api_url=self.server.url)
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.stop()
+        self.tmpdir.cleanup()
+
+    def test_select_fields(self):
+        self.assertEqual((['text-0', 'date-2__start_dt'], ['text-0', 'date-2__start_dt']),
+                         select_fields(self.app_config, external_ids=['date-2__start_dt', 'text-0']))
+        self.assertEqual((['number-1'], ['Number 1']),
+                         select_fields(self.app_config, labels=['Number 1']))
+        with self.assertRaises(ValueError):
+            select_fields(self.app_config, external_ids=['text-0'], labels=['Number 1'])
+
+    def test_csv(self):
+        path = os.path.join(self.tmpdir.name, 'items.csv')
+        progress = []
+        num_items = export_app(self.podio, 1001, path, limit=10, workers=3,
+                               progress_callback=progress.append)
+        self.assertEqual(55, num_items)
+        self.assertEqual(55, progress[-1])
+        self.assertEqual(6, len(progress))
+        with open(path, newline='') as fh:
+            rows = list(csv.reader(fh))
+        self.assertEqual(['item_id', 'text-0', 'number-1', 'date-2', 'category-3'], rows[0])
+        self.assertEqual([str(item_id) for item_id in self.server.items[1001]],
+                         [row[0] for row in rows[1:]])
+
+    def test_failed_export_leaves_no_file(self):
+        path = os.path.join(self.tmpdir.name, 'items.csv')
+
+        def fail(num_items):
+            raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            export_app(self.podio, 1001, path, format='csv', limit=10, progress_callback=fail)
+        self.assertEqual([], os.listdir(self.tmpdir.name))
+
+    def test_jsonl_by_label(self):
+        out = io.StringIO()
+        export_app(self.podio, 1001, out, format='jsonl', labels=['Text 0', 'Number 1'], limit=20)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(55, len(lines))
+        self.assertEqual(['item_id', 'Text 0', 'Number 1'], list(lines[0].keys()))
+        first = next(iter(self.server.items[1001].values()))
+        self.assertEqual(first['fields'][0]['values'][0]['value'], lines[0]['Text 0'])
+
+    def test_from_cache(self):
+        database = os.path.join(self.tmpdir.name, 'cache.sqlite3')
+        builder = MultiAppCacheBuilder(self.podio, database, limit=20)
+        builder.add_app(1001)
+        builder.run()
+        num_requests = self.server.num_requests
+
+        out = io.StringIO()
+        num_items = export_app(None, 1001, out, external_ids=['text-0', 'category-3'],
+                               database=database, limit=7)
+        self.assertEqual(55, num_items)
+        self.assertEqual(num_requests, self.server.num_requests)
+        rows = list(csv.reader(io.StringIO(out.getvalue())))
+        self.assertEqual(['item_id', 'text-0', 'category-3'], rows[0])
+        self.assertEqual(sorted(self.server.items[1001]), [int(row[0]) for row in rows[1:]])
+        self.assertEqual(56, len(rows))
+
+    def test_parquet_column_kinds(self):
+        self.assertEqual(['string', 'float', 'int', 'string', 'timestamp', 'string'],
+                         [parquet_column_kind(self.app_config, field_id)
+                          for field_id in ['number-1', 'number-1__float', 'number-1__int',
+                                           'date-2', 'date-2__end_dt', 'unknown__int']])
+
+    @skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_parquet_mixed_types_across_pages(self):
+        path = os.path.join(self.tmpdir.name, 'items.parquet')
+        field_ids = ['text-0', 'number-1__int', 'number-1__float', 'date-2__start_dt']
+        writer = ParquetExportWriter(path, ['item_id'] + field_ids, self.app_config, field_ids)
+        # The text column is empty on the first page, the others change their type
+        writer.write_rows([[1, None, 1, 1, datetime.datetime(2024, 1, 1, 12, 0)]])
+        writer.write_rows([[2, 'two', 2.0, 2.5, None],
+                           [3, ['a', 'b'], 'not a number', 3, 'not a date']])
+        writer.close()
+
+        table = pyarrow.parquet.read_table(path)
+        self.assertEqual('string', str(table.schema.field('text-0').type))
+        self.assertEqual('int64', str(table.schema.field('number-1__int').type))
+        values = table.to_pydict()
+        self.assertEqual(['a', 'b'], json.loads(values['text-0'][2]))
+        self.assertEqual({
+            'item_id': [1, 2, 3],
+            'text-0': [None, 'two', values['text-0'][2]],
+            'number-1__int': [1, 2, None],
+            'number-1__float': [1.0, 2.5, 3.0],
+            'date-2__start_dt': [datetime.datetime(2024, 1, 1, 12, 0), None, None],
+        }, values)
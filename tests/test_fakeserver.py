@@ -0,0 +1,52 @@
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+import requests
+
+from tetrapod.fakeserver import FakePodioServer, FAKE_TOKEN
+from tetrapod.helpers import iterate_resource
+from tetrapod.podio_auth import PodioOAuth2Session
+
+
+class TestFakePodioServer(TestCase):
+
+    def setUp(self):
+        self.server = FakePodioServer(rate_limit=100).start()
+        self.server.add_app(1001, num_items=120, num_fields=8)
+        patcher = patch.dict('os.environ', {'OAUTHLIB_INSECURE_TRANSPORT': '1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.podio = PodioOAuth2Session('fake', token=dict(FAKE_TOKEN), api_url=self.server.url)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_iterate_resource(self):
+        url = 'https://api.podio.com/item/app/1001/filter/'
+        items = iterate_resource(self.podio, url, limit=50)
+        self.assertEqual(120, len(items))
+        self.assertEqual(3, self.server.num_requests)
+
+    def test_rate_limit_headers(self):
+        resp = self.podio.get('https://api.podio.com/app/1001/')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('100', resp.headers['X-Rate-Limit-Limit'])
+        self.assertEqual('99', resp.headers['X-Rate-Limit-Remaining'])
+
+    def test_page_size_timeout(self):
+        resp = requests.post(self.server.url + '/item/app/1001/filter/', json={'limit': 501})
+        self.assertEqual(504, resp.status_code)
+
+    def test_error_injection(self):
+        self.server.error_rate = 1.0
+        resp = requests.get(self.server.url + '/item/1001000001')
+        self.assertEqual(504, resp.status_code)
+
+    def test_update_and_delete_item(self):
+        item_url = self.server.url + '/item/1001000001'
+        resp = requests.put(item_url + '/value', json={'text-0': 'Renamed'})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('Renamed', self.server.find_item(1001000001)['fields'][-1]['values'][0]['value'])
+        self.assertEqual(204, requests.delete(item_url).status_code)
+        self.assertEqual(404, requests.get(item_url).status_code)
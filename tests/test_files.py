@@ -0,0 +1,95 @@
+import io
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from tetrapod.fakeserver import FakePodioServer, FAKE_TOKEN
+from tetrapod.files import (
+    MultipartFileStream,
+    download_file,
+    transfer_files,
+    upload_and_attach,
+    upload_file_stream,
+)
+from tetrapod.helpers import upload_file
+from tetrapod.podio_auth import PodioOAuth2Session
+
+
+class TestMultipartFileStream(TestCase):
+
+    def test_iterate_twice(self):
+        body = MultipartFileStream(io.BytesIO(b'x' * 25), 'a.txt', chunk_size=10)
+        first = b''.join(body)
+        self.assertEqual(len(body), len(first))
+        self.assertEqual(first, b''.join(body))
+        self.assertIn(b'filename="a.txt"\r\nContent-Type: text/plain', first)
+
+
+class TestFiles(TestCase):
+
+    def setUp(self):
+        self.server = FakePodioServer().start()
+        patcher = patch.dict('os.environ', {'OAUTHLIB_INSECURE_TRANSPORT': '1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.podio = PodioOAuth2Session('fake', token=dict(FAKE_TOKEN), api_url=self.server.url)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def make_file(self, name, data):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, mode='wb') as fh:
+            fh.write(data)
+        return path
+
+    def test_upload_and_download(self):
+        data = os.urandom(300 * 1024)
+        path = self.make_file('report.bin', data)
+        file_id = upload_and_attach(self.podio, 123, path, chunk_size=64 * 1024)
+        self.assertEqual(data, self.server.files[file_id]['data'])
+        self.assertEqual('report.bin', self.server.files[file_id]['name'])
+        self.assertEqual([('item', 123)], self.server.files[file_id]['attached_to'])
+
+        download_dir = os.path.join(self.tmpdir.name, 'downloads')
+        os.mkdir(download_dir)
+        downloaded = download_file(self.podio, file_id, download_dir, chunk_size=64 * 1024)
+        self.assertEqual(os.path.join(download_dir, 'report.bin'), downloaded)
+        with open(downloaded, mode='rb') as fh:
+            self.assertEqual(data, fh.read())
+        self.assertEqual(['report.bin'], os.listdir(download_dir))
+
+    def test_upload_file_helper(self):
+        # The old helper of tetrapod.helpers goes through the same streaming upload
+        file_id = upload_file(self.podio, 123, b'hello', 'hello.txt')
+        self.assertEqual(b'hello', self.server.files[file_id]['data'])
+        self.assertEqual([('item', 123)], self.server.files[file_id]['attached_to'])
+
+    def test_upload_bytes_and_file_objects(self):
+        file_id = upload_file_stream(self.podio, b'hello', 'hello.txt')
+        self.assertEqual(b'hello', self.server.files[file_id]['data'])
+        file_id = upload_file_stream(self.podio, io.BytesIO(b'world'), 'world.txt')
+        self.assertEqual('world.txt', self.server.files[file_id]['name'])
+        out = io.BytesIO()
+        download_file(self.podio, file_id, out)
+        self.assertEqual(b'world', out.getvalue())
+
+    def test_transfer_files(self):
+        paths = [self.make_file('file-%d.txt' % i, b'content %d' % i) for i in range(10)]
+        existing = self.server.add_file('existing.txt', b'existing')
+        reported = []
+        transfers = transfer_files(
+            self.podio,
+            uploads=[(1000 + i, path) for i, path in enumerate(paths)],
+            downloads=[(existing, os.path.join(self.tmpdir.name, 'copy.txt')), (999, self.tmpdir.name)],
+            workers=4, progress_callback=reported.append)
+        self.assertEqual(12, len(transfers))
+        self.assertEqual(12, len(reported))
+        self.assertTrue(all(t.ok for t in transfers[:11]))
+        # file 999 does not exist
+        self.assertIsNotNone(transfers[11].error)
+        self.assertEqual(10, len([f for f in self.server.files.values() if f['attached_to']]))
+        self.assertEqual(8, transfers[10].size)
@@ -1,21 +1,144 @@
+import itertools
 import json
 import os
 from unittest import TestCase
+from unittest.mock import patch
 
+from tetrapod.fakeserver import FakePodioServer, FAKE_TOKEN
 from tetrapod.helpers import (
+    AdaptivePageSize,
+    app_filter,
+    fetch_items_by_id,
+    iter_array,
     iterate_array,
     iterate_resource,
+    iterate_resource_pages,
+    load_complete_app,
     intersection,
     union,
 )
+from tetrapod.podio_auth import PodioOAuth2Session
 
 
 class TestIterateArray(TestCase):
     def setUp(self):
-        pass
+        self.server = FakePodioServer().start()
+        self.server.add_app(1001, num_items=300, num_fields=2)
+        patcher = patch.dict('os.environ', {'OAUTHLIB_INSECURE_TRANSPORT': '1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.podio = PodioOAuth2Session('fake', token=dict(FAKE_TOKEN), api_url=self.server.url)
+        # The fake server gives item 1001000250 250 comments
+        self.url = 'https://api.podio.com/comment/item/1001000250/'
+
+    def tearDown(self):
+        self.server.stop()
 
     def test_iterate_array(self):
-        pass
+        comments = iterate_array(self.podio, self.url, 'GET', limit=100)
+        self.assertEqual(250, len(comments))
+        self.assertEqual(3, self.server.num_requests)
+
+    def test_prefetch(self):
+        comments = iterate_array(self.podio, self.url, 'GET', limit=30, prefetch=3)
+        self.assertEqual(['Comment %d' % i for i in range(250)], [c['value'] for c in comments])
+        # 9 pages, plus at most 3 speculative requests past the end
+        self.assertLessEqual(self.server.num_requests, 12)
+
+    def test_early_termination(self):
+        comments = iter_array(self.podio, self.url, 'GET', limit=10, prefetch=2)
+        first = list(itertools.islice(comments, 15))
+        comments.close()
+        self.assertEqual(15, len(first))
+        self.assertLessEqual(self.server.num_requests, 5)
+
+    def test_resource_pages_prefetch(self):
+        url = 'https://api.podio.com/item/app/1001/filter/'
+        pages = list(iterate_resource_pages(self.podio, url, limit=40, offset=20, prefetch=3))
+        self.assertEqual([40] * 7, [len(page) for page in pages])
+        item_ids = [item['item_id'] for page in pages for item in page]
+        self.assertEqual(list(self.server.items[1001])[20:], item_ids)
+        # The total is known after the first page, so nothing is requested twice
+        self.assertEqual(7, self.server.num_requests)
+
+    def test_fetch_items_by_id(self):
+        all_ids = list(self.server.items[1001])
+        wanted = all_ids[250:] + all_ids[:20] + [all_ids[0], 1]
+        items = fetch_items_by_id(self.podio, 1001, wanted, chunk_size=30, workers=3)
+        # Duplicates and unknown items are dropped, the order is kept
+        self.assertEqual(all_ids[250:] + all_ids[:20], [item['item_id'] for item in items])
+        self.assertEqual(3, self.server.num_requests)
+        with self.assertRaises(ValueError):
+            fetch_items_by_id(self.podio, 1001, wanted, chunk_size=501)
+
+    def test_app_filter(self):
+        url, params = app_filter(1001, view_id=7, filters={'item_id': [1]}, sort_by='title',
+                                 sort_desc=False, fields='items.view(micro)')
+        self.assertEqual('https://api.podio.com/item/app/1001/filter/7/?fields=items.view(micro)',
+                         url)
+        self.assertEqual({'filters': {'item_id': [1]}, 'sort_by': 'title', 'sort_desc': False},
+                         params)
+        self.assertEqual(('https://api.podio.com/item/app/1001/filter/', {}), app_filter(1001))
+
+    def test_load_view_and_fields(self):
+        all_ids = list(self.server.items[1001])
+        self.server.add_view(1001, 7, filters={'item_id': all_ids[:120]}, sort_by='item_id')
+        items = load_complete_app(self.podio, 1001, view_id=7, fields='items.view(micro)')
+        # The order of the view, all pages, and only the micro representation
+        self.assertEqual(list(reversed(all_ids[:120])), [item.item_id for item in items])
+        self.assertEqual(['app_item_id', 'item_id', 'link', 'title'],
+                         sorted(items[0].item_data.keys()))
+        self.assertEqual(1, self.server.num_requests)
+
+        items = load_complete_app(self.podio, 1001, view_id=7, sort_by='item_id',
+                                  sort_desc=False, filters={'item_id': all_ids[100:400]})
+        self.assertEqual(all_ids[100:300], [item.item_id for item in items])
+        self.assertIn('fields', items[0].item_data)
+
+
+class TestAdaptivePageSize(TestCase):
+    def setUp(self):
+        # Pages of more than 120 items time out
+        self.server = FakePodioServer(max_page_size=120).start()
+        self.server.add_app(1001, num_items=1000, num_fields=2)
+        patcher = patch.dict('os.environ', {'OAUTHLIB_INSECURE_TRANSPORT': '1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # A robust session would retry every 504 with the same page size
+        self.podio = PodioOAuth2Session('fake', token=dict(FAKE_TOKEN), api_url=self.server.url,
+                                        enable_robustness=True)
+        self.url = 'https://api.podio.com/item/app/1001/filter/'
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_adaptive_pull(self):
+        page_size = AdaptivePageSize()
+        pages = list(iterate_resource_pages(self.podio, self.url, offset=10, adaptive=page_size))
+        item_ids = [item['item_id'] for page in pages for item in page]
+        self.assertEqual(list(self.server.items[1001])[10:], item_ids)
+        # 500, 250 and 125 fail, then the pages grow up to 120 and stay there
+        self.assertEqual([62, 77, 96, 120], [len(page) for page in pages[:4]])
+        self.assertEqual(120, page_size.limit)
+        self.assertEqual(3 + len(pages), self.server.num_requests)
+
+        # The next pull starts with what was learned
+        self.server.num_requests = 0
+        self.assertEqual(1000, len(iterate_resource(self.podio, self.url, adaptive=page_size)))
+        self.assertEqual(9, self.server.num_requests)
+
+    def test_slow_pages_and_giving_up(self):
+        page_size = AdaptivePageSize(limit=100, fast_seconds=0.0, slow_seconds=0.0)
+        page_size.succeeded(1.0)
+        self.assertEqual(75, page_size.limit)
+
+        self.server.error_rate = 1.0
+        page_size = AdaptivePageSize(max_failures=2, retry_wait=0.0)
+        with self.assertRaises(Exception):
+            list(iterate_resource_pages(self.podio, self.url, adaptive=page_size))
+        self.assertEqual(3, self.server.num_requests)
+        with self.assertRaises(ValueError):
+            list(iterate_resource_pages(self.podio, self.url, adaptive=True, prefetch=2))
 
 
 class TestIterateResource(TestCase):
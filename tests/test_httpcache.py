@@ -0,0 +1,110 @@
+import tempfile
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+from tetrapod.fakeserver import FakePodioServer, FAKE_TOKEN
+from tetrapod.httpcache import CACHE_HEADER, ResponseCache
+from tetrapod.podio_auth import PodioOAuth2Session
+
+APP_URL = 'https://api.podio.com/app/1001/'
+
+
+class TestResponseCache(TestCase):
+
+    def setUp(self):
+        self.server = FakePodioServer().start()
+        self.server.add_app(1001, num_items=10, num_fields=4)
+        patcher = patch.dict('os.environ', {'OAUTHLIB_INSECURE_TRANSPORT': '1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def make_session(self, cache, **token):
+        podio = PodioOAuth2Session('fake', token=dict(FAKE_TOKEN, **token), api_url=self.server.url)
+        podio.enable_response_cache(cache)
+        return podio
+
+    def test_hit(self):
+        podio = self.make_session(ResponseCache())
+        first = podio.get(APP_URL)
+        second = podio.get(APP_URL)
+        self.assertEqual(1, self.server.num_requests)
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual('hit', second.headers[CACHE_HEADER])
+        # Not a cached endpoint
+        podio.get('https://api.podio.com/item/1001000001')
+        podio.get('https://api.podio.com/item/1001000001')
+        self.assertEqual(3, self.server.num_requests)
+
+    def test_revalidate(self):
+        cache = ResponseCache(ttls=[(r'/app/\d+/?', 0)])
+        podio = self.make_session(cache)
+        first = podio.get(APP_URL)
+        second = podio.get(APP_URL)
+        self.assertEqual(2, self.server.num_requests)
+        self.assertEqual('revalidated', second.headers[CACHE_HEADER])
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(1, cache.revalidations)
+
+    def test_directory(self):
+        self.make_session(ResponseCache(directory=self.tmpdir.name)).get(APP_URL)
+        podio = self.make_session(ResponseCache(directory=self.tmpdir.name))
+        resp = podio.get(APP_URL)
+        self.assertEqual(1, self.server.num_requests)
+        self.assertEqual(1001, resp.json()['app_id'])
+
+    def test_accounts_sharing_a_directory(self):
+        user_1 = {'ref': {'type': 'user', 'id': 1}}
+        self.make_session(ResponseCache(directory=self.tmpdir.name), **user_1).get(APP_URL)
+        # Another user doesn't get the response of the first one ...
+        podio = self.make_session(ResponseCache(directory=self.tmpdir.name),
+                                  ref={'type': 'user', 'id': 2})
+        self.assertNotEqual('hit', podio.get(APP_URL).headers.get(CACHE_HEADER))
+        self.assertEqual(2, self.server.num_requests)
+        # ... but the first user does, also with a refreshed access token
+        podio = self.make_session(ResponseCache(directory=self.tmpdir.name),
+                                  access_token='refreshed', **user_1)
+        self.assertEqual('hit', podio.get(APP_URL).headers[CACHE_HEADER])
+        self.assertEqual(2, self.server.num_requests)
+
+    def test_decoded_content_has_no_content_length(self):
+        cache = ResponseCache()
+        podio = self.make_session(cache)
+        podio.get(APP_URL, headers={'Accept-Encoding': 'gzip'})
+        resp = podio.get(APP_URL)
+        self.assertEqual('hit', resp.headers[CACHE_HEADER])
+        self.assertNotIn('Content-Length', resp.headers)
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_params_and_invalidation(self):
+        podio = self.make_session(ResponseCache(directory=self.tmpdir.name))
+        podio.get(APP_URL)
+        podio.get(APP_URL, params={'view': 'micro'})
+        self.assertEqual(2, self.server.num_requests)
+        # Changing a field of the app drops the cached app
+        podio.put('https://api.podio.com/app/1001/field/1001000', json={'label': 'New'})
+        podio.get(APP_URL)
+        podio.get(APP_URL, params={'view': 'micro'})
+        self.assertEqual(5, self.server.num_requests)
+
+    def test_counters_from_several_threads(self):
+        cache = ResponseCache()
+        podio = self.make_session(cache)
+        podio.get(APP_URL)
+
+        def get_app():
+            for i in range(200):
+                podio.get(APP_URL)
+
+        threads = [threading.Thread(target=get_app) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, self.server.num_requests)
+        self.assertEqual((1600, 1), (cache.hits, cache.misses))
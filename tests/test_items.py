@@ -7,7 +7,16 @@ from tetrapod.items import (
     fetch_field,
     Item,
     CategoryMediator,
+    DateMediator,
+    get_category_option_index,
+    parse_podio_datetime,
+    parse_podio_datetimes,
+    profile_fields,
+    AccessorPlan,
+    FieldAccessor,
 )
+from tetrapod.synthetic import make_app_config, make_items
+import tetrapod.items
 
 
 class ItemTestCase(TestCase):
@@ -39,6 +48,26 @@ class TestCategoryMediator(ItemTestCase):
             res
         )
 
+    def test_update_category_int(self):
+        res = self.mediator.update(self.field, 3)
+        self.assertEqual(['Rejected'], [v['value']['text'] for v in res])
+
+    def test_update_category_list(self):
+        res = self.mediator.update(self.field, ['Rejected', 1, 'Unknown'])
+        self.assertEqual([3, 1], [v['value']['id'] for v in res])
+        self.assertEqual([], self.mediator.update(self.field, []))
+
+    def test_option_index_cache(self):
+        index = get_category_option_index(self.field)
+        self.assertIs(index, get_category_option_index(self.field))
+        # Options changed in place
+        options = self.field['config']['settings']['options']
+        options.append({'status': 'active', 'text': 'Done', 'id': 4, 'color': 'DCEBD8'})
+        self.assertEqual(4, self.mediator.update(self.field, 'Done')[0]['value']['id'])
+        # A new config
+        self.field['config'] = json.loads(json.dumps(self.field['config']))
+        self.assertIsNot(index, get_category_option_index(self.field))
+
     def test_fetch_category(self):
         self.assertEqual(
             [(1, "Entered"), (2, "Accepted"), (3, "Rejected")],
@@ -201,3 +230,85 @@ class TestItem(TestCase):
         res = self.item.as_podio_dict(fields=['name'])
         self.assertEqual("Bow of boat", res['name'])
 
+
+
+class TestFieldProfiler(ItemTestCase):
+
+    def test_profile_fields(self):
+        item = Item(item_data=self.test_item)
+        with profile_fields() as profiler:
+            for _ in range(3):
+                item['name']
+                item['date__start_dt']
+            item['status2__choices']
+            item['name'] = 'Bow of ship'
+            item.as_podio_dict(fields=['name'])
+        self.assertIsNone(tetrapod.items._profiler)
+        # Not recorded, profiling is off again
+        item['name']
+
+        self.assertEqual(3, profiler.stats[('fetch_field', 'TextMediator', None)][0])
+        self.assertEqual(3, profiler.stats[('fetch_field', 'DateMediator', 'start_dt')][0])
+        self.assertEqual(1, profiler.stats[('fetch_field', 'CategoryMediator', 'choices')][0])
+        self.assertEqual(1, profiler.stats[('update_field', 'TextMediator', None)][0])
+        self.assertEqual(1, profiler.stats[('fetch_podio_dict', 'TextMediator', None)][0])
+        self.assertEqual(5, profiler.by_mediator()['TextMediator'][0])
+
+        report = profiler.report().splitlines()
+        self.assertEqual(6, len(report))
+        self.assertIn('per call', report[0])
+
+
+class TestCompiledAccessors(TestCase):
+
+    def setUp(self):
+        self.app_config = make_app_config(7, num_fields=16)
+        self.items = list(make_items(self.app_config, 50, fill_rate=0.5))
+        self.descriptors = [
+            'text-0', 'text_8', 'number-1', 'number-1__int', 'number-1__float',
+            'date-2', 'date-2__start_dt', 'date-2__end', 'date-10__end_dt',
+            'category-3', 'category-3__labels', 'category-3__choices', 'category-11__active',
+            'email-5', 'embed-7__all',
+        ]
+
+    def test_same_as_fetch_field(self):
+        plan = AccessorPlan(self.descriptors, self.app_config)
+        for item_data in self.items:
+            expected = [fetch_field(d, item_data, self.app_config) for d in self.descriptors]
+            self.assertEqual(expected, plan.row(item_data))
+            self.assertEqual(expected, [FieldAccessor(d, self.app_config)(item_data)
+                                        for d in self.descriptors])
+
+    def test_as_dict(self):
+        plan = AccessorPlan(['text-0', 'number-1__float'], self.app_config)
+        item_data = self.items[0]
+        self.assertEqual({'text-0': 'Item 1',
+                          'number-1__float': fetch_field('number-1__float', item_data)},
+                         plan.as_dict(item_data))
+
+    def test_unknown_field(self):
+        with self.assertRaises(KeyError):
+            FieldAccessor('does-not-exist', self.app_config)
+
+
+class TestDateParsing(TestCase):
+
+    def test_parse_podio_datetime(self):
+        for value in ['2018-07-27 01:00:00', '2000-02-29 23:59:59', '2018-7-27 1:00:00']:
+            self.assertEqual(datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S'),
+                             parse_podio_datetime(value))
+        for value in ['2018-07-27', '2018-W30-5 01:00:00', '2018-07-27T01:00:00']:
+            with self.assertRaises(ValueError):
+                parse_podio_datetime(value)
+
+    def test_parse_podio_datetimes(self):
+        self.assertEqual(
+            [datetime.datetime(2018, 7, 27, 1, 0), None, datetime.datetime(2018, 7, 27, 1, 0)],
+            parse_podio_datetimes(['2018-07-27 01:00:00', None, '2018-07-27 01:00:00'])
+        )
+
+    def test_update_date(self):
+        mediator = DateMediator()
+        for value in ['2018-07-27 01:00:00', '2018-07-27T01:00:00', '27 July 2018 1:00',
+                      datetime.datetime(2018, 7, 27, 1, 0)]:
+            self.assertEqual([{'start': '2018-07-27 01:00:00'}], mediator.update({}, value))
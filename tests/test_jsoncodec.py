@@ -0,0 +1,61 @@
+import datetime
+import json
+from unittest import TestCase, skipIf
+from unittest.mock import MagicMock
+
+from tetrapod import jsoncodec
+from tetrapod.synthetic import make_app_config, make_items
+
+
+class TestJSONCodec(TestCase):
+
+    def setUp(self):
+        self.addCleanup(jsoncodec.use_codec)
+        app_config = make_app_config(1001, num_fields=20)
+        self.items = list(make_items(app_config, 20))
+
+    def check_codec(self, name):
+        jsoncodec.use_codec(name)
+        self.assertEqual(name, jsoncodec.CODEC)
+        text = jsoncodec.dumps(self.items)
+        self.assertIsInstance(text, str)
+        self.assertEqual(self.items, json.loads(text))
+        self.assertEqual(self.items, jsoncodec.loads(text))
+        self.assertEqual(self.items, jsoncodec.loads(text.encode('utf-8')))
+
+        resp = MagicMock()
+        resp.content = json.dumps({'items': self.items, 'text': 'Grüße'}).encode('utf-8')
+        self.assertEqual('Grüße', jsoncodec.response_json(resp)['text'])
+        resp.json.assert_not_called()
+
+        # Datetimes and other unknown objects go through default, with either codec
+        value = {'due': datetime.datetime(2024, 1, 31, 12, 0), 'id': 1}
+        self.assertEqual('{"due":"2024-01-31 12:00:00","id":1}',
+                         jsoncodec.dumps(value, default=str))
+
+    def test_stdlib(self):
+        self.check_codec('json')
+
+    @skipIf(jsoncodec.orjson is None, 'orjson is not installed')
+    def test_orjson(self):
+        self.check_codec('orjson')
+        # Non-string keys work like with the json module
+        self.assertEqual('{"1":"a"}', jsoncodec.dumps({1: 'a'}))
+
+    @skipIf(jsoncodec.orjson is None, 'orjson is not installed')
+    def test_same_text_with_both_codecs(self):
+        value = {'items': self.items, 'text': 'Grüße', 'list': [1, 2.5, None, True]}
+        jsoncodec.use_codec('json')
+        text = jsoncodec.dumps(value)
+        self.assertTrue(text.startswith('{"items":[{"item_id":'))
+        jsoncodec.use_codec('orjson')
+        self.assertEqual(text, jsoncodec.dumps(value))
+
+    def test_response_like_objects(self):
+        resp = MagicMock()
+        resp.json.return_value = {'items': []}
+        self.assertEqual({'items': []}, jsoncodec.response_json(resp))
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            jsoncodec.use_codec('pickle')
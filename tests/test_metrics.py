@@ -0,0 +1,98 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from tetrapod.fakeserver import FakePodioServer, FAKE_TOKEN
+from tetrapod.helpers import iterate_resource
+from tetrapod.metrics import RequestMetrics, endpoint_template, record_metrics
+from tetrapod.podio_auth import PodioOAuth2Session
+
+
+class TestEndpointTemplate(TestCase):
+
+    def test_numeric_segments(self):
+        self.assertEqual('/item/app/{id}/filter/',
+                         endpoint_template('https://api.podio.com/item/app/123/filter/?x=1'))
+        self.assertEqual('/item/{id}', endpoint_template('https://api.podio.com/item/42'))
+        self.assertEqual('/user/profile/', endpoint_template('https://api.podio.com/user/profile/'))
+
+
+class TestRequestMetrics(TestCase):
+
+    def setUp(self):
+        self.server = FakePodioServer(rate_limit=100).start()
+        self.server.add_app(1001, num_items=120, num_fields=8)
+        patcher = patch.dict('os.environ', {'OAUTHLIB_INSECURE_TRANSPORT': '1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.podio = PodioOAuth2Session('fake', token=dict(FAKE_TOKEN), api_url=self.server.url)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_record_metrics(self):
+        url = 'https://api.podio.com/item/app/1001/filter/'
+        with record_metrics(self.podio) as metrics:
+            iterate_resource(self.podio, url, limit=50)
+            self.podio.get('https://api.podio.com/item/1')
+        # Requests after the with-block are not recorded
+        self.podio.get('https://api.podio.com/app/1001/')
+        self.assertEqual([], self.podio.metrics_recorders)
+
+        summary = metrics.summary()
+        self.assertEqual(4, summary['requests'])
+        self.assertEqual(1, summary['4xx'])
+        self.assertEqual(0, summary['5xx'])
+        self.assertEqual(3, summary['endpoints']['POST /item/app/{id}/filter/']['count'])
+        self.assertEqual(100, summary['rate_limit_limit'])
+        self.assertEqual(96, summary['rate_limit_remaining'])
+        self.assertGreater(summary['bytes_received'], 0)
+        self.assertGreater(summary['bytes_sent'], 0)
+
+    def test_recorder_removed_during_request(self):
+        # Another thread leaves its record_metrics() block while a response is recorded
+        leaving = RequestMetrics()
+        staying = RequestMetrics()
+        original = leaving.record_response
+
+        def record_and_leave(*args):
+            original(*args)
+            self.podio.metrics_recorders.remove(leaving)
+
+        leaving.record_response = record_and_leave
+        self.podio.metrics_recorders.extend([leaving, staying])
+        self.podio.get('https://api.podio.com/app/1001/')
+        self.assertEqual(1, leaving.total_requests)
+        self.assertEqual(1, staying.total_requests)
+
+    def test_retries(self):
+        self.podio.enable_robustness = True
+        self.server.error_rate = 1.0
+        metrics = self.podio.enable_metrics()
+        with patch('tetrapod.podio_auth.sleep'):
+            resp = self.podio.get('https://api.podio.com/item/1001000001')
+        self.assertEqual(504, resp.status_code)
+        self.assertEqual(6, metrics.total_requests)
+        self.assertEqual({'status_504': 5}, metrics.retries)
+
+    def test_hooks(self):
+        calls = []
+        self.podio.pre_request_hooks.append(lambda method, url, kwargs: calls.append(('pre', method)))
+        self.podio.post_request_hooks.append(
+            lambda method, url, resp, elapsed: calls.append(('post', resp.status_code)))
+        self.podio.get('https://api.podio.com/app/1001/')
+        self.assertEqual([('pre', 'GET'), ('post', 200)], calls)
+
+    def test_openmetrics(self):
+        metrics = self.podio.enable_metrics()
+        self.podio.get('https://api.podio.com/app/1001/')
+        text = metrics.to_openmetrics()
+        self.assertIn('tetrapod_requests_total{method="GET",endpoint="/app/{id}/",status="200"} 1', text)
+        self.assertIn('tetrapod_request_duration_seconds_count{method="GET",endpoint="/app/{id}/"} 1', text)
+        self.assertIn('tetrapod_rate_limit_remaining 99', text)
+        self.assertTrue(text.endswith('# EOF\n'))
+
+    def test_reset(self):
+        metrics = RequestMetrics()
+        metrics.record_retry('connection_error')
+        metrics.reset()
+        self.assertEqual({}, metrics.retries)
@@ -1,12 +1,15 @@
 import json
 import os
+import tempfile
 from unittest.mock import patch
 from unittest import TestCase
 
 from tetrapod.session import (
     try_environment_token,
     create_podio_session,
+    create_response_cache,
 )
+from tetrapod.httpcache import ResponseCache
 
 class TestSession(TestCase):
 
@@ -31,4 +34,14 @@ class TestSession(TestCase):
             )
 
     def test_try_environment_token_not_set(self):
-        self.assertEqual(None, try_environment_token())
\ No newline at end of file
+        self.assertEqual(None, try_environment_token())
+
+    def test_create_response_cache(self):
+        self.assertIsNone(create_response_cache(None))
+        self.assertIsNone(create_response_cache(False))
+        cache = ResponseCache()
+        self.assertIs(cache, create_response_cache(cache))
+        self.assertIsNone(create_response_cache(True).directory)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch.dict('os.environ', {'TETRAPOD_RESPONSE_CACHE': tmpdir}):
+                self.assertEqual(tmpdir, create_response_cache(None).directory)
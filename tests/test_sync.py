@@ -0,0 +1,255 @@
+import json
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from tetrapod.cache import CachedItemStorage
+from tetrapod.fakeserver import FakePodioServer, FAKE_TOKEN
+from tetrapod.podio_auth import PodioOAuth2Session
+from tetrapod.sync import MultiAppCacheBuilder, SyncCheckpoint
+
+
+def make_items(app_id, num):
+    return [{
+        'item_id': app_id * 1000 + i,
+        'app': {'app_id': app_id},
+        'fields': [{
+            'type': 'text',
+            'external_id': 'title',
+            'values': [{'value': 'Item %d' % i}]
+        }]
+    } for i in range(num)]
+
+
+class FakePodio(object):
+    """Answers the Podio filter endpoint from a dict of app_id -> items."""
+
+    def __init__(self, items_by_app):
+        self.items_by_app = items_by_app
+        self.requests = []
+
+    def post(self, url, json=None, **kwargs):
+        self.requests.append(json)
+        app_id = int(url.rstrip('/').split('/')[-2])
+        items = self.items_by_app[app_id]
+        offset, limit = json['offset'], json['limit']
+        resp = MagicMock()
+        resp.status_code = 200
+        resp.json.return_value = {
+            'items': items[offset:offset + limit],
+            'total': len(items),
+            'filtered': len(items),
+        }
+        return resp
+
+
+class TestMultiAppCacheBuilder(TestCase):
+
+    def setUp(self):
+        fd, self.db_filename = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.db_filename)
+
+    def test_sync_several_apps(self):
+        podio = FakePodio({1: make_items(1, 25), 2: make_items(2, 7)})
+        reported = []
+        builder = MultiAppCacheBuilder(podio, self.db_filename, workers=2, limit=10,
+                                       progress_callback=reported.append)
+        builder.add_app(1, extra_fields=['title'], natural_key='title')
+        builder.add_app(2)
+        progress = builder.run()
+
+        self.assertEqual(25, progress[1].items_written)
+        self.assertEqual(3, progress[1].api_calls)
+        self.assertEqual(7, progress[2].items_written)
+        self.assertTrue(progress[2].done)
+        self.assertTrue(len(reported) > 0)
+        summary = builder.summary()
+        self.assertEqual(32, summary['items'])
+        self.assertEqual(4, summary['api_calls'])
+        # A stable order, so that a run can be resumed from its offset
+        for request in podio.requests:
+            self.assertEqual(('item_id', False), (request['sort_by'], request['sort_desc']))
+
+        conn = sqlite3.connect(self.db_filename)
+        rows = conn.execute('SELECT item_data FROM podio_app_1 '
+                            'WHERE __natural_key = ?', ('Item 3',)).fetchall()
+        self.assertEqual(1003, json.loads(rows[0][0])['item_id'])
+        self.assertEqual(7, conn.execute('SELECT COUNT(*) FROM podio_app_2').fetchone()[0])
+        conn.close()
+
+    def test_failed_app_does_not_stop_others(self):
+        podio = FakePodio({1: make_items(1, 5)})
+        builder = MultiAppCacheBuilder(podio, self.db_filename, workers=2)
+        builder.add_app(1)
+        builder.add_app(99)  # unknown to the fake API -> KeyError
+        progress = builder.run()
+        self.assertEqual(5, progress[1].items_written)
+        self.assertIsNotNone(progress[99].error)
+        self.assertEqual(1, builder.summary()['apps_failed'])
+
+    def test_database_can_not_be_opened(self):
+        podio = FakePodio({1: make_items(1, 200), 2: make_items(2, 200)})
+        database = os.path.join(self.db_filename + '.missing', 'podio.sqlite3')
+        builder = MultiAppCacheBuilder(podio, database, workers=2, limit=1)
+        builder.add_app(1)
+        builder.add_app(2)
+        # More pages than fit into the queue, and nobody writes them
+        with self.assertRaises(sqlite3.OperationalError):
+            builder.run()
+
+    def test_failing_progress_callback(self):
+        def callback(progress):
+            raise RuntimeError('Callback failed')
+        podio = FakePodio({1: make_items(1, 200)})
+        builder = MultiAppCacheBuilder(podio, self.db_filename, workers=1, limit=1,
+                                       progress_callback=callback)
+        builder.add_app(1)
+        with self.assertRaises(RuntimeError):
+            builder.run()
+
+    def test_unexpected_fetch_error_is_raised(self):
+        podio = FakePodio({1: make_items(1, 5)})
+        builder = MultiAppCacheBuilder(podio, self.db_filename)
+        builder.add_app(1)
+        with patch('tetrapod.sync.utcnow_str', side_effect=ValueError('Broken clock')):
+            with self.assertRaises(ValueError):
+                builder.run()
+
+
+class TestIncrementalSync(TestCase):
+
+    def setUp(self):
+        self.server = FakePodioServer().start()
+        self.server.add_app(1001, num_items=40, num_fields=2)
+        self.server.add_app(1002, num_items=15, num_fields=2)
+        patcher = patch.dict('os.environ', {'OAUTHLIB_INSECURE_TRANSPORT': '1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.podio = PodioOAuth2Session('fake', token=dict(FAKE_TOKEN), api_url=self.server.url)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_filename = os.path.join(self.tmpdir.name, 'podio.sqlite3')
+        self.checkpoint_filename = os.path.join(self.tmpdir.name, 'checkpoint.json')
+
+    def tearDown(self):
+        self.server.stop()
+        self.tmpdir.cleanup()
+
+    def count(self, app_id):
+        conn = sqlite3.connect(self.db_filename)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM podio_app_%d' % app_id).fetchone()[0]
+        finally:
+            conn.close()
+
+    def sync(self, since=None):
+        checkpoint = SyncCheckpoint(self.checkpoint_filename)
+        checkpoint.start_run('incremental' if since else 'full')
+        builder = MultiAppCacheBuilder(self.podio, self.db_filename, limit=10,
+                                       checkpoint=checkpoint)
+        for app_id in (1001, 1002):
+            builder.add_app(app_id, since=since and since[app_id], clear=not since)
+        progress = builder.run()
+        checkpoint.finish_run()
+        return progress, SyncCheckpoint(self.checkpoint_filename)
+
+    def test_full_then_incremental(self):
+        progress, checkpoint = self.sync()
+        self.assertEqual(40, progress[1001].items_written)
+        self.assertEqual(15, progress[1002].items_written)
+        self.assertEqual('done', checkpoint.app(1001)['status'])
+        self.assertEqual(40, checkpoint.app(1001)['offset'])
+        last_synced = {app_id: checkpoint.app(app_id)['last_synced'] for app_id in (1001, 1002)}
+        self.assertIsNotNone(last_synced[1001])
+
+        item_id = next(iter(self.server.items[1001]))
+        self.podio.put('https://api.podio.com/item/%d/value' % item_id,
+                       json={'text-0': 'Changed'})
+
+        progress, checkpoint = self.sync(since=last_synced)
+        self.assertEqual(1, progress[1001].items_written)
+        self.assertEqual(0, progress[1002].items_written)
+        self.assertEqual(40, self.count(1001))
+        self.assertEqual(15, self.count(1002))
+        conn = sqlite3.connect(self.db_filename)
+        item_data = json.loads(conn.execute('SELECT item_data FROM podio_app_1001 '
+                                            'WHERE item_id = ?', (item_id,)).fetchone()[0])
+        conn.close()
+        values = {f['external_id']: f['values'] for f in item_data['fields']}
+        self.assertEqual('Changed', values['text-0'][0]['value'])
+
+    def test_incremental_sync_reports_deleted_items(self):
+        progress, checkpoint = self.sync()
+        last_synced = {app_id: checkpoint.app(app_id)['last_synced'] for app_id in (1001, 1002)}
+        item_id = next(iter(self.server.items[1001]))
+        storage = CachedItemStorage(sqlite3.connect(self.db_filename), self.podio)
+        storage.delete_item(1001, item_id)
+        storage.backend.close()
+
+        progress, checkpoint = self.sync(since=last_synced)
+        self.assertEqual([item_id], progress[1001].deleted_item_ids)
+        self.assertEqual([], progress[1002].deleted_item_ids)
+        self.assertEqual(39, self.count(1001))
+
+    def test_incremental_sync_removes_items_deleted_in_podio(self):
+        progress, checkpoint = self.sync()
+        last_synced = {app_id: checkpoint.app(app_id)['last_synced'] for app_id in (1001, 1002)}
+        item_id = next(iter(self.server.items[1001]))
+        self.podio.delete('https://api.podio.com/item/%d' % item_id)
+
+        progress, checkpoint = self.sync(since=last_synced)
+        self.assertEqual([item_id], progress[1001].deleted_item_ids)
+        self.assertEqual(39, self.count(1001))
+        self.assertEqual(15, self.count(1002))
+        # One page of items edited since the last run, one page of item IDs
+        self.assertEqual(2, progress[1001].api_calls)
+
+    def test_old_tombstones_are_purged(self):
+        progress, checkpoint = self.sync()
+        last_synced = {app_id: checkpoint.app(app_id)['last_synced'] for app_id in (1001, 1002)}
+        storage = CachedItemStorage(sqlite3.connect(self.db_filename), self.podio)
+        for item_id in (1, 2):
+            storage.remove_item_from_db(1001, item_id)
+        storage.conn.execute("UPDATE cached_tombstones SET deleted_on = '2020-01-01 00:00:00' "
+                             "WHERE item_id = 1")
+        storage.commit()
+        storage.backend.close()
+
+        self.sync(since=last_synced)
+        storage = CachedItemStorage(sqlite3.connect(self.db_filename), self.podio)
+        self.assertEqual([2], storage.get_tombstones(1001))
+        storage.backend.close()
+
+    def test_tombstone_days(self):
+        self.sync()
+        storage = CachedItemStorage(sqlite3.connect(self.db_filename), self.podio)
+        for item_id in (1, 2):
+            storage.remove_item_from_db(1001, item_id)
+        storage.conn.execute("UPDATE cached_tombstones SET deleted_on = '2020-01-01 00:00:00' "
+                             "WHERE item_id = 1")
+        storage.commit()
+        storage.backend.close()
+        # A full sync purges nothing by itself
+        for days, expected in ((None, [1, 2]), (1, [2])):
+            builder = MultiAppCacheBuilder(self.podio, self.db_filename, limit=10,
+                                           tombstone_days=days)
+            builder.add_app(1001)
+            builder.run()
+            storage = CachedItemStorage(sqlite3.connect(self.db_filename), self.podio)
+            self.assertEqual(expected, storage.get_tombstones(1001))
+            storage.backend.close()
+
+    def test_resume_from_offset(self):
+        checkpoint = SyncCheckpoint(self.checkpoint_filename)
+        checkpoint.start_run('full')
+        builder = MultiAppCacheBuilder(self.podio, self.db_filename, limit=10,
+                                       checkpoint=checkpoint)
+        builder.add_app(1001, offset=30)
+        progress = builder.run()
+        self.assertEqual(10, progress[1001].items_written)
+        self.assertEqual(1, progress[1001].api_calls)
+        self.assertEqual(40, SyncCheckpoint(self.checkpoint_filename).app(1001)['offset'])
@@ -0,0 +1,24 @@
+import datetime
+from unittest import TestCase
+
+from tetrapod.items import fetch_field
+from tetrapod.synthetic import make_app_config, make_items
+
+
+class TestSyntheticItems(TestCase):
+
+    def setUp(self):
+        self.app_config = make_app_config(7, num_fields=16)
+        self.items = list(make_items(self.app_config, 5, seed=1))
+
+    def test_items_are_reproducible(self):
+        self.assertEqual(self.items, list(make_items(self.app_config, 5, seed=1)))
+        self.assertEqual(7000001, self.items[0]['item_id'])
+
+    def test_fields_can_be_fetched(self):
+        item_data = self.items[2]
+        self.assertEqual('Item 3', fetch_field('text-0', item_data))
+        self.assertIsInstance(fetch_field('number-1__float', item_data), float)
+        self.assertIsInstance(fetch_field('date-2__start_dt', item_data), datetime.datetime)
+        self.assertEqual(5, len(fetch_field('category-3__choices', item_data)))
+        self.assertEqual(16, len(item_data['fields']))
@@ -0,0 +1,79 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from tetrapod.fakeserver import FakePodioServer
+from tetrapod.helpers import iterate_resource
+from tetrapod.tokenpool import AppCredentials, AppTokenPool, app_id_from_url
+
+
+class TestAppTokenPool(TestCase):
+
+    def setUp(self):
+        self.server = FakePodioServer(rate_limit=30).start()
+        self.server.add_app(1001, num_items=100, num_fields=2)
+        self.server.add_app(1002, num_items=10, num_fields=2)
+        patcher = patch.dict('os.environ', {'OAUTHLIB_INSECURE_TRANSPORT': '1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.token_calls = []
+        self.pool = AppTokenPool([
+            AppCredentials('client-a', 'secret', 1001, 'token-1'),
+            AppCredentials('client-b', 'secret', 1001, 'token-1'),
+            AppCredentials('client-a', 'secret', 1002, 'token-2'),
+        ], token_func=self.fetch_token, api_url=self.server.url)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def fetch_token(self, client_id, client_secret, app_id, app_token):
+        self.token_calls.append((client_id, app_id))
+        return {
+            'access_token': 'access-%s-%d-%d' % (client_id, app_id, len(self.token_calls)),
+            'refresh_token': 'refresh',
+            'token_type': 'bearer',
+            'expires_in': 28800,
+        }
+
+    def requests_per_token(self):
+        return [entry['requests'] for entry in self.pool.summary()]
+
+    def test_app_id_from_url(self):
+        self.assertEqual(1001, app_id_from_url('https://api.podio.com/item/app/1001/filter/'))
+        self.assertEqual(1001, app_id_from_url('https://api.podio.com/app/1001/field/5'))
+        self.assertEqual(1001, app_id_from_url('https://api.podio.com/app/1001'))
+        self.assertIsNone(app_id_from_url('https://api.podio.com/item/1001000005'))
+        self.assertIsNone(app_id_from_url('https://api.podio.com/app/space/7/'))
+
+    def test_spreads_requests_over_the_tokens_of_an_app(self):
+        for _ in range(20):
+            self.assertEqual(200, self.pool.get('https://api.podio.com/app/1001/').status_code)
+        self.assertEqual([10, 10, 0], self.requests_per_token())
+        # One authentication per token that was used
+        self.assertEqual([('client-a', 1001), ('client-b', 1001)], sorted(self.token_calls))
+
+    def test_for_app(self):
+        item_id = next(iter(self.server.items[1002]))
+        resp = self.pool.for_app(1002).get('https://api.podio.com/item/%d' % item_id)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([0, 0, 1], self.requests_per_token())
+        with self.assertRaises(KeyError):
+            self.pool.for_app(9999)
+
+    def test_more_than_one_rate_limit(self):
+        # 100 items in pages of 2 are 50 requests, more than the 30 that one token allows
+        items = iterate_resource(self.pool, 'https://api.podio.com/item/app/1001/filter/', limit=2)
+        self.assertEqual(100, len(items))
+        self.assertEqual(50, sum(self.requests_per_token()))
+
+    def test_rate_limit_switches_token(self):
+        for _ in range(60):
+            self.assertEqual(200, self.pool.get('https://api.podio.com/app/1001/').status_code)
+        # Both tokens are used up now
+        self.assertEqual(420, self.pool.get('https://api.podio.com/app/1001/').status_code)
+        self.assertEqual(200, self.pool.get('https://api.podio.com/app/1002/').status_code)
+
+    def test_token_renewed_before_expiry(self):
+        self.pool.get('https://api.podio.com/app/1002/')
+        self.pool.entries[2].expires_at = 0
+        self.pool.get('https://api.podio.com/app/1002/')
+        self.assertEqual([('client-a', 1002), ('client-a', 1002)], self.token_calls)
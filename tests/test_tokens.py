@@ -0,0 +1,181 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from tetrapod.fakeserver import FakePodioServer
+from tetrapod.podio_auth import make_client
+from tetrapod.session import create_podio_session
+from tetrapod.tokens import TokenManager, get_token_manager
+
+
+def make_token(access_token, expires_in):
+    return {
+        'client_id': 'fake',
+        'access_token': access_token,
+        'refresh_token': 'refresh',
+        'token_type': 'bearer',
+        'expires_at': int(time.time() + expires_in),
+    }
+
+
+class TestTokenManager(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'credentials.json')
+        self.refresh_calls = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, token):
+        with open(self.path, mode='w') as fh:
+            json.dump(token, fh)
+
+    def refresh(self, token):
+        self.refresh_calls.append(token['access_token'])
+        time.sleep(0.05)
+        return dict(token, access_token='new-%d' % len(self.refresh_calls), expires_in=3600)
+
+    def test_fresh_token_is_not_refreshed(self):
+        self.write(make_token('old', 3600))
+        manager = TokenManager(self.path, refresh_func=self.refresh)
+        self.assertEqual('old', manager.get_token()['access_token'])
+        self.assertEqual([], self.refresh_calls)
+
+    def test_single_flight(self):
+        self.write(make_token('old', 60))
+        manager = TokenManager(self.path, refresh_func=self.refresh)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(manager.get_token()))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['old'], self.refresh_calls)
+        self.assertEqual({'new-1'}, {token['access_token'] for token in results})
+        with open(self.path) as fh:
+            stored = json.load(fh)
+        self.assertEqual('new-1', stored['access_token'])
+        self.assertGreater(stored['expires_at'], time.time() + 3000)
+
+    def test_refresh_of_other_process_is_reused(self):
+        self.write(make_token('old', 60))
+        first = TokenManager(self.path, refresh_func=self.refresh)
+        second = TokenManager(self.path, refresh_func=self.refresh)
+        second._token = make_token('old', 60)
+        self.assertEqual('new-1', first.get_token()['access_token'])
+        # second still has the old token in memory, but finds the new one in the file
+        self.assertEqual('new-1', second.get_token()['access_token'])
+        self.assertEqual(1, len(self.refresh_calls))
+
+    def test_failed_refresh_keeps_valid_token(self):
+        calls = []
+
+        def failing_refresh(token):
+            calls.append(token['access_token'])
+            raise ConnectionError('Podio is down')
+
+        self.write(make_token('old', 60))
+        manager = TokenManager(self.path, refresh_func=failing_refresh, retry_delay=3600)
+        self.assertEqual('old', manager.get_token()['access_token'])
+        self.assertEqual('old', manager.get_token()['access_token'])
+        # No new attempt before retry_delay has passed
+        self.assertEqual(1, len(calls))
+
+        manager = TokenManager(self.path, refresh_func=failing_refresh, retry_delay=0)
+        self.assertEqual('old', manager.get_token()['access_token'])
+        self.assertEqual('old', manager.get_token()['access_token'])
+        self.assertEqual(3, len(calls))
+
+        # Once the token has expired, the error goes through
+        self.write(make_token('old', -10))
+        manager = TokenManager(self.path, refresh_func=failing_refresh)
+        with self.assertRaises(ConnectionError):
+            manager.get_token()
+
+    def test_shared_manager(self):
+        self.assertIs(get_token_manager(self.path), get_token_manager(self.path))
+
+
+class TestSessionWithTokenManager(TestCase):
+
+    def setUp(self):
+        self.server = FakePodioServer().start()
+        patcher = patch.dict('os.environ', {'OAUTHLIB_INSECURE_TRANSPORT': '1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'credentials.json')
+        with open(self.path, mode='w') as fh:
+            json.dump(make_token('old', 3600), fh)
+
+    def tearDown(self):
+        self.server.stop()
+        self.tmpdir.cleanup()
+
+    def test_sessions_use_the_refreshed_token(self):
+        manager = TokenManager(self.path, refresh_func=lambda token: dict(
+            token, access_token='new', expires_in=3600))
+        sessions = []
+        for _ in range(2):
+            with patch('tetrapod.podio_auth.TETRAPOD_API_URL', self.server.url):
+                sessions.append(make_client('fake', manager.get_token(), check=False,
+                                            token_manager=manager))
+        seen = []
+        for podio in sessions:
+            podio.post_request_hooks.append(
+                lambda method, url, resp, elapsed: seen.append(resp.request.headers['Authorization']))
+
+        sessions[0].get('https://api.podio.com/user/profile/')
+        # The token is about to expire: the next request of any session refreshes it, once.
+        manager.refresh_margin = 7200
+        sessions[1].get('https://api.podio.com/user/profile/')
+        manager.refresh_margin = 300
+        sessions[0].get('https://api.podio.com/user/profile/')
+        self.assertEqual(['Bearer old', 'Bearer new', 'Bearer new'], seen)
+        self.assertEqual(1, manager.refreshes)
+
+
+class TestClientSecret(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        patcher = patch.dict('os.environ')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name in ('TETRAPOD_ACCESS_TOKEN', 'TETRAPOD_CLIENT_SECRET'):
+            os.environ.pop(name, None)
+        post = patch('requests.post')
+        self.post = post.start()
+        self.addCleanup(post.stop)
+        self.post.return_value = MagicMock(content=None)
+        self.post.return_value.json.return_value = {'access_token': 'new', 'expires_in': 3600}
+
+    def refresh(self, name, token):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, mode='w') as fh:
+            json.dump(token, fh)
+        podio = create_podio_session(credentials_file=path, check=False)
+        self.assertEqual('new', podio.token_manager.get_token()['access_token'])
+        with open(path, mode='r') as fh:
+            return self.post.call_args[1]['data'], json.load(fh)
+
+    def test_secret_from_environment(self):
+        os.environ['TETRAPOD_CLIENT_SECRET'] = 'env-secret'
+        data, _ = self.refresh('env.json', make_token('old', 60))
+        self.assertEqual('refresh_token', data['grant_type'])
+        self.assertEqual('env-secret', data['client_secret'])
+
+    def test_secret_from_credentials_file(self):
+        data, stored = self.refresh('file.json', dict(make_token('old', 60),
+                                                      client_secret='file-secret'))
+        self.assertEqual('file-secret', data['client_secret'])
+        # Kept for the next refresh
+        self.assertEqual('file-secret', stored['client_secret'])
@@ -0,0 +1,83 @@
+import threading
+import urllib.error
+import urllib.request
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from tetrapod.webhooks import ItemChangeQueue, WebhookReceiver
+
+
+class TestItemChangeQueue(TestCase):
+
+    def test_debounce(self):
+        queue = ItemChangeQueue(debounce=5.0, max_delay=60.0)
+        queue.add(1, 100, 'item.create', now=0.0)
+        queue.add(1, 100, 'item.update', now=3.0)
+        queue.add(1, 101, 'item.delete', now=4.0)
+        self.assertEqual({}, queue.pop_due(now=8.0))
+        self.assertEqual({1: ({100}, {101})}, queue.pop_due(now=9.0))
+        self.assertEqual(0, len(queue))
+
+    def test_max_delay(self):
+        queue = ItemChangeQueue(debounce=5.0, max_delay=10.0)
+        for now in range(0, 12, 2):
+            queue.add(1, 100 + now, 'item.update', now=float(now))
+        due = queue.pop_due(now=10.0)
+        self.assertEqual(6, len(due[1][0]))
+
+    def test_requeue_with_backoff(self):
+        queue = ItemChangeQueue(debounce=0.0, retry_delay=10.0)
+        queue.add(1, 101, 'item.update', now=0.0)
+        self.assertEqual(10.0, queue.requeue(1, {100}, {102}, now=0.0))
+        self.assertEqual({}, queue.pop_due(now=9.0))
+        # The newer event of item 101 wins over the requeued ones
+        self.assertEqual({1: ({100, 101}, {102})}, queue.pop_due(now=10.0))
+        self.assertEqual(20.0, queue.requeue(1, {100}, set(), now=10.0))
+        queue.succeeded(1)
+        self.assertEqual(10.0, queue.requeue(1, {100}, set(), now=10.0))
+
+
+class TestWebhookReceiver(TestCase):
+
+    def setUp(self):
+        self.storage = MagicMock()
+        self.receiver = WebhookReceiver(self.storage, host='localhost', port=0, debounce=0,
+                                        retry_delay=0)
+
+    def tearDown(self):
+        self.receiver.server.server_close()
+
+    def test_flush_refreshes_changed_items(self):
+        self.receiver.handle_hook(1, {'type': 'item.update', 'item_id': '100'})
+        self.receiver.handle_hook(1, {'type': 'item.update', 'item_id': '100'})
+        self.receiver.handle_hook(1, {'type': 'item.delete', 'item_id': '101'})
+        self.receiver.flush()
+        self.storage.refresh_items.assert_called_once_with(1, [100])
+        self.storage.remove_item_from_db.assert_called_once_with(1, 101, commit=False)
+
+    def test_verify_hook(self):
+        self.receiver.handle_hook(1, {'type': 'hook.verify', 'hook_id': '7', 'code': 'abc'})
+        self.storage.podio.post.assert_called_once_with(
+            'https://api.podio.com/hook/7/verify/validate', json={'code': 'abc'})
+
+    def test_failed_refresh_is_retried(self):
+        self.storage.refresh_items.side_effect = [Exception('504 Gateway Timeout'), 1]
+        self.receiver.handle_hook(1, {'type': 'item.update', 'item_id': '100'})
+        self.assertEqual(0, self.receiver.flush())
+        self.storage.rollback.assert_called_once()
+        self.assertEqual(1, len(self.receiver.queue))
+        self.assertEqual(1, self.receiver.flush())
+        self.assertEqual(0, len(self.receiver.queue))
+
+    def test_hook_without_item_id(self):
+        self.receiver.handle_hook(1, {'type': 'item.update'})
+        self.assertEqual(0, len(self.receiver.queue))
+
+        request = urllib.request.Request('http://localhost:%d/hook/1/' % self.receiver.port,
+                                         data=b'type=item.update&item_id=abc')
+        thread = threading.Thread(target=self.receiver.server.handle_request)
+        thread.start()
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            urllib.request.urlopen(request, timeout=5)
+        thread.join()
+        self.assertEqual(400, cm.exception.code)
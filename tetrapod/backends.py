@@ -0,0 +1,616 @@
+"""
+Storage backends for the CachedItemStorage in tetrapod.cache.
+
+A backend only stores rows: the item_id, the serialized item_data, the
+__natural_key and the extra fields of every cached item, plus the cache
+configuration of every app and the tombstones of deleted items. Everything that
+has to do with Podio (and with the Item objects) stays in CachedItemStorage.
+
+Two backends are included:
+ - SQLiteBackend: The default. Uses a sqlite3 connection or a SQLiteConnectionPool.
+ - MemoryBackend: Keeps everything in dicts in the current process, optionally as
+   a LRU cache with a maximum number of items. Good for tests and hot paths.
+
+Other backends (e.g. for a key-value store or PostgreSQL) need to subclass
+CacheBackend and implement all of its methods.
+"""
+import datetime
+import logging
+import sqlite3
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Union
+
+log = logging.getLogger(__name__)
+
+
+def app_table_name(app_id: int) -> str:
+    return 'podio_app_%d' % int(app_id)
+
+
+def utcnow_str(days_ago: float = 0) -> str:
+    """The current UTC time (minus days_ago) in Podio's '%Y-%m-%d %H:%M:%S' format."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return (now - datetime.timedelta(days=days_ago)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class CacheBackend(object):
+    """
+    The interface that every storage backend of CachedItemStorage implements.
+
+    Rows are dicts with the keys 'item_id', 'item_data' (the serialized item),
+    '__natural_key' (only if the app has a natural key) and one key per extra field.
+    All values except item_id are strings.
+
+    Write methods do not commit. Use transaction() to group writes and commit them,
+    or call commit() explicitly.
+    """
+
+    def setup_app(self, app_id: int, extra_fields: list, natural_key_list: list = None):
+        """Prepare the storage for one app and persist its cache configuration."""
+        raise NotImplementedError()
+
+    def finish_app(self, app_id: int, natural_key_list: list = None):
+        """Called after all the items of an app have been put (e.g. to build indexes)."""
+        raise NotImplementedError()
+
+    def clear_app(self, app_id: int):
+        """Remove all the items of an app, e.g. before downloading all of them again."""
+        raise NotImplementedError()
+
+    def load_cache_configs(self) -> dict:
+        """
+        Return the persisted cache configuration as
+        {table_name: {'extra_fields': [...], 'natural_key': [...] or None}}
+        """
+        raise NotImplementedError()
+
+    def put_item(self, app_id: int, row: dict):
+        """
+        Insert or replace the row of one item. Raises sqlite3.IntegrityError if
+        another item of the app already has the same __natural_key; the stored rows
+        are left unchanged then.
+        """
+        raise NotImplementedError()
+
+    def get_item_data(self, app_id: int, item_id: int) -> Union[str, None]:
+        """Return the serialized item_data of one item or None."""
+        raise NotImplementedError()
+
+    def get_item_ids(self, app_id: int) -> list:
+        """Return the item_ids of all the cached items of an app."""
+        raise NotImplementedError()
+
+    def find_item_data(self, app_id: int, select_for: dict, item_ids: list = None) -> list:
+        """
+        Return the serialized item_data of all items whose columns are equal to the
+        values in select_for, optionally restricted to a list of item_ids.
+        """
+        raise NotImplementedError()
+
+    def remove_item(self, app_id: int, item_id: int, tombstone: bool = True):
+        """Remove the row of one item and optionally record a tombstone."""
+        raise NotImplementedError()
+
+    def get_tombstones(self, app_id: int, since: str = None) -> list:
+        raise NotImplementedError()
+
+    def find_tombstones(self, app_id: int, item_ids: list) -> dict:
+        """Return {item_id: deleted_on} for those of the item_ids that have a tombstone."""
+        raise NotImplementedError()
+
+    def purge_tombstones(self, app_id: int, before: str = None):
+        raise NotImplementedError()
+
+    @contextmanager
+    def transaction(self):
+        """Group several writes, commit them at the end (or roll them back on errors)."""
+        raise NotImplementedError()
+
+    def commit(self):
+        raise NotImplementedError()
+
+    def rollback(self):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class SQLiteConnectionPool(object):
+    """
+    Connections to one SQLite database file that can be shared between threads.
+
+    Every thread gets its own read connection. All writes go through one dedicated
+    writer connection, guarded by write_lock. The database is switched to WAL mode,
+    so that readers do not have to wait for a running write transaction.
+
+    With read_only=True the database is opened with a 'file:...?mode=ro' URI and
+    no writer connection exists at all.
+
+    Example:
+    >>> pool = SQLiteConnectionPool('database.sqlite3')
+    >>> storage = CachedItemStorage(pool, podio)
+    """
+
+    def __init__(self, database: str, read_only: bool = False, timeout: float = 30.0):
+        self.database = database
+        self.read_only = read_only
+        self.timeout = timeout
+        self.write_lock = threading.RLock()
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        self._writer = None
+        if not read_only:
+            self._writer = sqlite3.connect(database, timeout=timeout, check_same_thread=False)
+            self._writer.execute('PRAGMA journal_mode=WAL')
+
+    def reader(self) -> sqlite3.Connection:
+        """Return the read connection of the current thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # check_same_thread=False only so that close() can be called from any
+            # thread, every read connection is only ever used by its own thread.
+            if self.read_only:
+                conn = sqlite3.connect(f'file:{self.database}?mode=ro', uri=True,
+                                       timeout=self.timeout, check_same_thread=False)
+            else:
+                conn = sqlite3.connect(self.database, timeout=self.timeout,
+                                       check_same_thread=False)
+                conn.execute('PRAGMA query_only = ON')
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    def writer(self) -> sqlite3.Connection:
+        if self._writer is None:
+            raise sqlite3.OperationalError(f'Database {self.database} is opened read-only.')
+        return self._writer
+
+    def close(self):
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers = []
+        self._local = threading.local()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    Stores every app in its own table 'podio_app_<app_id>'. The cache configuration
+    lives in the table 'cached_apps' and the tombstones in 'cached_tombstones'.
+
+    :param conn: A sqlite3 connection or a SQLiteConnectionPool.
+    """
+
+    def __init__(self, conn: Union[sqlite3.Connection, SQLiteConnectionPool]):
+        if isinstance(conn, SQLiteConnectionPool):
+            self.pool = conn
+            self.conn = None if conn.read_only else conn.writer()
+            self.write_lock = conn.write_lock
+        else:
+            self.pool = None
+            self.conn = conn
+            self.write_lock = threading.RLock()
+        self._depth = 0
+
+    def _reader(self) -> sqlite3.Connection:
+        if self.pool is not None:
+            return self.pool.reader()
+        return self.conn
+
+    @contextmanager
+    def _writer(self):
+        with self.write_lock:
+            if self.pool is None:
+                yield self.conn
+            else:
+                yield self.pool.writer()
+
+    @contextmanager
+    def transaction(self):
+        with self._writer() as conn:
+            self._depth += 1
+            try:
+                yield conn
+            except Exception:
+                self._depth -= 1
+                if self._depth == 0:
+                    conn.rollback()
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                conn.commit()
+
+    def commit(self):
+        with self._writer() as conn:
+            conn.commit()
+
+    def rollback(self):
+        with self._writer() as conn:
+            conn.rollback()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+        else:
+            self.conn.close()
+
+    def setup_app(self, app_id: int, extra_fields: list, natural_key_list: list = None):
+        table_name = app_table_name(app_id)
+        with self._writer() as conn:
+            # Store the list of extra field names and the list of field names needed to
+            # construct the __natural_key. This can later be used to run queries and update
+            # entries.
+            setup_sql = """CREATE TABLE IF NOT EXISTS cached_apps (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                table_name TEXT UNIQUE NOT NULL,
+                extra_fields TEXT NULL,
+                natural_key TEXT NULL)"""
+            conn.execute(setup_sql)
+
+            if natural_key_list:
+                new_cache_sql = """
+                INSERT INTO cached_apps(table_name, extra_fields, natural_key)
+                    VALUES(?, ?, ?)
+                """
+                try:
+                    conn.execute(
+                        new_cache_sql,
+                        (table_name, f"{','.join(extra_fields)}", f"{','.join(natural_key_list)}")
+                    )
+                except sqlite3.IntegrityError:
+                    log.warning("Integrity Error in table_name = %s" % table_name)
+                    update_cache_sql = """
+                    UPDATE cached_apps SET
+                           extra_fields = ? ,
+                           natural_key = ?
+                    WHERE table_name = ?
+                    """
+                    conn.execute(
+                        update_cache_sql,
+                        (f"{','.join(extra_fields)}", f"{','.join(natural_key_list)}", table_name)
+                    )
+            else:
+                new_cache_sql = """
+                INSERT INTO cached_apps(table_name, extra_fields)
+                    VALUES(?, ?)
+                """
+                try:
+                    conn.execute(
+                        new_cache_sql,
+                        (table_name, f"{','.join(extra_fields)}")
+                    )
+                except sqlite3.IntegrityError:
+                    update_cache_sql = """
+                    UPDATE cached_apps SET
+                           extra_fields = ?
+                    WHERE table_name = ?
+                    """
+                    conn.execute(
+                        update_cache_sql,
+                        (f"{','.join(extra_fields)}", table_name)
+                    )
+
+            # Build the actual table for the items.
+            cols = [
+                'item_id INT PRIMARY KEY NOT NULL',
+                'item_data TEXT NULL',
+            ]
+            if natural_key_list:
+                cols.append('__natural_key TEXT NULL')
+
+            for field_name in extra_fields:
+                cols.append('"%s" TEXT NULL' % field_name)
+            cols_sql = ", ".join(cols)
+            create_sql = f'CREATE TABLE IF NOT EXISTS {table_name} ({cols_sql});'
+            log.debug(create_sql)
+            conn.execute(create_sql)
+            conn.commit()
+
+    def finish_app(self, app_id: int, natural_key_list: list = None):
+        table_name = app_table_name(app_id)
+        with self._writer() as conn:
+            conn.commit()
+            if natural_key_list:
+                idx_sql = \
+                    f'CREATE UNIQUE INDEX IF NOT EXISTS idx_{app_id:d}_natural_key ' \
+                    f'ON "{table_name}" (__natural_key)'
+                log.debug(idx_sql)
+                try:
+                    conn.execute(idx_sql)
+                except sqlite3.IntegrityError as err:
+                    log.debug(err)
+                    raise err
+
+    def clear_app(self, app_id: int):
+        with self._writer() as conn:
+            conn.execute(f'DELETE FROM {app_table_name(app_id)}')
+
+    def load_cache_configs(self) -> dict:
+        cache_configs = {}
+        sql = """SELECT table_name, extra_fields, natural_key FROM cached_apps"""
+        cursor = self._reader().cursor()
+        cursor.execute(sql)
+        all = cursor.fetchall()
+        for table_name, extra_fields, natural_key in all:
+            cache_configs[table_name] = {
+                'extra_fields': extra_fields.split(',') if extra_fields else [],
+                'natural_key': natural_key.split(',') if natural_key else None,
+            }
+        cursor.close()
+        return cache_configs
+
+    def put_item(self, app_id: int, row: dict):
+        table_name = app_table_name(app_id)
+        column_names = ', '.join(f'"{col}"' for col in row.keys())
+        # create enough questionsmarks for the SQL
+        placeholders = ', '.join('?' * len(row))
+        sql = f'INSERT OR REPLACE INTO {table_name} ({column_names}) VALUES ({placeholders})'
+        with self._writer() as conn:
+            conn.execute(sql, list(row.values()))
+
+    def get_item_data(self, app_id: int, item_id: int) -> Union[str, None]:
+        table_name = app_table_name(app_id)
+        cursor = self._reader().cursor()
+        sql = "SELECT item_data FROM %s WHERE item_id = ?" % table_name
+        cursor.execute(sql, (item_id, ))
+        found = cursor.fetchone()
+        cursor.close()
+        return found[0] if found else None
+
+    def get_item_ids(self, app_id: int) -> list:
+        cursor = self._reader().cursor()
+        try:
+            cursor.execute(f'SELECT item_id FROM {app_table_name(app_id)}')
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def find_item_data(self, app_id: int, select_for: dict, item_ids: list = None) -> list:
+        table_name = app_table_name(app_id)
+        where_clauses = []
+        for key in select_for.keys():
+            where_clauses.append(f'"{key}" = ?')
+        if item_ids is not None:
+            item_ids_str = ", ".join([f'{el:d}' for el in item_ids])
+            where_clauses.append(f'item_id IN ({item_ids_str})')
+        where_clauses_str = ' AND '.join(where_clauses)
+        sql = f"""SELECT item_data FROM {table_name} WHERE {where_clauses_str}"""
+        cursor = self._reader().cursor()
+        cursor.execute(sql, list(select_for.values()))
+        found = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        return found
+
+    def remove_item(self, app_id: int, item_id: int, tombstone: bool = True):
+        table_name = app_table_name(app_id)
+        with self._writer() as conn:
+            conn.execute(f'DELETE FROM {table_name} WHERE item_id = ?', (item_id, ))
+            if tombstone:
+                self._create_tombstone_table(conn)
+                conn.execute(
+                    'INSERT OR REPLACE INTO cached_tombstones(item_id, app_id, deleted_on) '
+                    'VALUES(?, ?, ?)',
+                    (item_id, app_id, utcnow_str())
+                )
+
+    def get_tombstones(self, app_id: int, since: str = None) -> list:
+        sql = 'SELECT item_id FROM cached_tombstones WHERE app_id = ?'
+        params = [app_id]
+        if since is not None:
+            sql += ' AND deleted_on >= ?'
+            params.append(since)
+        cursor = self._reader().cursor()
+        try:
+            cursor.execute(sql + ' ORDER BY item_id', params)
+            return [row[0] for row in cursor.fetchall()]
+        except sqlite3.OperationalError:
+            # No item has ever been deleted, the table does not exist, yet.
+            return []
+        finally:
+            cursor.close()
+
+    def find_tombstones(self, app_id: int, item_ids: list) -> dict:
+        if not item_ids:
+            return {}
+        item_ids_str = ', '.join([f'{int(el):d}' for el in item_ids])
+        sql = f'SELECT item_id, deleted_on FROM cached_tombstones ' \
+              f'WHERE app_id = ? AND item_id IN ({item_ids_str})'
+        cursor = self._reader().cursor()
+        try:
+            cursor.execute(sql, (app_id, ))
+            return dict(cursor.fetchall())
+        except sqlite3.OperationalError:
+            return {}
+        finally:
+            cursor.close()
+
+    def purge_tombstones(self, app_id: int, before: str = None):
+        sql = 'DELETE FROM cached_tombstones WHERE app_id = ?'
+        params = [app_id]
+        if before is not None:
+            sql += ' AND deleted_on < ?'
+            params.append(before)
+        with self._writer() as conn:
+            self._create_tombstone_table(conn)
+            conn.execute(sql, params)
+
+    def _create_tombstone_table(self, conn):
+        conn.execute("""CREATE TABLE IF NOT EXISTS cached_tombstones (
+            item_id INT PRIMARY KEY NOT NULL,
+            app_id INT NOT NULL,
+            deleted_on TEXT NOT NULL)""")
+
+
+def _column_equals(stored, wanted) -> bool:
+    """
+    Compare a stored value with a value to look for like SQLite does: numbers (the
+    INT item_id) by their value, the TEXT columns as text. NULL never matches.
+    """
+    if stored is None or wanted is None:
+        return False
+    if isinstance(stored, (int, float)):
+        try:
+            return stored == float(wanted)
+        except (TypeError, ValueError):
+            return False
+    return stored == '%s' % wanted
+
+
+class MemoryBackend(CacheBackend):
+    """
+    Keeps all rows in dicts of the current process. Nothing is persisted.
+
+    :param max_items: If set, the backend works as a LRU cache: When more than
+        max_items items are stored, the least recently used ones are dropped and
+        subsequent lookups will not find them anymore.
+
+    Writes can not be rolled back. Unlike SQLiteBackend, which only creates the
+    unique index of the natural key in finish_app(), this backend enforces unique
+    natural keys on every put_item(), also while an app is being downloaded.
+    """
+
+    def __init__(self, max_items: int = None):
+        self.max_items = max_items
+        self._lock = threading.RLock()
+        self._cache_configs = {}
+        # (app_id, item_id) -> row, in least recently used order.
+        self._rows = OrderedDict()
+        # app_id -> {natural_key: item_id}
+        self._natural_keys = {}
+        # app_id -> {item_id: deleted_on}
+        self._tombstones = {}
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            yield self
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        log.warning('MemoryBackend can not roll back writes.')
+
+    def setup_app(self, app_id: int, extra_fields: list, natural_key_list: list = None):
+        with self._lock:
+            self._cache_configs[app_table_name(app_id)] = {
+                'extra_fields': list(extra_fields),
+                'natural_key': list(natural_key_list) if natural_key_list else None,
+            }
+            self._natural_keys.setdefault(app_id, {})
+
+    def finish_app(self, app_id: int, natural_key_list: list = None):
+        pass
+
+    def clear_app(self, app_id: int):
+        with self._lock:
+            for key in [key for key in self._rows if key[0] == app_id]:
+                del self._rows[key]
+            self._natural_keys[app_id] = {}
+
+    def load_cache_configs(self) -> dict:
+        with self._lock:
+            return {name: dict(config) for name, config in self._cache_configs.items()}
+
+    def put_item(self, app_id: int, row: dict):
+        key = (app_id, row['item_id'])
+        with self._lock:
+            natural_key = row.get('__natural_key')
+            natural_keys = self._natural_keys.setdefault(app_id, {})
+            # Check before anything is changed, a failed put leaves the old row in place.
+            if natural_key is not None \
+                    and natural_keys.get(natural_key, row['item_id']) != row['item_id']:
+                raise sqlite3.IntegrityError(
+                    'Natural key %r is not unique in app %d' % (natural_key, app_id))
+            old_row = self._rows.pop(key, None)
+            if old_row is not None:
+                self._forget_natural_key(app_id, old_row)
+            if natural_key is not None:
+                natural_keys[natural_key] = row['item_id']
+            self._rows[key] = dict(row)
+            if self.max_items is not None:
+                while len(self._rows) > self.max_items:
+                    (evicted_app_id, _), evicted = self._rows.popitem(last=False)
+                    self._forget_natural_key(evicted_app_id, evicted)
+
+    def _forget_natural_key(self, app_id, row):
+        natural_key = row.get('__natural_key')
+        if natural_key is not None:
+            self._natural_keys.get(app_id, {}).pop(natural_key, None)
+
+    def _get_row(self, app_id, item_id):
+        key = (app_id, item_id)
+        row = self._rows.get(key)
+        if row is not None:
+            self._rows.move_to_end(key)
+        return row
+
+    def get_item_data(self, app_id: int, item_id: int) -> Union[str, None]:
+        with self._lock:
+            row = self._get_row(app_id, item_id)
+            return row['item_data'] if row is not None else None
+
+    def get_item_ids(self, app_id: int) -> list:
+        with self._lock:
+            return [item_id for (row_app_id, item_id) in self._rows if row_app_id == app_id]
+
+    def find_item_data(self, app_id: int, select_for: dict, item_ids: list = None) -> list:
+        with self._lock:
+            # Fast path: The natural key is indexed.
+            if list(select_for.keys()) == ['__natural_key']:
+                natural_key = '%s' % select_for['__natural_key']
+                item_id = self._natural_keys.get(app_id, {}).get(natural_key)
+                if item_id is None or (item_ids is not None and item_id not in item_ids):
+                    return []
+                return [self._get_row(app_id, item_id)['item_data']]
+
+            if item_ids is not None:
+                candidates = [self._rows.get((app_id, item_id)) for item_id in item_ids]
+            else:
+                candidates = [row for (row_app_id, _), row in self._rows.items()
+                              if row_app_id == app_id]
+            found = []
+            for row in candidates:
+                if row is None:
+                    continue
+                if all(_column_equals(row.get(key), val) for key, val in select_for.items()):
+                    found.append(row)
+            for row in found:
+                self._rows.move_to_end((app_id, row['item_id']))
+            return [row['item_data'] for row in found]
+
+    def remove_item(self, app_id: int, item_id: int, tombstone: bool = True):
+        with self._lock:
+            row = self._rows.pop((app_id, item_id), None)
+            if row is not None:
+                self._forget_natural_key(app_id, row)
+            if tombstone:
+                self._tombstones.setdefault(app_id, {})[item_id] = utcnow_str()
+
+    def get_tombstones(self, app_id: int, since: str = None) -> list:
+        with self._lock:
+            tombstones = self._tombstones.get(app_id, {})
+            return sorted(item_id for item_id, deleted_on in tombstones.items()
+                          if since is None or deleted_on >= since)
+
+    def find_tombstones(self, app_id: int, item_ids: list) -> dict:
+        with self._lock:
+            tombstones = self._tombstones.get(app_id, {})
+            return {item_id: tombstones[item_id] for item_id in item_ids
+                    if item_id in tombstones}
+
+    def purge_tombstones(self, app_id: int, before: str = None):
+        with self._lock:
+            tombstones = self._tombstones.get(app_id, {})
+            for item_id in list(tombstones.keys()):
+                if before is None or tombstones[item_id] < before:
+                    del tombstones[item_id]
@@ -7,10 +7,20 @@ try:
 except ImportError:
     from collections import Iterable # noqa
 
-from typing import Union
-from tetrapod.helpers import iterate_resource
+from typing import TYPE_CHECKING, Union
+from tetrapod import jsoncodec
+from tetrapod.backends import (
+    CacheBackend,
+    MemoryBackend,
+    SQLiteBackend,
+    SQLiteConnectionPool,
+    app_table_name,
+)
+from tetrapod.helpers import app_filter, fetch_items_by_id, iterate_resource_pages
 from tetrapod.items import Item
-from tetrapod.podio_auth import PodioOAuth2Session
+
+if TYPE_CHECKING:
+    from tetrapod.podio_auth import PodioOAuth2Session
 
 log = logging.getLogger(__name__)
 
@@ -50,6 +60,13 @@ class CachedItemStorage(object):
     """
     One object to connect a PodioOauth2Session and a SQLite3 database together.
 
+    Instead of a single sqlite3 connection, a SQLiteConnectionPool can be passed in.
+    The storage can then be shared between threads: lookups run in parallel on the
+    per-thread read connections, writes are serialized on the writer connection.
+
+    Any other CacheBackend (see tetrapod.backends) can be used as well, e.g. the
+    MemoryBackend that keeps everything in the current process.
+
     Example:
     >>> import sqlite3
     >>> from tetrapod.session import create_podio_session
@@ -59,74 +76,62 @@ class CachedItemStorage(object):
     >>> factory.get_item(12929939)
     """
 
-    def __init__(self, conn:sqlite3.Connection, podio:PodioOAuth2Session):
+    def __init__(self, conn:Union[sqlite3.Connection, SQLiteConnectionPool, CacheBackend],
+                 podio:'PodioOAuth2Session'):
         self.app_configs = {}
-        self.conn = conn
+        if isinstance(conn, CacheBackend):
+            self.backend = conn
+        else:
+            self.backend = SQLiteBackend(conn)
+        # The sqlite3 (writer) connection, only for backwards compatibility.
+        self.conn = getattr(self.backend, 'conn', None)
         self.podio = podio
         self.cache_configs = {}
 
-    def _find_item_sql(self, sql, parameters):
-        clean_params = []
-        for param in parameters:
+    def commit(self):
+        self.backend.commit()
+
+    def rollback(self):
+        self.backend.rollback()
+
+    def _find_one(self, app_id: int, select_for: dict, item_ids: list = None):
+        clean_select_for = {}
+        for key, param in select_for.items():
             if isinstance(param, list):
-                clean_params.append(repr(param))
+                clean_select_for[key] = repr(param)
             else:
-                clean_params.append(param)
-        cursor = self.conn.cursor()
-        cursor.execute(sql, clean_params)
-        found = cursor.fetchall()
-        cursor.close()
+                clean_select_for[key] = param
+        found = self.backend.find_item_data(app_id, clean_select_for, item_ids)
 
         if len(found) == 0:
-            raise CachedItemNotFound(f'Item not found, SQL query: {sql}, '
-                                     f'parameters: {repr(clean_params)}')
+            raise CachedItemNotFound(f'Item not found in app {app_id}, '
+                                     f'parameters: {repr(clean_select_for)}')
         elif len(found) == 1:
-            item = CachedItem(self, json.loads(found[0][0]))
+            item = CachedItem(self, jsoncodec.loads(found[0]))
             return item
         elif len(found) >= 2:
             raise Exception('Natural keys must be unique: %s' % repr(found))
 
     def get_item(self, app_id: int, item_id: int):
-        table_name = f'podio_app_{app_id}'
-
-        cursor = self.conn.cursor()
-        sql = "SELECT item_data FROM %s WHERE item_id = ?" % table_name
-        vars = (item_id,)
-        cursor.execute(sql, vars)
-        item_data = json.loads(cursor.fetchone()[0])
-        cursor.close()
+        found = self.backend.get_item_data(app_id, item_id)
+        if found is None:
+            raise CachedItemNotFound(f'Item {item_id} not found in app {app_id}')
+        item_data = jsoncodec.loads(found)
 
         item = CachedItem(item_storage=self, item_data=item_data)
         return item
 
     def get_item_by_join_ids(self, podio_app_id: int, select_for: dict):
-        table_name = f'podio_app_{podio_app_id:d}'
-        where_clauses = []
-        for key, val in select_for.items():
-            where_clauses.append(f'"{key}" = ?')
-        where_clauses_str = ' AND '.join(where_clauses)
-        sql = f"""SELECT item_data FROM {table_name} WHERE {where_clauses_str}"""
-        return self._find_item_sql(sql, list(select_for.values()))
+        return self._find_one(podio_app_id, select_for)
 
     def get_referenced_item(self, podio_app_id: int, item_ids: Iterable, select_for: dict):
         """
         Find one item but only return it, if it is
         """
-        table_name = f'podio_app_{podio_app_id:d}'
-        where_clauses = []
-        for key, val in select_for.items():
-            where_clauses.append(f'"{key}" = ?')
-
         # Now restrict even further by the list of allowed item_ids
         if len(item_ids) == 0:
             raise CachedItemNotFound()
-        item_ids_str = ", ".join([f'{el:d}' for el in item_ids])
-        where_clauses.append(f'item_id IN ({(item_ids_str)})')
-
-        # Put it together
-        where_clauses_str = ' AND '.join(where_clauses)
-        sql = f"""SELECT item_data FROM {table_name} WHERE {where_clauses_str}"""
-        return self._find_item_sql(sql, list(select_for.values()))
+        return self._find_one(podio_app_id, select_for, list(item_ids))
 
     def get_item_by_natural_key(self, podio_app_id: int, key: Union[Iterable, str]) -> CachedItem:
         if isinstance(key, Iterable):
@@ -134,14 +139,11 @@ class CachedItemStorage(object):
         else:
             key_val = key
 
-        table_name = f'podio_app_{podio_app_id:d}'
-        sql = f"""SELECT item_data FROM {table_name} WHERE __natural_key = ?"""
-
-        return self._find_item_sql(sql, (key_val, ))
+        return self._find_one(podio_app_id, {'__natural_key': key_val})
 
     def update_item(self, item: CachedItem):
         app_id = item.get_item_data()['app']['app_id']
-        table_name = f'podio_app_{app_id}'
+        table_name = app_table_name(app_id)
         extra_fields = self.cache_configs[table_name]['extra_fields']
         natural_key_list = self.cache_configs[table_name]['natural_key']
 
@@ -149,18 +151,145 @@ class CachedItemStorage(object):
                                       extra_fields, natural_key_list)
 
     def create_item(self, app_id: int, item_values: dict):
-        table_name = f'podio_app_{app_id}'
+        table_name = app_table_name(app_id)
         extra_fields = self.cache_configs[table_name]['extra_fields']
         natural_key_list = self.cache_configs[table_name]['natural_key']
         resp = self.podio.post(f'https://api.podio.com/item/app/{app_id:d}/',
                                json={'fields': item_values})
         resp.raise_for_status()
-        item_data = resp.json()
+        item_data = jsoncodec.response_json(resp)
         self.insert_item_data_into_db(app_id, item_data, extra_fields, natural_key_list)
         return CachedItem(self, item_data)
 
-    def delete_item(self, app_id: int, item_id: int):
-        raise NotImplementedError()
+    def delete_item(self, app_id: int, item_id: int, silent: bool = False):
+        """
+        Delete one item in Podio, remove it from the cache and leave a tombstone.
+        """
+        resp = self.podio.delete(f'https://api.podio.com/item/{item_id:d}',
+                                 params={'silent': 'true' if silent else 'false'})
+        # Already gone is as good as deleted.
+        if resp.status_code not in (404, 410):
+            resp.raise_for_status()
+        self.remove_item_from_db(app_id, item_id)
+
+    def delete_items(self, app_id: int, item_ids: Iterable, silent: bool = False,
+                     chunk_size: int = 100):
+        """
+        Delete many items of one app, using Podio's bulk delete endpoint in chunks
+        of chunk_size items. If the bulk endpoint is not available the items are
+        deleted one by one.
+
+        See https://developers.podio.com/doc/items/bulk-delete-items-19406111
+        """
+        item_ids = [int(item_id) for item_id in item_ids]
+        for start in range(0, len(item_ids), chunk_size):
+            chunk = item_ids[start:start + chunk_size]
+            resp = self.podio.post(f'https://api.podio.com/item/app/{app_id:d}/delete',
+                                   params={'silent': 'true' if silent else 'false'},
+                                   json={'item_ids': chunk})
+            if resp.status_code in (404, 405, 501):
+                log.warning('Bulk delete not available (HTTP %d), deleting %d items one by one.'
+                            % (resp.status_code, len(chunk)))
+                for item_id in chunk:
+                    self.delete_item(app_id, item_id, silent=silent)
+                continue
+            resp.raise_for_status()
+            with self.backend.transaction():
+                for item_id in chunk:
+                    self.remove_item_from_db(app_id, item_id, commit=False)
+
+    def remove_item_from_db(self, app_id: int, item_id: int, commit=True, tombstone=True):
+        """
+        Drop the cached copy of one item, e.g. after it was deleted in Podio. Unless
+        tombstone is False, the deletion is recorded as a tombstone, see get_tombstones().
+        """
+        if commit:
+            with self.backend.transaction():
+                self.backend.remove_item(app_id, item_id, tombstone=tombstone)
+        else:
+            self.backend.remove_item(app_id, item_id, tombstone=tombstone)
+
+    def remove_missing_items(self, app_id: int, live_item_ids: Iterable, commit=True) -> list:
+        """
+        Remove the cached items of an app that are not among live_item_ids, e.g. the
+        IDs of all the items that still exist in Podio. Items deleted in Podio by
+        someone else are not found otherwise. Every removal leaves a tombstone.
+        Returns the IDs of the removed items.
+        """
+        live_item_ids = set(int(item_id) for item_id in live_item_ids)
+        gone = sorted(item_id for item_id in self.backend.get_item_ids(app_id)
+                      if item_id not in live_item_ids)
+        if commit:
+            with self.backend.transaction():
+                for item_id in gone:
+                    self.backend.remove_item(app_id, item_id)
+        else:
+            for item_id in gone:
+                self.backend.remove_item(app_id, item_id)
+        return gone
+
+    def get_tombstones(self, app_id: int, since: str = None) -> list:
+        """
+        Return the IDs of the items of an app that have been deleted through this
+        cache (optionally only those deleted since the UTC timestamp 'since' in
+        Podio's '%Y-%m-%d %H:%M:%S' format).
+        """
+        return self.backend.get_tombstones(app_id, since)
+
+    def drop_tombstoned(self, app_id: int, items: list) -> list:
+        """
+        Return the items (item_data dicts) without those that were deleted through
+        this cache. A page that was downloaded before the deletion would otherwise
+        bring them back. Items that were edited after the deletion (e.g. restored
+        from the recycle bin) are kept.
+        """
+        tombstones = self.backend.find_tombstones(
+            app_id, [item_data['item_id'] for item_data in items])
+        if not tombstones:
+            return items
+        kept = []
+        for item_data in items:
+            deleted_on = tombstones.get(item_data['item_id'])
+            if deleted_on is None or (item_data.get('last_edit_on') or '') > deleted_on:
+                kept.append(item_data)
+            else:
+                log.debug('Skipping item %d of app %d, it has been deleted.'
+                          % (item_data['item_id'], app_id))
+        return kept
+
+    def purge_tombstones(self, app_id: int, before: str = None):
+        """Forget the tombstones of an app, e.g. after a full re-sync."""
+        with self.backend.transaction():
+            self.backend.purge_tombstones(app_id, before)
+
+    def refresh_items(self, app_id: int, item_ids: Iterable, chunk_size: int = 250,
+                      workers: int = 4):
+        """
+        Download the current state of some items and write it into the cache.
+        Items that do not exist in Podio anymore are removed from the cache.
+        The items are fetched chunk_size at a time, see fetch_items_by_id().
+        Returns the number of refreshed items.
+        """
+        item_ids = [int(item_id) for item_id in item_ids]
+        table_name = app_table_name(app_id)
+        try:
+            cache_config = self.cache_configs[table_name]
+        except KeyError:
+            log.warning('App %s is not cached, ignoring refresh of %d items.'
+                        % (app_id, len(item_ids)))
+            return 0
+        # Download everything first, so that the writer is not blocked by the network.
+        found = fetch_items_by_id(self.podio, app_id, item_ids, chunk_size, workers)
+        found_ids = set(item_data['item_id'] for item_data in found)
+        gone = [item_id for item_id in item_ids if item_id not in found_ids]
+
+        with self.backend.transaction():
+            for item_id in gone:
+                self.remove_item_from_db(app_id, item_id, commit=False)
+            for item_data in found:
+                self.insert_item_data_into_db(app_id, item_data, cache_config['extra_fields'],
+                                              cache_config['natural_key'], commit=False)
+        return len(found)
 
     def get_app_config(self, podio_app_id: int):
         try:
@@ -168,29 +297,42 @@ class CachedItemStorage(object):
         except KeyError:
             resp = self.podio.get(f'https://api.podio.com/app/{podio_app_id:d}/')
             resp.raise_for_status()
-            config = resp.json()
+            config = jsoncodec.response_json(resp)
             self.app_configs[int(podio_app_id)] = config
             return config
 
     def init_cache(self):
-        sql = """SELECT table_name, extra_fields, natural_key FROM cached_apps"""
-        cursor = self.conn.cursor()
-        cursor.execute(sql)
-        all = cursor.fetchall()
-        for table_name, extra_fields, natural_key in all:
-            self.cache_configs[table_name] = {
-                'extra_fields': extra_fields.split(',') if extra_fields else [],
-                'natural_key': natural_key.split(',') if natural_key else None,
-            }
-        cursor.close()
+        self.cache_configs.update(self.backend.load_cache_configs())
         log.debug('Cache initialized with cache configuration:')
         log.debug(json.dumps(self.cache_configs, indent=2))
 
-    def cache_app(self, podio_app_id: int, extra_fields: list, natural_key: Union[Iterable, str]):
+    def cache_app(self, podio_app_id: int, extra_fields: list, natural_key: Union[Iterable, str],
+                  view_id: int = None, filters: dict = None, fields: str = None,
+                  adaptive=False):
+        """
+        Create a local copy of all the items in one app, or only of the items in a view
+        or that match the filters (see tetrapod.helpers.app_filter()). With fields, the
+        items must still contain the extra_fields and the natural key.
+        With adaptive, the page size adapts to the app (see iterate_resource_pages()).
         """
-        Create a local copy of all the items in one app.
+        natural_key_list = self.setup_app_cache(podio_app_id, extra_fields, natural_key)
+        url, params = app_filter(podio_app_id, view_id=view_id, filters=filters, fields=fields)
+        # Page by page, so that only one page of items is held in memory
+        pages = iterate_resource_pages(self.podio, url, limit=300, params=params,
+                                       adaptive=adaptive)
+        with self.backend.transaction():
+            for page in pages:
+                for item_data in self.drop_tombstoned(podio_app_id, page):
+                    self.insert_item_data_into_db(podio_app_id, item_data, extra_fields,
+                                                  natural_key_list, commit=False)
+        self.finish_app_cache(podio_app_id, natural_key_list)
+
+    def setup_app_cache(self, podio_app_id: int, extra_fields: list,
+                        natural_key: Union[Iterable, str]):
+        """
+        Create the tables needed to cache one app and register its cache configuration.
+        Returns the list of field names that make up the natural key (or None).
         """
-        table_name = 'podio_app_%d' % podio_app_id
         natural_key_list = None
         if natural_key:
             if not isinstance(natural_key, list):
@@ -201,93 +343,28 @@ class CachedItemStorage(object):
         # Store the list of extra field names and the list of field names needed to
         # construct the __natural_key. This can later be used to run queries and update
         # entries.
-        setup_sql = """CREATE TABLE IF NOT EXISTS cached_apps (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            table_name TEXT UNIQUE NOT NULL,
-            extra_fields TEXT NULL,
-            natural_key TEXT NULL)"""
-        self.conn.execute(setup_sql)
+        self.backend.setup_app(podio_app_id, extra_fields, natural_key_list)
+        self.cache_configs[app_table_name(podio_app_id)] = {
+            'extra_fields': list(extra_fields),
+            'natural_key': natural_key_list,
+        }
+        return natural_key_list
+
+    def clear_app_cache(self, podio_app_id: int):
+        """
+        Remove all the cached items of an app. The tombstones are kept, see
+        purge_tombstones().
+        """
+        self.backend.clear_app(podio_app_id)
 
-        if natural_key:
-            new_cache_sql = """
-            INSERT INTO cached_apps(table_name, extra_fields, natural_key)
-                VALUES(?, ?, ?)
-            """
-            try:
-                self.conn.execute(
-                	new_cache_sql,
-                	(table_name, f"{','.join(extra_fields)}", f"{','.join(natural_key_list)}")
-            	)
-            except sqlite3.IntegrityError:
-                log.warning("Integrity Error in table_name = %s" % table_name)
-                update_cache_sql = """
-                UPDATE cached_apps SET 
-                       extra_fields = ? ,
-                       natural_key = ?
-                WHERE table_name = ?
-                """
-                self.conn.execute(
-                	update_cache_sql,
-                	(f"{','.join(extra_fields)}", f"{','.join(natural_key_list)}", table_name)
-            	)
-	    
-        else:
-            new_cache_sql = """
-            INSERT INTO cached_apps(table_name, extra_fields)
-                VALUES(?, ?)
-            """
-            try:
-                self.conn.execute(
-                    new_cache_sql,
-                    (table_name, f"{','.join(extra_fields)}")
-                )
-            except sqlite3.IntegrityError:
-                update_cache_sql = """
-                UPDATE cached_apps SET 
-                       extra_fields = ?
-                WHERE table_name = ?
-                """
-                self.conn.execute(
-                	update_cache_sql,
-                	(f"{','.join(extra_fields)}", table_name)
-            	)
-
-        # Build the actual table for the items.
-        cols = [
-            'item_id INT PRIMARY KEY NOT NULL',
-            'item_data TEXT NULL',
-        ]
-        if natural_key_list:
-            cols.append('__natural_key TEXT NULL')
-
-        for field_name in extra_fields:
-            cols.append('"%s" TEXT NULL' % field_name)
-        cols_sql = ", ".join(cols)
-        create_sql = f'CREATE TABLE IF NOT EXISTS {table_name} ({cols_sql});'
-        log.debug(create_sql)
-        self.conn.execute(create_sql)
-        self.conn.commit()
-        url = "https://api.podio.com/item/app/%d/filter/" % podio_app_id
-        all_items = iterate_resource(self.podio, url, limit=300)
-        for item_data in all_items:
-            self.insert_item_data_into_db(podio_app_id, item_data, extra_fields, natural_key_list)
-
-        self.conn.commit()
-        if natural_key_list:
-            idx_sql = \
-                f'CREATE UNIQUE INDEX IF NOT EXISTS idx_{podio_app_id:d}_natural_key ' \
-                f'ON "{table_name}" (__natural_key)'
-            log.debug(idx_sql)
-            try:
-                self.conn.execute(idx_sql)
-            except sqlite3.IntegrityError as err:
-                log.debug(err)
-                raise err
+    def finish_app_cache(self, podio_app_id: int, natural_key_list: list = None):
+        """
+        Commit the inserted items and create the natural key index of a cached app.
+        """
+        self.backend.finish_app(podio_app_id, natural_key_list)
 
     def insert_item_data_into_db(self, app_id, item_data,
-                                 extra_fields=None, natural_key_list=None):
-        table_name = f'podio_app_{app_id}'
-
+                                 extra_fields=None, natural_key_list=None, commit=True):
         # Make sure that the Podio app ID is always included.
         try:
             item_data['app']['app_id']
@@ -297,8 +374,10 @@ class CachedItemStorage(object):
         item = Item(item_data)
 
         # item-ID and json-dump of the whole item go first.
-        columns = ['item_id', 'item_data']
-        values = [item_data['item_id'], json.dumps(item_data)]
+        row = {
+            'item_id': item_data['item_id'],
+            'item_data': jsoncodec.dumps(item_data),
+        }
 
         # determine the value of the natural key
         if natural_key_list:
@@ -312,8 +391,7 @@ class CachedItemStorage(object):
                     nat_key_val.append(repr(related))
                 else:
                     nat_key_val.append('%s' % item[key])
-            values.append('-'.join(nat_key_val))
-            columns.append('__natural_key')
+            row['__natural_key'] = '-'.join(nat_key_val)
 
         if extra_fields:
             for field_name in extra_fields:
@@ -322,18 +400,13 @@ class CachedItemStorage(object):
                 # How do we deal with complex values?
                 if isinstance(item[field_name], dict):
                     related = [item[key]['item_id']]
-                    values.append(repr(related))
-                    columns.append(f'"{field_name}"')
+                    row[field_name] = repr(related)
                 else:
-                    values.append('%s' % item[field_name])
-                    columns.append(f'"{field_name}"')
-
-        # create enough questionsmarks for the SQL
-        column_names = ', '.join(columns)
-        placeholders = ', '.join('?' * len(values))
-        sql = f'INSERT OR REPLACE INTO {table_name} ({column_names}) VALUES ({placeholders})'
-        self.conn.execute(
-            sql,
-            values
-        )
-        self.conn.commit()
+                    row[field_name] = '%s' % item[field_name]
+
+        # Bulk inserts (see cache_app()) commit once at the end instead of once per item.
+        if commit:
+            with self.backend.transaction():
+                self.backend.put_item(app_id, row)
+        else:
+            self.backend.put_item(app_id, row)
@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 '''
 This module contains the command line interface for the 'tpod' command.
+
+Heavy modules (requests, oauthlib, the sync, deploy and export machinery) are only
+imported inside the commands that need them, so that 'tpod --help' starts fast.
 '''
 import click
 import configparser
 import json
 import os
+import sys
 
 from pathlib import Path
 
-from tetrapod import podio_auth
 from tetrapod.session import create_podio_session
 
 
@@ -22,6 +25,8 @@ def cli():
 @click.option('--client-id', default=None, help='The Podio client ID')
 @click.option('--client-secret', default=None, help='The Podio client secret')
 def init(client_id, client_secret):
+    from tetrapod import podio_auth
+
     # client secret is probably not needed
     if client_id is None: # or client_secret is None:
         # and a 'client secret'.\n" \
@@ -33,6 +38,9 @@ def init(client_id, client_secret):
 
     try:
         token = podio_auth.authorize(client_id, client_secret)
+        if client_secret:
+            # Needed to refresh the token later on
+            token['client_secret'] = client_secret
         podio_auth.save_token(token)
         click.secho('Token saved. Ready to add apps.')
 
@@ -86,11 +94,16 @@ def add_app(app_id, field):
     print(space['url_label'])
     path = Path( os.path.join(space['url_label'], app['url_label']) )
     path.mkdir(parents=True, exist_ok=True)
+    # Add the app to the project, if there is one already.
+    project_filename = '{}.tpodproject'.format(space['url_label'])
     config = configparser.ConfigParser()
-    config['project'] = {
-        'name': space['url_label'],
-        'apps': app['url_label']
-    }
+    config.read(project_filename)
+    if not config.has_section('project'):
+        config['project'] = {'name': space['url_label'], 'apps': ''}
+    app_names = [a.strip() for a in config['project']['apps'].split(',') if a.strip()]
+    if app['url_label'] not in app_names:
+        app_names.append(app['url_label'])
+    config['project']['apps'] = ', '.join(app_names)
     for one_field in app['fields']:
         if one_field['external_id'] == field:
             script_filename = os.path.join(path, '{}.js'.format(field))
@@ -101,9 +114,16 @@ def add_app(app_id, field):
             with open(json_filename, mode='w+') as fh:
                 settings = json.dumps(one_field, indent=2)
                 fh.write(settings)
-            config['{}.{}'.format(space['url_label'], app['url_label'])] = {
+            app_section = '{}.{}'.format(space['url_label'], app['url_label'])
+            field_names = []
+            if config.has_section(app_section):
+                field_names = [f.strip() for f in config[app_section]['fields'].split(',')
+                               if f.strip()]
+            if field not in field_names:
+                field_names.append(field)
+            config[app_section] = {
                 'app_id': app['app_id'],
-                'fields': field,
+                'fields': ', '.join(field_names),
             }
             config['{}.{}.{}'.format(space['url_label'], app['url_label'], field)] = {
                 'field_id': one_field['field_id'],
@@ -115,50 +135,44 @@ def add_app(app_id, field):
         else:
             print(' \_', one_field['external_id'])
 
-    with open('{}.tpodproject'.format(space['url_label']), 'w+') as configfile:
+    with open(project_filename, 'w+') as configfile:
         config.write(configfile)
 
 
-@click.command(help='Update the calculation fields')
+@click.command(help='Update the calculation fields of all apps of the project')
 @click.argument('space_name')
-def deploy(space_name):
+@click.option('--workers', type=int, default=4, show_default=True,
+              help='Number of fields pushed at the same time')
+@click.option('--force', is_flag=True, help='Also push the fields that did not change')
+def deploy(space_name, workers, force):
+    from tetrapod.deploy import (DEPLOYED, FAILED, UNCHANGED, DeployState, deploy_fields,
+                                 project_fields)
+
     config = configparser.ConfigParser()
-    config.read('{}.tpodproject'.format(space_name))
-    space_name = config['project']['name']
-    # TODO: for-loop
-    app_name = config['project']['apps']
-    app_section = '{}.{}'.format(space_name, app_name)
-    app_id = config[app_section]['app_id']
-    fields_raw = config[app_section]['fields']
-    fields_all = [f.strip() for f in fields_raw.split(',')]
-    for fields in fields_all:
-        field_section = '{}.{}.{}'.format(space_name, app_name, fields)
-        field_id = config[field_section]['field_id']
-        with open(config[field_section]['script'], mode='r') as script_file:
-            field_script = script_file.read()
-        with open(config[field_section]['settings'], mode='r') as settings_file:
-            field_settings = json.load(settings_file)
-
-        # Now we got everything to makte the request:
-        payload = {
-            "label": field_settings['label'],
-            "description": field_settings['config']['description'],
-            "delta": field_settings['config']['delta'],
-            "settings": field_settings['config']['settings'],
-            "mapping": field_settings['config']['mapping'],
-            "required": field_settings['config']['required'],
-            "hidden_create_view_edit": field_settings['config']['hidden_create_view_edit'],
-        }
-        payload['settings']['script'] = field_script
-        print(json.dumps(payload, indent=2))
-
-        # Upload the payload
-        podio = create_podio_session()
-        url = 'https://api.podio.com/app/{:d}/field/{:d}'.format(int(app_id), int(field_id))
-        print(url)
-        resp = podio.put(url, data=json.dumps(payload))
-        print(resp.status_code)
-        print(json.dumps(resp.json(), indent=2))
+    if not config.read('{}.tpodproject'.format(space_name)):
+        raise click.UsageError('Could not read {}.tpodproject'.format(space_name))
+    fields = project_fields(config)
+    state = DeployState('{}.tpoddeploy.json'.format(space_name))
+
+    def report(result):
+        if result.status == FAILED:
+            click.secho('{} FAILED {}: {}'.format(result.field.section, result.status_code or '',
+                                                  result.error), fg='red')
+        elif result.status == UNCHANGED:
+            click.echo('{} unchanged'.format(result.field.section))
+        else:
+            click.echo('{} deployed ({})'.format(result.field.section, result.status_code))
+
+    podio = create_podio_session(robust=True)
+    results = deploy_fields(podio, fields, state, workers=max(1, workers), force=force,
+                            progress_callback=report)
+    counts = {}
+    for result in results:
+        counts[result.status] = counts.get(result.status, 0) + 1
+    click.echo('{} deployed, {} unchanged, {} failed'.format(
+        counts.get(DEPLOYED, 0), counts.get(UNCHANGED, 0), counts.get(FAILED, 0)))
+    if counts.get(FAILED):
+        raise SystemExit(1)
 
 
 @click.command(help="Get user info")
@@ -171,6 +185,160 @@ def user(user_id):
     print(resp.status_code)
     print(json.dumps(resp.json(), indent=2))
 
+def read_sync_config(config_file):
+    """
+    Read the config file of 'tpod sync', e.g.
+
+        [sync]
+        database = podio.sqlite3
+        workers = 4
+        limit = 300
+
+        [app:12345678]
+        extra_fields = title, status
+        natural_key = title
+
+        [app:23456789]
+
+    limit can also be 'auto', to adapt the page size to every app. With
+    tombstone_days = 30 the tombstones of deleted items are kept for 30 days,
+    otherwise only until the next incremental sync of their app.
+    Returns the [sync] settings and a list of (app_id, extra_fields, natural_key).
+    """
+    config = configparser.ConfigParser()
+    if not config.read(config_file):
+        raise click.UsageError('Could not read the config file %s' % config_file)
+    settings = dict(config['sync']) if config.has_section('sync') else {}
+    apps = []
+    for section in config.sections():
+        if not section.startswith('app:'):
+            continue
+        app_id = int(section.split(':', 1)[1])
+        extra_fields = [f.strip() for f in config[section].get('extra_fields', '').split(',')
+                        if f.strip()]
+        natural_key = [f.strip() for f in config[section].get('natural_key', '').split(',')
+                       if f.strip()]
+        apps.append((app_id, extra_fields, natural_key or None))
+    if not apps:
+        raise click.UsageError('No [app:<app_id>] sections in %s' % config_file)
+    return settings, apps
+
+
+@click.command(help='Mirror the apps listed in CONFIG_FILE into a local SQLite cache')
+@click.argument('config_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--mode', type=click.Choice(['incremental', 'full']), default='incremental',
+              show_default=True,
+              help='incremental only downloads the items edited since the last sync of an app')
+@click.option('--workers', type=int, default=None, help='Number of apps downloaded at the same time')
+@click.option('--database', default=None, help='Overrides the database of the config file')
+@click.option('--checkpoint', 'checkpoint_file', default=None,
+              help='Checkpoint file, defaults to <database>.checkpoint.json')
+@click.option('--restart', is_flag=True, help='Start over instead of resuming an interrupted run')
+def sync(config_file, mode, workers, database, checkpoint_file, restart):
+    from tetrapod.sync import MultiAppCacheBuilder, SyncCheckpoint
+
+    settings, apps = read_sync_config(config_file)
+    database = database or settings.get('database', 'podio.sqlite3')
+    workers = workers or int(settings.get('workers', 4))
+    limit = settings.get('limit', '300').strip()
+    adaptive = limit == 'auto'
+    limit = 300 if adaptive else int(limit)
+    tombstone_days = settings.get('tombstone_days')
+    tombstone_days = float(tombstone_days) if tombstone_days else None
+    checkpoint = SyncCheckpoint(checkpoint_file or database + '.checkpoint.json')
+
+    resume = checkpoint.run_unfinished and not restart
+    if resume:
+        mode = checkpoint.run['mode']
+        click.echo('Resuming the %s sync started at %s' % (mode, checkpoint.run['id']))
+    else:
+        checkpoint.start_run(mode)
+    run_id = checkpoint.run['id']
+
+    podio = create_podio_session(robust=True)
+    builder = MultiAppCacheBuilder(podio, database, workers=workers, limit=limit,
+                                   adaptive=adaptive, checkpoint=checkpoint,
+                                   tombstone_days=tombstone_days)
+    for app_id, extra_fields, natural_key in apps:
+        state = checkpoint.app(app_id)
+        if resume and state.get('run') == run_id:
+            if state.get('status') == 'done':
+                click.echo('App %d: already done in this run' % app_id)
+                continue
+            offset = state.get('offset', 0)
+            builder.add_app(app_id, extra_fields, natural_key, since=state.get('since'),
+                            offset=offset, clear=bool(state.get('clear')) and offset == 0)
+            continue
+        since = state.get('last_synced') if mode == 'incremental' else None
+        builder.add_app(app_id, extra_fields, natural_key, since=since, clear=since is None)
+
+    progress = builder.run()
+    for app_id, app_progress in progress.items():
+        line = 'App %d: %d items, %d API calls, %.1f s, %.1f items/s' % (
+            app_id, app_progress.items_written, app_progress.api_calls,
+            app_progress.elapsed, app_progress.items_per_second)
+        if app_progress.deleted_item_ids:
+            line += ', %d deleted' % len(app_progress.deleted_item_ids)
+        if app_progress.error:
+            click.secho(line + ', FAILED: %r' % app_progress.error, fg='red')
+        else:
+            click.echo(line)
+    summary = builder.summary()
+    click.echo('Total: %d apps, %d items, %d API calls in %.1f s (%.1f items/s)' % (
+        summary['apps'], summary['items'], summary['api_calls'], summary['elapsed'],
+        summary['items_per_second']))
+    if summary['apps_failed']:
+        click.secho('%d apps failed, run again to resume.' % summary['apps_failed'], fg='red')
+        raise SystemExit(1)
+    checkpoint.finish_run()
+
+
+@click.command(help='Export all items of the app APP_ID to CSV, JSON Lines or Parquet')
+@click.argument('app_id', type=int)
+@click.option('--output', '-o', default=None,
+              help="Output file, defaults to <app_id>.<format>. '-' writes to stdout.")
+@click.option('--format', 'export_format', type=click.Choice(['csv', 'jsonl', 'parquet']),
+              default=None, help='Defaults to the extension of the output file, or csv')
+@click.option('--field', '-f', 'external_ids', multiple=True,
+              help='External ID of a field to export (repeatable), all fields by default')
+@click.option('--label', '-l', 'labels', multiple=True,
+              help='Label of a field to export (repeatable)')
+@click.option('--database', default=None,
+              help='Export from this local SQLite cache (see tpod sync) instead of from Podio')
+@click.option('--limit', type=int, default=500, show_default=True, help='Items per page')
+@click.option('--workers', type=int, default=4, show_default=True,
+              help='Pages downloaded at the same time')
+@click.option('--view-id', type=int, default=None,
+              help='Only export the items of this view of the app')
+def export(app_id, output, export_format, external_ids, labels, database, limit, workers,
+           view_id):
+    from tetrapod.export import EXTENSIONS, export_app
+
+    if export_format is None:
+        export_format = 'csv'
+        for name, extension in EXTENSIONS.items():
+            if output and output.endswith(extension):
+                export_format = name
+    if output is None:
+        output = '%d%s' % (app_id, EXTENSIONS[export_format])
+    if output == '-':
+        if export_format == 'parquet':
+            raise click.UsageError('Parquet can not be written to stdout.')
+        destination = sys.stdout
+    else:
+        destination = output
+
+    podio = None if database else create_podio_session(robust=True)
+    try:
+        num_items = export_app(podio, app_id, destination, format=export_format,
+                               external_ids=external_ids, labels=labels, limit=limit,
+                               workers=workers, database=database, view_id=view_id)
+    except ValueError as err:
+        raise click.UsageError(str(err))
+    if output != '-':
+        click.echo('Exported %d items to %s' % (num_items, output), err=True)
+
+
 cli.add_command(init)
 cli.add_command(orgs)
 cli.add_command(spaces)
@@ -178,6 +346,8 @@ cli.add_command(apps)
 cli.add_command(add_app)
 cli.add_command(deploy)
 cli.add_command(user)
+cli.add_command(sync)
+cli.add_command(export)
 
 if __name__ == '__main__':
     cli()
@@ -1,5 +1,6 @@
-from tetrapod.helpers import iterate_resource
-from tetrapod.items import Item
+from tetrapod import jsoncodec
+from tetrapod.helpers import app_filter, iterate_resource
+from tetrapod.items import AccessorPlan, PODIO_DATETIME_FORMAT, select_fields
 
 try:
     import pandas as pd
@@ -8,40 +9,36 @@ except ImportError as err:
     raise err
 
 def load_from_app(podio_session, app_id:int, limit:int=300,
-                            external_ids:list=[], labels:list=[]):
+                            external_ids:list=[], labels:list=[], parse_dates:bool=False,
+                            view_id:int=None, filters:dict=None, sort_by=None,
+                            sort_desc:bool=None, fields:str=None):
     """
     Creates a Pandas dataframe from a Podio app.
     :param app_id: The app_id of the Podio app to be loaded.
     :param view_id: The view_id (if any) that the app should be filtered by.
+    :param parse_dates: Convert the columns of date fields to datetime64 in one go.
+    :param filters, sort_by, sort_desc, fields: Passed on to Podio,
+        see tetrapod.helpers.app_filter().
     :return: A datagrame (pandas.df) that contains data from the Podio app.
     """
     app_resp = podio_session.get('https://api.podio.com/app/{}/'.format(app_id))
     app_resp.raise_for_status()
-    app_data = app_resp.json()
+    app_data = jsoncodec.response_json(app_resp)
 
-    url = 'https://api.podio.com/item/app/{}/filter/'.format(app_id)
-    all_item_data = iterate_resource(podio_session, url, limit=limit)
+    url, params = app_filter(app_id, view_id, filters, sort_by, sort_desc, fields)
+    all_item_data = iterate_resource(podio_session, url, limit=limit, params=params)
 
-    if len(external_ids) > 0 and len(labels) > 0:
-        raise ValueError('labels and external_ids cannot be used at the same time.')
+    field_ids, column_labels = select_fields(app_data, external_ids, labels)
+    field_types = {field['external_id']: field['type'] for field in app_data.get('fields', [])}
+    date_columns = [column for field_id, column in zip(field_ids, column_labels)
+                    if field_types.get(field_id) == 'date']
 
-    field_ids = [] # contains external_ids
-    column_labels = [] # contains the label or the external_id
-    for field in app_data.get('fields', []):
-        if field.get('label') in labels:
-            field_ids.append(field['external_id'])
-            column_labels.append(field.get('label'))
-        if field['external_id'] in external_ids:
-            field_ids.append(field['external_id'])
-            column_labels.append(field['external_id'])
+    plan = AccessorPlan(field_ids, app_data)
+    all_rows = [plan.row(item_data) for item_data in all_item_data]
 
-    all_rows = []
-    for item_data in all_item_data:
-        row = []
-        item = Item(item_data)
-        for field_id in field_ids:
-            row.append(item[field_id])
-        all_rows.append(row)
-
-    return pd.DataFrame(all_rows, columns=column_labels)
+    df = pd.DataFrame(all_rows, columns=column_labels)
+    if parse_dates:
+        for column in date_columns:
+            df[column] = pd.to_datetime(df[column], format=PODIO_DATETIME_FORMAT)
+    return df
 
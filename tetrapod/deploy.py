@@ -0,0 +1,176 @@
+"""
+Deploy the calculation fields of a tpod project (the .tpodproject file written by
+'tpod add_app') to Podio.
+
+Every field is pushed with PUT /app/{app_id}/field/{field_id}. A hash of each payload
+is kept in a state file next to the project, so fields whose script and settings
+haven't changed since the last deploy are skipped. The changed fields are pushed
+concurrently over one session.
+
+>>> from tetrapod.deploy import DeployState, deploy_fields, project_fields
+>>> fields = project_fields(config)
+>>> state = DeployState('myspace.tpoddeploy.json')
+>>> results = deploy_fields(podio, fields, state, workers=4)
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+DEPLOYED = 'deployed'
+UNCHANGED = 'unchanged'
+FAILED = 'failed'
+
+
+class ProjectField(object):
+    """One calculation field of a tpod project."""
+
+    def __init__(self, section: str, app_id: int, field_id: int, script_file: str,
+                 settings_file: str):
+        self.section = section
+        self.app_id = app_id
+        self.field_id = field_id
+        self.script_file = script_file
+        self.settings_file = settings_file
+
+    @property
+    def key(self) -> str:
+        return '%d/%d' % (self.app_id, self.field_id)
+
+    @property
+    def url(self) -> str:
+        return 'https://api.podio.com/app/{:d}/field/{:d}'.format(self.app_id, self.field_id)
+
+    def payload(self) -> dict:
+        with open(self.script_file, mode='r') as script_file:
+            field_script = script_file.read()
+        with open(self.settings_file, mode='r') as settings_file:
+            field_settings = json.load(settings_file)
+        payload = {
+            "label": field_settings['label'],
+            "description": field_settings['config']['description'],
+            "delta": field_settings['config']['delta'],
+            "settings": field_settings['config']['settings'],
+            "mapping": field_settings['config']['mapping'],
+            "required": field_settings['config']['required'],
+            "hidden_create_view_edit": field_settings['config']['hidden_create_view_edit'],
+        }
+        payload['settings']['script'] = field_script
+        return payload
+
+
+def payload_hash(payload: dict) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def project_fields(config) -> list:
+    """All the fields of all the apps of a project, from its ConfigParser."""
+    space_name = config['project']['name']
+    app_names = [a.strip() for a in config['project']['apps'].split(',') if a.strip()]
+    fields = []
+    for app_name in app_names:
+        app_section = '{}.{}'.format(space_name, app_name)
+        app_id = int(config[app_section]['app_id'])
+        field_names = [f.strip() for f in config[app_section]['fields'].split(',') if f.strip()]
+        for field_name in field_names:
+            field_section = '{}.{}.{}'.format(space_name, app_name, field_name)
+            fields.append(ProjectField(field_section, app_id,
+                                       int(config[field_section]['field_id']),
+                                       config[field_section]['script'],
+                                       config[field_section]['settings']))
+    return fields
+
+
+class DeployState(object):
+    """
+    The payload hashes of the last successful deploy of every field, kept in a JSON
+    file: {"<app_id>/<field_id>": "<sha256>"}. The file is rewritten atomically.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.hashes = {}
+        if os.path.exists(path):
+            with open(path, mode='r') as fh:
+                self.hashes = json.load(fh)
+
+    def unchanged(self, field: ProjectField, digest: str) -> bool:
+        with self._lock:
+            return self.hashes.get(field.key) == digest
+
+    def deployed(self, field: ProjectField, digest: str):
+        with self._lock:
+            self.hashes[field.key] = digest
+            self._save()
+
+    def _save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tpoddeploy-')
+        with os.fdopen(fd, mode='w') as fh:
+            json.dump(self.hashes, fh, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+class DeployResult(object):
+
+    def __init__(self, field: ProjectField, status: str, status_code: int = None,
+                 error=None):
+        self.field = field
+        self.status = status
+        self.status_code = status_code
+        self.error = error
+
+
+def _deploy_one(podio, field: ProjectField, payload: dict, digest: str,
+                state: DeployState) -> DeployResult:
+    try:
+        resp = podio.put(field.url, json=payload)
+    except Exception as err:
+        log.exception('Deploying %s failed' % field.section)
+        return DeployResult(field, FAILED, error=err)
+    if not 200 <= resp.status_code < 300:
+        log.error('Deploying %s failed: %d %s' % (field.section, resp.status_code, resp.text))
+        return DeployResult(field, FAILED, resp.status_code, error=resp.text)
+    state.deployed(field, digest)
+    return DeployResult(field, DEPLOYED, resp.status_code)
+
+
+def deploy_fields(podio, fields: list, state: DeployState, workers: int = 4,
+                  force: bool = False, progress_callback=None) -> list:
+    """
+    Push the fields whose payload changed since the last deploy, `workers` at a time.
+    :param force: Push all fields, changed or not.
+    :param progress_callback: Called with every DeployResult as soon as it is known.
+    :return: One DeployResult per field, in the order of fields.
+    """
+    results = [None] * len(fields)
+    todo = []
+    for index, field in enumerate(fields):
+        payload = field.payload()
+        digest = payload_hash(payload)
+        if not force and state.unchanged(field, digest):
+            results[index] = DeployResult(field, UNCHANGED)
+            if progress_callback is not None:
+                progress_callback(results[index])
+            continue
+        todo.append((index, field, payload, digest))
+
+    callback_lock = threading.Lock()
+
+    def run(task):
+        index, field, payload, digest = task
+        results[index] = _deploy_one(podio, field, payload, digest, state)
+        if progress_callback is not None:
+            with callback_lock:
+                progress_callback(results[index])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(run, todo))
+    return results
@@ -0,0 +1,298 @@
+"""
+Export a Podio app to CSV, JSON Lines or Parquet without loading it into memory.
+
+The items are streamed page by page, from Podio or from a local SQLite cache (see
+tetrapod.sync), turned into rows with an AccessorPlan and written out right away.
+Only a few pages are held in memory at any time, no matter how big the app is.
+
+>>> from tetrapod.export import export_app
+>>> export_app(podio, 12345678, 'items.csv', external_ids=['title', 'status'])
+>>> export_app(None, 12345678, 'items.parquet', format='parquet', database='cache.sqlite3')
+
+Parquet needs pyarrow ('pip install pyarrow').
+"""
+import csv
+import datetime
+import logging
+import os
+import sqlite3
+
+from tetrapod import jsoncodec
+from tetrapod.backends import app_table_name
+from tetrapod.helpers import app_filter, iterate_resource_pages
+from tetrapod.items import (
+    AccessorPlan,
+    DateMediator,
+    select_fields,
+    split_descriptor_parts,
+    supported_fields,
+)
+
+log = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'jsonl', 'parquet')
+
+EXTENSIONS = {
+    'csv': '.csv',
+    'jsonl': '.jsonl',
+    'parquet': '.parquet',
+}
+
+
+def iter_podio_pages(podio, app_id: int, limit: int = 500, workers: int = 4,
+                     view_id: int = None, filters: dict = None):
+    """Pages of items of an app, with up to `workers` pages downloaded concurrently."""
+    url, params = app_filter(app_id, view_id=view_id, filters=filters)
+    return iterate_resource_pages(podio, url, limit=limit, params=params, prefetch=workers)
+
+
+def iter_cached_pages(conn: sqlite3.Connection, app_id: int, limit: int = 500):
+    """Pages of items from the cache table of an app, ordered by item_id."""
+    cursor = conn.execute('SELECT item_data FROM %s ORDER BY item_id' % app_table_name(app_id))
+    while True:
+        rows = cursor.fetchmany(limit)
+        if not rows:
+            return
+        yield [jsoncodec.loads(row[0]) for row in rows]
+
+
+def cached_app_config(conn: sqlite3.Connection, app_id: int) -> dict:
+    """
+    An app config put together from the fields of the cached items, so that a cached
+    app can be exported without asking Podio. Fields that are empty in all the cached
+    items are missing from it.
+    """
+    rows = conn.execute(
+        "SELECT f.value FROM %s AS t, json_each(t.item_data, '$.fields') AS f "
+        "GROUP BY json_extract(f.value, '$.external_id') "
+        "ORDER BY MIN(json_extract(f.value, '$.field_id'))" % app_table_name(app_id))
+    fields = []
+    for (field_json,) in rows:
+        field = jsoncodec.loads(field_json)
+        field.pop('values', None)
+        fields.append(field)
+    return {'app_id': app_id, 'fields': fields}
+
+
+def _plain_value(value):
+    """Lists, dicts and dates as they can be written into one CSV cell."""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (list, dict)):
+        return jsoncodec.dumps(value, default=str)
+    return str(value)
+
+
+class CsvExportWriter(object):
+
+    def __init__(self, fh, columns: list):
+        self.writer = csv.writer(fh)
+        self.writer.writerow(columns)
+
+    def write_rows(self, rows: list):
+        self.writer.writerows([[_plain_value(value) for value in row] for row in rows])
+
+    def close(self):
+        pass
+
+
+class JsonLinesExportWriter(object):
+
+    def __init__(self, fh, columns: list):
+        self.fh = fh
+        self.columns = columns
+
+    def write_rows(self, rows: list):
+        self.fh.write(''.join(jsoncodec.dumps(dict(zip(self.columns, row)), default=str) + '\n'
+                              for row in rows))
+
+    def close(self):
+        pass
+
+
+def parquet_column_kind(app_config: dict, field_descriptor: str) -> str:
+    """
+    'int', 'float', 'timestamp' or 'string': what the AccessorPlan returns for a field,
+    from its type and field param. Everything else (texts, lists, ...) is a string.
+    """
+    external_id, field_param = split_descriptor_parts(field_descriptor)
+    field = None
+    for one_field in app_config.get('fields', []):
+        if one_field['external_id'] == external_id:
+            field = one_field
+    field_type = field['type'] if field is not None else None
+    if field_type == 'number' and field_param in ('int', 'float'):
+        return field_param
+    if field_type == 'date' and (field_param in DateMediator.START_DT_PARAMS
+                                 or field_param in DateMediator.END_DT_PARAMS):
+        return 'timestamp'
+    if field_type == 'calculation' and field_param == 'datetime' \
+            and field['config']['settings'].get('return_type') == 'date':
+        return 'timestamp'
+    return 'string'
+
+
+def _parquet_value(value, kind: str):
+    """value converted to the kind of its column; None if it doesn't fit."""
+    if value is None:
+        return None
+    try:
+        if kind == 'int':
+            return int(value)
+        if kind == 'float':
+            return float(value)
+        if kind == 'timestamp':
+            return value if isinstance(value, datetime.datetime) else None
+    except (TypeError, ValueError):
+        return None
+    return str(_plain_value(value))
+
+
+class ParquetExportWriter(object):
+    """
+    Writes one row group per page. The column types are fixed before the first page
+    is written, from the field types of the app (see parquet_column_kind()), so that
+    every page has the same schema. Values that don't fit their column become null.
+    Without an app_config every column except item_id is a string.
+    """
+
+    def __init__(self, path, columns: list, app_config: dict = None, field_ids: list = None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as err:
+            print("The module pyarrow is not installed. Run 'pip install pyarrow' or equivalent "
+                  "to install.")
+            raise err
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = path
+        self.columns = columns
+        kinds = ['int'] + [parquet_column_kind(app_config or {}, field_id)
+                           for field_id in (field_ids or columns[1:])]
+        self.kinds = kinds
+        types = {
+            'int': pyarrow.int64(),
+            'float': pyarrow.float64(),
+            'timestamp': pyarrow.timestamp('s'),
+            'string': pyarrow.string(),
+        }
+        self.schema = pyarrow.schema([(name, types[kind]) for name, kind in zip(columns, kinds)])
+        self.writer = None
+
+    def _table(self, rows: list):
+        pa = self.pa
+        columns = list(zip(*rows)) if rows else [()] * len(self.columns)
+        arrays = []
+        for values, kind, field in zip(columns, self.kinds, self.schema):
+            arrays.append(pa.array([_parquet_value(value, kind) for value in values],
+                                   type=field.type))
+        return pa.Table.from_arrays(arrays, schema=self.schema)
+
+    def write_rows(self, rows: list):
+        table = self._table(rows)
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, self.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is None:
+            # No items at all, still write a valid (empty) file.
+            self.writer = self.pq.ParquetWriter(self.path, self.schema)
+        self.writer.close()
+
+
+def export_app(podio, app_id: int, destination, format: str = 'csv', external_ids=(),
+               labels=(), limit: int = 500, workers: int = 4, database: str = None,
+               progress_callback=None, view_id: int = None, filters: dict = None) -> int:
+    """
+    Stream all items of an app into a file.
+    :param podio: The session to download the items with. Not needed with database.
+    :param destination: A path, or a text file object for csv and jsonl (e.g. sys.stdout).
+    :param format: 'csv', 'jsonl' or 'parquet'.
+    :param external_ids: The fields to export, by external_id (with field params,
+        e.g. 'due-date__start_dt').
+    :param labels: The fields to export, by label. Without external_ids and labels,
+        all the fields are exported.
+    :param limit: Page size.
+    :param workers: Number of pages downloaded at the same time.
+    :param database: Read the items from this SQLite cache instead of from Podio.
+    :param progress_callback: Called with the number of items written so far after every page.
+    :param view_id, filters: Only export the items of a view or that match the filters,
+        see tetrapod.helpers.app_filter(). Not possible with database.
+    :return: The number of exported items.
+    """
+    if format not in FORMATS:
+        raise ValueError('Unknown export format %r, use one of %s' % (format, ', '.join(FORMATS)))
+
+    conn = None
+    if database is not None:
+        if view_id is not None or filters:
+            raise ValueError('Views and filters can only be used when exporting from Podio.')
+        conn = sqlite3.connect(database)
+        app_config = cached_app_config(conn, app_id)
+        pages = iter_cached_pages(conn, app_id, limit=limit)
+    else:
+        app_resp = podio.get('https://api.podio.com/app/{}/'.format(app_id))
+        app_resp.raise_for_status()
+        app_config = jsoncodec.response_json(app_resp)
+        pages = iter_podio_pages(podio, app_id, limit=limit, workers=workers,
+                                 view_id=view_id, filters=filters)
+
+    if external_ids or labels:
+        field_ids, column_labels = select_fields(app_config, external_ids, labels)
+        if len(field_ids) == 0:
+            raise ValueError('None of the fields was found in app %d.' % app_id)
+    else:
+        field_ids = supported_fields(app_config)
+        column_labels = list(field_ids)
+    plan = AccessorPlan(field_ids, app_config)
+    columns = ['item_id'] + column_labels
+
+    # A path is written under a temporary name first and only renamed at the end,
+    # so that a failed export doesn't leave a truncated file behind.
+    to_path = not hasattr(destination, 'write')
+    target = '%s.%d.tmp' % (destination, os.getpid()) if to_path else destination
+    fh = None
+    writer = None
+    finished = False
+    try:
+        if format == 'parquet':
+            writer = ParquetExportWriter(target, columns, app_config, field_ids)
+        else:
+            out = destination
+            if to_path:
+                out = fh = open(target, mode='w', newline='', encoding='utf-8')
+            writer_class = CsvExportWriter if format == 'csv' else JsonLinesExportWriter
+            writer = writer_class(out, columns)
+
+        num_items = 0
+        for page in pages:
+            writer.write_rows([[item_data['item_id']] + plan.row(item_data)
+                               for item_data in page])
+            num_items += len(page)
+            if progress_callback is not None:
+                progress_callback(num_items)
+        writer.close()
+        if fh is not None:
+            fh.close()
+        if to_path:
+            os.replace(target, destination)
+        finished = True
+    finally:
+        if not finished:
+            if writer is not None:
+                try:
+                    writer.close()
+                except Exception:
+                    log.exception('Could not close the export writer')
+            if fh is not None:
+                fh.close()
+            if to_path and os.path.exists(target):
+                os.remove(target)
+        if hasattr(pages, 'close'):
+            pages.close()
+        if conn is not None:
+            conn.close()
+    log.info('Exported %d items of app %d' % (num_items, app_id))
+    return num_items
@@ -0,0 +1,558 @@
+"""
+A local stand-in for the Podio API, for load and throughput tests without
+using up the real Podio rate limit.
+
+The apps and items are generated with tetrapod.synthetic. Latency, 5xx errors and
+the X-Rate-Limit-* headers can be configured, so that the retries of a robust
+session, the pagination and concurrent downloads can be tested offline.
+
+Start it from the command line:
+
+    python -m tetrapod.fakeserver --port 8123 --apps 1001,1002 --items 5000 --latency 0.2
+
+and point tetrapod to it:
+
+    export TETRAPOD_API_URL=http://localhost:8123
+    export OAUTHLIB_INSECURE_TRANSPORT=1
+    export TETRAPOD_CLIENT_ID=fake TETRAPOD_ACCESS_TOKEN=fake
+
+Or use it from Python:
+
+>>> with FakePodioServer(latency=0.1, error_rate=0.05) as server:
+...     server.add_app(1001, num_items=2000, num_fields=20)
+...     podio = PodioOAuth2Session('fake', token=FAKE_TOKEN, api_url=server.url)
+...     items = iterate_resource(podio, 'https://api.podio.com/item/app/1001/filter/')
+
+GET responses carry an ETag and conditional requests (If-None-Match) get a 304.
+
+Implemented endpoints:
+ - GET    /app/{app_id}/
+ - PUT    /app/{app_id}/field/{field_id}
+ - POST   /item/app/{app_id}/filter/ and /item/app/{app_id}/filter/{view_id}/
+          (filters: item_id, last_edit_on; sort_by, sort_desc; views added
+          with add_view(); ?fields=items.view(micro))
+ - POST   /item/app/{app_id}/
+ - POST   /item/app/{app_id}/delete
+ - GET    /item/{item_id}
+ - GET    /item/{item_id}/value
+ - PUT    /item/{item_id}/value
+ - DELETE /item/{item_id}
+ - GET    /comment/item/{item_id}/
+ - POST   /file/ (multipart upload)
+ - POST   /file/{file_id}/attach
+ - GET    /file/{file_id}
+ - GET    /file/{file_id}/raw
+ - GET    /user/profile/
+"""
+import argparse
+import email.parser
+import email.policy
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from tetrapod.backends import utcnow_str
+from tetrapod.synthetic import make_app_config, make_items
+
+log = logging.getLogger(__name__)
+
+# Token that can be used for sessions talking to the fake server, it accepts any token.
+FAKE_TOKEN = {
+    'access_token': 'fake-access-token',
+    'token_type': 'bearer',
+    'client_id': 'fake',
+}
+
+ROUTES = []
+
+
+def parse_multipart(content_type: str, raw_body: bytes) -> dict:
+    """Form fields of a multipart/form-data body, files as (filename, bytes) tuples."""
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + raw_body)
+    form = {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        data = part.get_payload(decode=True)
+        filename = part.get_filename()
+        form[name] = (filename, data) if filename is not None else data.decode('utf-8')
+    return form
+
+
+def route(method, pattern):
+    def decorator(func):
+        ROUTES.append((method, re.compile('^' + pattern + '$'), func))
+        return func
+    return decorator
+
+
+class FakePodioHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _dispatch(self, method):
+        fake = self.server.fake
+        parts = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        content_len = int(self.headers.get('content-length', 0))
+        raw_body = self.rfile.read(content_len) if content_len else b''
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            body = parse_multipart(content_type, raw_body)
+        else:
+            try:
+                body = json.loads(raw_body) if raw_body else {}
+            except ValueError:
+                body = {k: v[0] for k, v in parse_qs(raw_body.decode('utf-8')).items()}
+
+        auth = self.headers.get('Authorization')
+        status, payload, num_items = fake.handle(method, parts.path, query, body, auth=auth)
+        fake.wait(num_items)
+
+        if isinstance(payload, bytes):
+            content, content_type = payload, 'application/octet-stream'
+        else:
+            content = json.dumps(payload).encode('utf-8') if payload is not None else b''
+            content_type = 'application/json'
+        # Conditional GET requests
+        etag = None
+        if method == 'GET' and status == 200:
+            etag = '"%s"' % hashlib.md5(content).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                status, content = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in fake.rate_limit_headers(auth).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        log.debug('%s - %s' % (self.address_string(), format % args))
+
+
+# What Podio returns for every item with ?fields=items.view(micro)
+MICRO_VIEW_KEYS = ('item_id', 'app_item_id', 'title', 'link')
+
+
+class FakePodioServer(object):
+    """
+    :param latency: Seconds every response is delayed.
+    :param jitter: Up to this many seconds are randomly added to the latency.
+    :param latency_per_item: Additional seconds per item in a response, makes big
+        pages slower than small ones.
+    :param error_rate: Probability (0.0 - 1.0) of answering with a 5xx error.
+    :param error_status: The status code of injected errors.
+    :param max_page_size: Filter requests with a bigger limit fail with 504
+        Gateway Timeout, like Podio does for apps with big items.
+    :param rate_limit: Number of requests per rate_limit_window seconds and access
+        token. When the budget is used up, the server answers with 420 like Podio.
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 0, latency: float = 0.0,
+                 jitter: float = 0.0, latency_per_item: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 504, max_page_size: int = 500, rate_limit: int = 5000,
+                 rate_limit_window: float = 3600.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.latency_per_item = latency_per_item
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.max_page_size = max_page_size
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.lock = threading.RLock()
+        self.app_configs = {}
+        # view_id -> {'app_id', 'filters', 'sort_by', 'sort_desc'}
+        self.views = {}
+        # app_id -> {item_id: item_data}, in insertion order
+        self.items = {}
+        # file_id -> {'file_id', 'name', 'mimetype', 'size', 'data', 'attached_to'}
+        self.files = {}
+        self.num_requests = 0
+        # Authorization header -> [start of the rate limit window, remaining requests]
+        self._budgets = {}
+        self._next_item_id = 10 ** 9
+        self._next_file_id = 10 ** 9
+        self.httpd = ThreadingHTTPServer((host, port), FakePodioHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def add_app(self, app_id: int, num_items: int = 100, num_fields: int = 10, seed: int = None):
+        app_config = make_app_config(app_id, num_fields=num_fields)
+        items = make_items(app_config, num_items, seed=self.seed if seed is None else seed)
+        with self.lock:
+            self.app_configs[app_id] = app_config
+            self.items[app_id] = {item['item_id']: item for item in items}
+        return app_config
+
+    def add_view(self, app_id: int, view_id: int, filters: dict = None, sort_by: str = None,
+                 sort_desc: bool = True):
+        """A view of the app, used by /item/app/{app_id}/filter/{view_id}/."""
+        with self.lock:
+            self.views[view_id] = {'app_id': app_id, 'filters': filters or {},
+                                   'sort_by': sort_by, 'sort_desc': sort_desc}
+
+    def add_file(self, name: str, data: bytes, mimetype: str = 'application/octet-stream') -> int:
+        with self.lock:
+            self._next_file_id += 1
+            file_id = self._next_file_id
+            self.files[file_id] = {
+                'file_id': file_id,
+                'name': name,
+                'mimetype': mimetype,
+                'size': len(data),
+                'data': data,
+                'attached_to': [],
+            }
+        return file_id
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        name='tetrapod-fakeserver', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def serve_forever(self):
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.httpd.server_close()
+
+    def wait(self, num_items: int = 0):
+        delay = self.latency + self.latency_per_item * num_items
+        if self.jitter:
+            with self.lock:
+                delay += self.rng.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _budget(self, auth) -> list:
+        """The rate limit budget of one access token, Podio counts them separately."""
+        now = time.monotonic()
+        budget = self._budgets.get(auth)
+        if budget is None or now - budget[0] >= self.rate_limit_window:
+            budget = self._budgets[auth] = [now, self.rate_limit]
+        return budget
+
+    def rate_limit_headers(self, auth: str = None) -> dict:
+        with self.lock:
+            return {
+                'X-Rate-Limit-Limit': str(self.rate_limit),
+                'X-Rate-Limit-Remaining': str(max(0, self._budget(auth)[1])),
+            }
+
+    def handle(self, method: str, path: str, query: dict, body: dict, auth: str = None):
+        """
+        Returns (status code, JSON payload, number of items in the payload).
+        :param auth: The Authorization header, every token has its own rate limit.
+        """
+        with self.lock:
+            self.num_requests += 1
+            budget = self._budget(auth)
+            if budget[1] <= 0:
+                return 420, {'error': 'rate_limit',
+                             'error_description': 'You have hit the rate limit.'}, 0
+            budget[1] -= 1
+            inject_error = self.error_rate > 0 and self.rng.random() < self.error_rate
+        if inject_error:
+            return self.error_status, {'error': 'unavailable',
+                                       'error_description': 'Injected error'}, 0
+
+        for route_method, pattern, func in ROUTES:
+            if route_method != method:
+                continue
+            match = pattern.match(path)
+            if match:
+                return func(self, query, body, **match.groupdict())
+        return 404, {'error': 'not_found', 'error_description': f'No route for {path}'}, 0
+
+    def find_item(self, item_id: int):
+        with self.lock:
+            for app_items in self.items.values():
+                if item_id in app_items:
+                    return app_items[item_id]
+        return None
+
+    # The endpoints
+
+    @route('GET', r'/app/(?P<app_id>\d+)/?')
+    def get_app(self, query, body, app_id):
+        app_config = self.app_configs.get(int(app_id))
+        if app_config is None:
+            return 404, {'error': 'not_found'}, 0
+        return 200, app_config, 0
+
+    @route('PUT', r'/app/(?P<app_id>\d+)/field/(?P<field_id>\d+)/?')
+    def update_field(self, query, body, app_id, field_id):
+        app_config = self.app_configs.get(int(app_id))
+        if app_config is None:
+            return 404, {'error': 'not_found'}, 0
+        with self.lock:
+            for field in app_config['fields']:
+                if field['field_id'] == int(field_id):
+                    if 'label' in body:
+                        field['label'] = body['label']
+                    field['config'].update({k: v for k, v in body.items() if k != 'label'})
+                    return 200, {}, 0
+        return 404, {'error': 'not_found'}, 0
+
+    @route('POST', r'/item/app/(?P<app_id>\d+)/filter(?:/(?P<view_id>\d+))?/?')
+    def filter_items(self, query, body, app_id, view_id=None):
+        app_items = self.items.get(int(app_id))
+        if app_items is None:
+            return 404, {'error': 'not_found'}, 0
+        limit = int(body.get('limit', 30))
+        offset = int(body.get('offset', 0))
+        if limit > self.max_page_size:
+            return 504, {'error': 'timeout', 'error_description': 'Gateway Timeout'}, 0
+        with self.lock:
+            items = list(app_items.values())
+            view = self.views.get(int(view_id)) if view_id is not None else None
+        if view_id is not None and (view is None or view['app_id'] != int(app_id)):
+            return 404, {'error': 'not_found', 'error_description': 'View not found'}, 0
+        # The filters and the order of the request come on top of the ones of the view
+        filters = dict(view['filters'] if view else {}, **(body.get('filters') or {}))
+        sort_by = body.get('sort_by', view['sort_by'] if view else None)
+        sort_desc = body.get('sort_desc', view['sort_desc'] if view else True)
+        wanted_ids = filters.get('item_id')
+        if wanted_ids:
+            wanted_ids = set(int(item_id) for item_id in wanted_ids)
+            items = [item for item in items if item['item_id'] in wanted_ids]
+        edited_from = (filters.get('last_edit_on') or {}).get('from')
+        if edited_from:
+            items = [item for item in items if self._last_edit_on(item) >= edited_from]
+        if sort_by is not None:
+            items.sort(key=lambda item: self._sort_key(item, sort_by), reverse=bool(sort_desc))
+        page = items[offset:offset + limit]
+        if query.get('fields') == 'items.view(micro)':
+            page = [{key: item[key] for key in MICRO_VIEW_KEYS if key in item} for item in page]
+        return 200, {'total': len(app_items), 'filtered': len(items), 'items': page}, len(page)
+
+    def _sort_key(self, item: dict, sort_by: str):
+        if sort_by == 'last_edit_on':
+            return self._last_edit_on(item)
+        if sort_by in ('item_id', 'app_item_id', 'title', 'created_on'):
+            return item.get(sort_by) or ''
+        # A field, by field_id or external_id
+        for field in item['fields']:
+            if sort_by in (str(field['field_id']), field['external_id']):
+                return str(field['values'][0].get('value', '')) if field['values'] else ''
+        return ''
+
+    @route('POST', r'/item/app/(?P<app_id>\d+)/?')
+    def create_item(self, query, body, app_id):
+        app_config = self.app_configs.get(int(app_id))
+        if app_config is None:
+            return 404, {'error': 'not_found'}, 0
+        with self.lock:
+            self._next_item_id += 1
+            item_id = self._next_item_id
+            now = utcnow_str()
+            item_data = {
+                'item_id': item_id,
+                'app': {'app_id': int(app_id)},
+                'title': '',
+                'link': f'https://podio.com/fake/items/{item_id}',
+                'created_on': now,
+                'last_edit_on': now,
+                'fields': self._make_fields(app_config, body.get('fields', {})),
+            }
+            self.items[int(app_id)][item_id] = item_data
+        return 200, item_data, 1
+
+    @route('POST', r'/item/app/(?P<app_id>\d+)/delete/?')
+    def bulk_delete(self, query, body, app_id):
+        app_items = self.items.get(int(app_id))
+        if app_items is None:
+            return 404, {'error': 'not_found'}, 0
+        with self.lock:
+            deleted = [item_id for item_id in body.get('item_ids', [])
+                       if app_items.pop(int(item_id), None) is not None]
+        return 200, {'deleted': len(deleted), 'pending': 0}, 0
+
+    @route('GET', r'/item/(?P<item_id>\d+)/?')
+    def get_item(self, query, body, item_id):
+        item_data = self.find_item(int(item_id))
+        if item_data is None:
+            return 404, {'error': 'not_found'}, 0
+        return 200, item_data, 1
+
+    @route('GET', r'/item/(?P<item_id>\d+)/value/?')
+    def get_item_values(self, query, body, item_id):
+        item_data = self.find_item(int(item_id))
+        if item_data is None:
+            return 404, {'error': 'not_found'}, 0
+        return 200, item_data['fields'], 1
+
+    @route('PUT', r'/item/(?P<item_id>\d+)/value/?')
+    def update_item_values(self, query, body, item_id):
+        item_data = self.find_item(int(item_id))
+        if item_data is None:
+            return 404, {'error': 'not_found'}, 0
+        app_config = self.app_configs[item_data['app']['app_id']]
+        with self.lock:
+            updated = self._make_fields(app_config, body)
+            updated_ids = {field['external_id'] for field in updated}
+            item_data['fields'] = [field for field in item_data['fields']
+                                   if field['external_id'] not in updated_ids] + updated
+            item_data['revision'] = item_data.get('revision', 0) + 1
+            item_data['last_edit_on'] = utcnow_str()
+        return 200, {'revision': item_data['revision']}, 0
+
+    @route('DELETE', r'/item/(?P<item_id>\d+)/?')
+    def delete_item(self, query, body, item_id):
+        with self.lock:
+            for app_items in self.items.values():
+                if app_items.pop(int(item_id), None) is not None:
+                    return 204, None, 0
+        return 404, {'error': 'not_found'}, 0
+
+    @route('GET', r'/comment/item/(?P<item_id>\d+)/?')
+    def get_comments(self, query, body, item_id):
+        if self.find_item(int(item_id)) is None:
+            return 404, {'error': 'not_found'}, 0
+        # Every item has as many comments as the last three digits of its item_id.
+        num_comments = int(item_id) % 1000
+        limit = int(query.get('limit', 100))
+        offset = int(query.get('offset', 0))
+        comments = [{
+            'comment_id': int(item_id) * 1000 + i,
+            'value': f'Comment {i}',
+        } for i in range(offset, min(offset + limit, num_comments))]
+        return 200, comments, len(comments)
+
+    @route('POST', r'/file/?')
+    def upload_file(self, query, body):
+        source = body.get('source')
+        if not isinstance(source, tuple):
+            return 400, {'error': 'invalid_value', 'error_description': 'No file uploaded'}, 0
+        filename, data = source
+        file_id = self.add_file(body.get('filename') or filename, data)
+        return 200, {'file_id': file_id}, 0
+
+    @route('POST', r'/file/(?P<file_id>\d+)/attach/?')
+    def attach_file(self, query, body, file_id):
+        with self.lock:
+            file_info = self.files.get(int(file_id))
+            if file_info is None:
+                return 404, {'error': 'not_found'}, 0
+            file_info['attached_to'].append((body.get('ref_type'), int(body.get('ref_id'))))
+        return 200, {}, 0
+
+    @route('GET', r'/file/(?P<file_id>\d+)/?')
+    def get_file(self, query, body, file_id):
+        file_info = self.files.get(int(file_id))
+        if file_info is None:
+            return 404, {'error': 'not_found'}, 0
+        return 200, {k: v for k, v in file_info.items() if k != 'data'}, 0
+
+    @route('GET', r'/file/(?P<file_id>\d+)/raw/?')
+    def get_file_raw(self, query, body, file_id):
+        file_info = self.files.get(int(file_id))
+        if file_info is None:
+            return 404, {'error': 'not_found'}, 0
+        return 200, file_info['data'], 0
+
+    @route('GET', r'/user/profile/?')
+    def get_profile(self, query, body):
+        return 200, {'name': 'Fake User', 'user_id': 1, 'profile_id': 1}, 0
+
+    @staticmethod
+    def _last_edit_on(item_data) -> str:
+        return item_data.get('last_edit_on') or item_data.get('created_on') or ''
+
+    def _make_fields(self, app_config, values: dict) -> list:
+        fields = []
+        for field in app_config['fields']:
+            if field['external_id'] not in values:
+                continue
+            value = values[field['external_id']]
+            if not isinstance(value, list):
+                value = [value]
+            fields.append({
+                'field_id': field['field_id'],
+                'type': field['type'],
+                'external_id': field['external_id'],
+                'label': field['label'],
+                'config': field['config'],
+                'values': [v if isinstance(v, dict) else {'value': v} for v in value],
+            })
+        return fields
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a fake Podio API server.')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--apps', default='1001',
+                        help='Comma separated list of app IDs to generate.')
+    parser.add_argument('--items', type=int, default=1000, help='Items per app.')
+    parser.add_argument('--fields', type=int, default=10, help='Fields per app.')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--latency-per-item', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=504)
+    parser.add_argument('--max-page-size', type=int, default=500)
+    parser.add_argument('--rate-limit', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    server = FakePodioServer(
+        host=args.host, port=args.port, latency=args.latency, jitter=args.jitter,
+        latency_per_item=args.latency_per_item, error_rate=args.error_rate,
+        error_status=args.error_status, max_page_size=args.max_page_size,
+        rate_limit=args.rate_limit, seed=args.seed)
+    for app_id in args.apps.split(','):
+        server.add_app(int(app_id), num_items=args.items, num_fields=args.fields)
+    log.info(f'Fake Podio API listening on {server.url} (apps: {args.apps})')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""
+Streaming upload and download of Podio files, one at a time or many concurrently.
+
+Files are never read into memory as a whole: uploads are sent from the file in
+chunks, downloads are written to disk chunk by chunk. With transfer_files() at
+most `workers` transfers run at the same time, so the memory used stays around
+workers * chunk_size no matter how many or how big the files are.
+
+Example:
+>>> from tetrapod.files import upload_and_attach, download_file, transfer_files
+>>> file_id = upload_and_attach(podio, item_id, '/tmp/report.pdf')
+>>> download_file(podio, file_id, '/tmp/downloads/')
+>>> transfers = transfer_files(
+...     podio,
+...     uploads=[(item_id, path) for item_id, path in attachments],
+...     downloads=[(file_id, '/tmp/downloads/') for file_id in file_ids],
+...     workers=8, progress_callback=lambda t: print(t.as_dict()))
+"""
+import io
+import logging
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+from tetrapod import jsoncodec
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+
+
+class MultipartFileStream(object):
+    """
+    A multipart/form-data request body with one file in it. The file is read in
+    chunks while the body is sent. The body can be iterated more than once, e.g.
+    by the retries of a robust session, because every iteration starts at the
+    beginning of the file again.
+    """
+
+    def __init__(self, fileobj, file_name: str, fields: dict = None, field_name: str = 'source',
+                 content_type: str = None, chunk_size: int = CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.start = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        self.size = fileobj.tell() - self.start
+        fileobj.seek(self.start)
+
+        boundary = uuid.uuid4().hex
+        content_type = content_type or mimetypes.guess_type(file_name)[0] \
+            or 'application/octet-stream'
+        head = b''
+        for name, value in (fields or {}).items():
+            if isinstance(value, str):
+                value = value.encode('utf-8')
+            head += (f'--{boundary}\r\n'
+                     f'Content-Disposition: form-data; name="{name}"\r\n\r\n').encode('utf-8')
+            head += value + b'\r\n'
+        quoted_name = file_name.replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+        head += (f'--{boundary}\r\n'
+                 f'Content-Disposition: form-data; name="{field_name}"; filename="{quoted_name}"\r\n'
+                 f'Content-Type: {content_type}\r\n\r\n').encode('utf-8')
+        self.head = head
+        self.tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+
+    def __len__(self):
+        return len(self.head) + self.size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        self.fileobj.seek(self.start)
+        remaining = self.size
+        while remaining > 0:
+            chunk = self.fileobj.read(min(self.chunk_size, remaining))
+            if not chunk:
+                raise IOError('File got shorter while it was uploaded.')
+            remaining -= len(chunk)
+            yield chunk
+        yield self.tail
+
+
+def _open_source(source, file_name=None):
+    """Returns (file object, file name, whether we opened the file and must close it)."""
+    if isinstance(source, (str, os.PathLike)):
+        return open(source, mode='rb'), file_name or os.path.basename(source), True
+    if isinstance(source, (bytes, bytearray)):
+        if not file_name:
+            raise ValueError('file_name is needed to upload raw bytes.')
+        return io.BytesIO(source), file_name, True
+    file_name = file_name or os.path.basename(getattr(source, 'name', '') or '')
+    if not file_name:
+        raise ValueError('file_name is needed for file objects without a name.')
+    if not source.seekable():
+        # e.g. pipes or sockets, there is no way around reading them into memory.
+        return io.BytesIO(source.read()), file_name, True
+    return source, file_name, False
+
+
+def upload_file_stream(podio, source, file_name: str = None, chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Upload a file to Podio without reading it into memory. Returns the new file_id.
+    :param source: A path, a binary file object or bytes.
+    :param file_name: The name of the file in Podio, defaults to the name of the source.
+    """
+    fileobj, file_name, close = _open_source(source, file_name)
+    try:
+        body = MultipartFileStream(fileobj, file_name, fields={'filename': file_name},
+                                   chunk_size=chunk_size)
+        log.info(f'Uploading file {file_name} ({body.size} bytes)')
+        resp = podio.post('https://api.podio.com/file/', data=body,
+                          headers={'Content-Type': body.content_type})
+        resp.raise_for_status()
+        return jsoncodec.response_json(resp)['file_id']
+    finally:
+        if close:
+            fileobj.close()
+
+
+def attach_file(podio, file_id: int, ref_id: int, ref_type: str = 'item'):
+    resp = podio.post('https://api.podio.com/file/%d/attach' % file_id,
+                      json={'ref_type': ref_type, 'ref_id': ref_id})
+    resp.raise_for_status()
+
+
+def upload_and_attach(podio, item_id: int, source, file_name: str = None,
+                      chunk_size: int = CHUNK_SIZE) -> int:
+    """Upload a file and attach it to an item. Returns the new file_id."""
+    file_id = upload_file_stream(podio, source, file_name, chunk_size=chunk_size)
+    attach_file(podio, file_id, item_id)
+    return file_id
+
+
+def download_file(podio, file_id: int, destination, chunk_size: int = CHUNK_SIZE):
+    """
+    Download a file from Podio, chunk by chunk.
+    :param destination: A file path, a directory (the file keeps its name from Podio)
+        or a binary file object.
+    :return: The path of the downloaded file, or the file object.
+    """
+    if isinstance(destination, (str, os.PathLike)) and os.path.isdir(destination):
+        meta_resp = podio.get('https://api.podio.com/file/%d' % file_id)
+        meta_resp.raise_for_status()
+        file_name = os.path.basename(jsoncodec.response_json(meta_resp)['name'])
+        destination = os.path.join(destination, file_name)
+
+    resp = podio.get('https://api.podio.com/file/%d/raw' % file_id, stream=True)
+    try:
+        resp.raise_for_status()
+        if not isinstance(destination, (str, os.PathLike)):
+            for chunk in resp.iter_content(chunk_size=chunk_size):
+                destination.write(chunk)
+            return destination
+
+        # Write to a temporary file first, so that an interrupted download never
+        # leaves a half-written file under the final name.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(destination)),
+                                        prefix='.tetrapod-download-')
+        try:
+            with os.fdopen(fd, mode='wb') as fh:
+                for chunk in resp.iter_content(chunk_size=chunk_size):
+                    fh.write(chunk)
+            os.replace(tmp_path, destination)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return destination
+    finally:
+        resp.close()
+
+
+class FileTransfer(object):
+    """One upload or download of transfer_files() and how it went."""
+
+    def __init__(self, direction: str, item_id: int = None, file_id: int = None,
+                 source=None, destination=None, file_name: str = None):
+        self.direction = direction
+        self.item_id = item_id
+        self.file_id = file_id
+        self.source = source
+        self.destination = destination
+        self.file_name = file_name
+        self.size = None
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    @property
+    def ok(self) -> bool:
+        return self.done and self.error is None
+
+    @property
+    def elapsed(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return end - self.started_at
+
+    def as_dict(self) -> dict:
+        return {
+            'direction': self.direction,
+            'item_id': self.item_id,
+            'file_id': self.file_id,
+            'destination': self.destination if isinstance(self.destination, str) else None,
+            'size': self.size,
+            'elapsed': self.elapsed,
+            'done': self.done,
+            'error': repr(self.error) if self.error else None,
+        }
+
+
+def _run_transfer(podio, transfer: FileTransfer, chunk_size: int):
+    transfer.started_at = time.monotonic()
+    try:
+        if transfer.direction == UPLOAD:
+            transfer.file_id = upload_and_attach(podio, transfer.item_id, transfer.source,
+                                                 transfer.file_name, chunk_size=chunk_size)
+            if isinstance(transfer.source, (str, os.PathLike)):
+                transfer.size = os.path.getsize(transfer.source)
+        else:
+            transfer.destination = download_file(podio, transfer.file_id, transfer.destination,
+                                                 chunk_size=chunk_size)
+            if isinstance(transfer.destination, (str, os.PathLike)):
+                transfer.size = os.path.getsize(transfer.destination)
+    except Exception as err:
+        log.exception('File %s failed: %r' % (transfer.direction, transfer.as_dict()))
+        transfer.error = err
+    finally:
+        transfer.finished_at = time.monotonic()
+    return transfer
+
+
+def transfer_files(podio, uploads=(), downloads=(), workers: int = 4,
+                   progress_callback=None, chunk_size: int = CHUNK_SIZE) -> list:
+    """
+    Upload, attach and download many files concurrently.
+    :param uploads: (item_id, source) or (item_id, source, file_name) tuples, see
+        upload_file_stream() for the sources.
+    :param downloads: (file_id, destination) tuples, see download_file().
+    :param workers: Number of transfers running at the same time.
+    :param progress_callback: Called with the FileTransfer every time one is finished.
+    :return: The list of FileTransfer objects, uploads first. Failed transfers have
+        their exception in .error, the other transfers go on.
+    """
+    transfers = []
+    for upload in uploads:
+        item_id, source = upload[0], upload[1]
+        file_name = upload[2] if len(upload) > 2 else None
+        transfers.append(FileTransfer(UPLOAD, item_id=item_id, source=source,
+                                      file_name=file_name))
+    for file_id, destination in downloads:
+        transfers.append(FileTransfer(DOWNLOAD, file_id=file_id, destination=destination))
+
+    callback_lock = threading.Lock()
+
+    def run(transfer):
+        _run_transfer(podio, transfer, chunk_size)
+        if progress_callback is not None:
+            with callback_lock:
+                progress_callback(transfer)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(run, transfers))
+    failed = [t for t in transfers if t.error is not None]
+    log.info(f'Transferred {len(transfers) - len(failed)} files, {len(failed)} failed.')
+    return transfers
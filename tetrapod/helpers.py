@@ -1,74 +1,97 @@
-import math
+import io
 import logging
-import mimetypes
 
-from collections import UserList
+from collections import UserList, deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
+from time import monotonic, sleep
+from urllib.parse import urlencode
 
 from tetrapod.items import Item
+from tetrapod.jsoncodec import response_json
 
 log = logging.getLogger(__name__)
 
+# The biggest limit the filter endpoint accepts
+MAX_PAGE_SIZE = 500
 
-def iterate_array(client, url, http_method='GET', limit=100, offset=0, params=None):
-    """
-    Get a list of objects from the Podio API and provide a generator to iterate
-    over these items. Use this for 
-
-    e.g. to read all the items of one app use:
 
-        url = 'https://api.podio.com/comment/item/{}/'.format(item_id)
-        for item in iterate_array(client, url, 'GET'):
-            print(item)
-    """
-    all_elements = []
-    if params is None:
-        params = dict(limit=limit, offset=offset)
+def _fetch_array_page(client, url, http_method, params) -> list:
+    if http_method == 'POST':
+        api_resp = client.post(url, data=params)
+    elif http_method == 'GET':
+        api_resp = client.get(url, params=params)
     else:
-        params['limit'] = limit
-        params['offset'] = offset
-        
-    do_requests = True
-    while do_requests == True:
-        if http_method == 'POST':
-            api_resp = client.post(url, data=params)
-        elif http_method == 'GET':
-            api_resp = client.get(url, params=params)
-        else:
-            raise Exception("Method not supported.")
-        
-        if api_resp.status_code != 200:
-            raise Exception('Podio API response was bad: {}'.format(api_resp.content))
-            
-        resp = api_resp.json()
-        num_entries = len(resp)
-        if num_entries < limit or num_entries <= 0:
-            do_requests = False
+        raise Exception("Method not supported.")
 
-        params['offset'] += limit
-        
-        all_elements.extend(resp) 
-    # print(f"array of {len(all_elements)}")
-    return all_elements
+    if api_resp.status_code != 200:
+        raise Exception('Podio API response was bad: {}'.format(api_resp.content))
+    return response_json(api_resp)
 
 
-def iterate_resource(client, url, http_method='POST', limit=500, offset=0, params=None):
+def iter_array(client, url, http_method='GET', limit=100, offset=0, params=None, prefetch=0):
     """
-    Get a list of items from the Podio API and provide a generator to iterate
-    over these items.
+    Like iterate_array(), but a generator: the objects are yielded as the pages
+    arrive and no more pages are requested once the caller stops iterating.
 
-    e.g. to read all the items of one app use:
+    With prefetch > 0 the next `prefetch` pages are requested speculatively on a
+    thread pool while the current one is consumed. List endpoints don't tell the
+    total number of objects, so up to `prefetch` requests past the last page are
+    wasted, in exchange for not waiting for every page one after the other.
 
-        url = 'https://api.podio.com/item/app/{}/filter/'.format(app_id)
-        for item in iterate_resource(client, url, 'POST'):
-            print(item)
+        url = 'https://api.podio.com/comment/item/{}/'.format(item_id)
+        for comment in iter_array(client, url, 'GET', prefetch=4):
+            if is_the_one(comment):
+                break
     """
-    if params is None:
-        params = dict(limit=limit, offset=offset)
-    else:
-        params['limit'] = limit
-        params['offset'] = offset
+    if http_method not in ('GET', 'POST'):
+        raise Exception("Method not supported.")
+    base_params = dict(params or {})
+
+    def fetch(page_offset):
+        return _fetch_array_page(client, url, http_method,
+                                 dict(base_params, limit=limit, offset=page_offset))
+
+    if prefetch <= 0:
+        while True:
+            page = fetch(offset)
+            yield from page
+            # A short page is the last one
+            if len(page) < limit:
+                return
+            offset += limit
+
+    executor = ThreadPoolExecutor(max_workers=prefetch)
+    pending = deque()
+    try:
+        while True:
+            while len(pending) <= prefetch:
+                pending.append(executor.submit(fetch, offset))
+                offset += limit
+            page = pending.popleft().result()
+            yield from page
+            if len(page) < limit:
+                return
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def iterate_array(client, url, http_method='GET', limit=100, offset=0, params=None, prefetch=0):
+    """
+    Get a list of objects from the Podio API, e.g. all the comments of an item:
+
+        url = 'https://api.podio.com/comment/item/{}/'.format(item_id)
+        for comment in iterate_array(client, url, 'GET'):
+            print(comment)
+
+    Use iter_array() to get a generator instead of the complete list.
+    """
+    return list(iter_array(client, url, http_method, limit, offset, params, prefetch))
+
 
+def _fetch_resource_page(client, url, http_method, params) -> dict:
     if http_method == 'POST':
         api_resp = client.post(url, json=params)
     elif http_method == 'GET':
@@ -78,44 +101,264 @@ def iterate_resource(client, url, http_method='POST', limit=500, offset=0, param
 
     if api_resp.status_code != 200:
         raise Exception('Podio API response was bad: {}'.format(api_resp.content))
+    return response_json(api_resp)
 
-    all_items = []
-    resp = api_resp.json()
+
+class AdaptivePageSize(object):
+    """
+    The page size of an adaptive pull, see iterate_resource_pages(). It starts with
+    the biggest page Podio allows and, after every page:
+     - a timeout or a 5xx error: go back to the last size that worked, or halve it.
+       A size that failed is not tried again.
+     - a page that took less than fast_seconds: grow by a quarter.
+     - a page that took more than slow_seconds: shrink by a quarter.
+    Keep one object per app, to start the next pull of the app with what was learned.
+
+    :param max_failures: Give up after this many failed requests in a row.
+    :param retry_wait: Seconds to wait before a retry that can't use a smaller page.
+    """
+
+    def __init__(self, limit: int = MAX_PAGE_SIZE, min_limit: int = 10,
+                 max_limit: int = MAX_PAGE_SIZE, fast_seconds: float = 2.0,
+                 slow_seconds: float = 15.0, max_failures: int = 5, retry_wait: float = 3.0):
+        self.limit = max(min_limit, min(limit, max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.fast_seconds = fast_seconds
+        self.slow_seconds = slow_seconds
+        self.max_failures = max_failures
+        self.retry_wait = retry_wait
+        # The smallest size that failed and the last one that worked
+        self.ceiling = max_limit + 1
+        self.last_good = None
+        self.failures = 0
+
+    def succeeded(self, elapsed: float):
+        self.failures = 0
+        self.last_good = self.limit
+        if elapsed > self.slow_seconds:
+            self.limit = max(self.min_limit, self.limit * 3 // 4)
+        elif elapsed < self.fast_seconds:
+            grown = min(self.max_limit, max(self.limit + 1, self.limit * 5 // 4))
+            if grown < self.ceiling:
+                self.limit = grown
+
+    def failed(self) -> bool:
+        """Shrink the page after a failure. Returns False when it is time to give up."""
+        self.failures += 1
+        self.ceiling = min(self.ceiling, self.limit)
+        if self.last_good is not None and self.last_good < self.limit:
+            self.limit = self.last_good
+        else:
+            self.limit = max(self.min_limit, self.limit // 2)
+        return self.failures <= self.max_failures
+
+
+def _iterate_adaptive_pages(client, url, http_method, offset, params,
+                            page_size: AdaptivePageSize):
+    # Robust sessions would retry a failed page with the same size, we want to see the
+    # error instead.
+    kwargs = {'retry_server_errors': False} if getattr(client, 'enable_robustness', False) \
+        else {}
+    total = None
+    while total is None or offset < total:
+        limit = page_size.limit
+        page_params = dict(params, limit=limit, offset=offset)
+        start = monotonic()
+        try:
+            if http_method == 'POST':
+                api_resp = client.post(url, json=page_params, **kwargs)
+            else:
+                api_resp = client.get(url, params=page_params, **kwargs)
+            error = None
+            if 500 <= api_resp.status_code < 600:
+                error = Exception('Podio API response was bad: {}'.format(api_resp.content))
+        except OSError as err:
+            # requests' exceptions, e.g. a ReadTimeout
+            error = err
+        if error is not None:
+            if not page_size.failed():
+                raise error
+            log.warning('Page of %d items from offset %d failed (%s), retrying with %d items'
+                        % (limit, offset, error, page_size.limit))
+            if page_size.limit == limit and page_size.retry_wait:
+                sleep(page_size.retry_wait)
+            continue
+        if api_resp.status_code != 200:
+            raise Exception('Podio API response was bad: {}'.format(api_resp.content))
+        resp = response_json(api_resp)
+        page_size.succeeded(monotonic() - start)
+        total = resp.get('filtered', resp['total'])
+        log.debug('Got %d items from offset %d, total: %d, next page size: %d'
+                  % (len(resp['items']), offset, total, page_size.limit))
+        yield resp['items']
+        if not resp['items']:
+            break
+        offset += limit
+    log.debug("Got all items!")
+
+
+def iterate_resource_pages(client, url, http_method='POST', limit=500, offset=0, params=None,
+                           prefetch=0, adaptive=False):
+    """
+    Like iterate_resource() but yields the items page by page as they arrive, so
+    the caller can start working on the first page while the rest is still being
+    downloaded. Every yielded page corresponds to exactly one API call.
+
+    The first response tells how many items there are, so with prefetch > 0 up to
+    `prefetch` of the following pages are requested concurrently on a thread pool.
+    The pages are still yielded in order and at most prefetch + 1 of them are held
+    in memory at any time.
+
+    With adaptive=True (or an AdaptivePageSize object) limit is ignored: the pages
+    start with the biggest size Podio allows, get smaller after timeouts and 5xx
+    errors and bigger again when they arrive quickly. The pages are requested one
+    after the other, so this can't be combined with prefetch.
+    """
+    if http_method not in ('GET', 'POST'):
+        raise Exception("Method not supported.")
+    if adaptive:
+        if prefetch > 0:
+            raise ValueError("Adaptive page sizes can't be combined with prefetch.")
+        page_size = adaptive if isinstance(adaptive, AdaptivePageSize) else AdaptivePageSize()
+        yield from _iterate_adaptive_pages(client, url, http_method, offset, params or {},
+                                           page_size)
+        return
+    params = dict(params or {}, limit=limit, offset=offset)
+
+    resp = _fetch_resource_page(client, url, http_method, params)
     log.debug(f"Got {len(resp['items'])} ...")
-    all_items.extend(resp['items'])
+    yield resp['items']
 
     total = resp['total']
-    try: 
+    try:
         total = resp['filtered']
     except KeyError:
         pass
 
     log.debug('Getting items from offset: %d, total: %d' % (offset, total))
-    steps_left = []
-    if total > limit:
-        num_steps = int(math.ceil(total / limit))
-        steps = list(range(0, num_steps * limit, limit))
-        # we don't need step 0 because we already got the data.
-        steps_left = steps[1:]
-
-    for curr_offset in steps_left:
+    # we don't need the first step because we already got the data.
+    steps_left = range(offset + limit, total, limit)
+
+    def fetch(curr_offset):
         log.debug('Getting items from offset: %d, total: %d' % (curr_offset, total))
-        params['limit'] = limit
-        params['offset'] = curr_offset
-        if http_method == 'POST':
-            api_resp = client.post(url, json=params)
-        else: # method == 'GET'
-            api_resp = client.get(url, params=params)
+        return _fetch_resource_page(client, url, http_method,
+                                    dict(params, limit=limit, offset=curr_offset))['items']
+
+    if prefetch <= 0 or len(steps_left) < 2:
+        for curr_offset in steps_left:
+            yield fetch(curr_offset)
+        log.debug("Got all items!")
+        return
+
+    executor = ThreadPoolExecutor(max_workers=prefetch)
+    pending = deque()
+    offsets = iter(steps_left)
+    try:
+        for curr_offset in offsets:
+            pending.append(executor.submit(fetch, curr_offset))
+            if len(pending) >= prefetch:
+                break
+        while pending:
+            page = pending.popleft().result()
+            next_offset = next(offsets, None)
+            if next_offset is not None:
+                pending.append(executor.submit(fetch, next_offset))
+            yield page
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+    log.debug("Got all items!")
 
-        if api_resp.status_code != 200:
-            raise Exception('Podio API response was bad: {}'.format(api_resp.content))
-        resp = api_resp.json()
-        all_items.extend( resp['items'] )
 
-    log.debug("Got all items!")
+def iterate_resource(client, url, http_method='POST', limit=500, offset=0, params=None,
+                     adaptive=False):
+    """
+    Get a list of items from the Podio API and provide a generator to iterate
+    over these items.
+
+    e.g. to read all the items of one app use:
+
+        url = 'https://api.podio.com/item/app/{}/filter/'.format(app_id)
+        for item in iterate_resource(client, url, 'POST'):
+            print(item)
+
+    With adaptive=True the page size adapts to the app, see iterate_resource_pages().
+    """
+    all_items = []
+    for page in iterate_resource_pages(client, url, http_method, limit, offset, params,
+                                       adaptive=adaptive):
+        all_items.extend(page)
     return all_items
 
 
+def app_filter(app_id, view_id=None, filters=None, sort_by=None, sort_desc=None,
+               fields=None):
+    """
+    The URL and the request body for the filter endpoint of an app, to be passed on to
+    iterate_resource() and friends:
+
+        url, params = app_filter(app_id, view_id=view_id, fields='items.view(micro)')
+        items = iterate_resource(client, url, 'POST', params=params)
+
+    :param view_id: Only the items of this view of the app, in its order.
+    :param filters: Podio filters, e.g. {'last_edit_on': {'from': '2024-01-01 00:00:00'}}
+        or {field_id: [option_id, ...]}.
+    :param sort_by: e.g. 'created_on', 'last_edit_on', 'title' or a field_id.
+    :param sort_desc: True for descending order.
+    :param fields: Podio's fields parameter, which changes what is returned for each
+        item, e.g. 'items.view(micro)' for just the item_id, title and link.
+    See https://developers.podio.com/doc/items/filter-items-4496747
+    """
+    url = 'https://api.podio.com/item/app/{}/filter/'.format(app_id)
+    if view_id is not None:
+        url += '{}/'.format(view_id)
+    if fields:
+        url += '?' + urlencode({'fields': fields}, safe='(),.')
+    params = {}
+    if filters:
+        params['filters'] = filters
+    if sort_by is not None:
+        params['sort_by'] = sort_by
+    if sort_desc is not None:
+        params['sort_desc'] = sort_desc
+    return url, params
+
+
+def fetch_items_by_id(client, app_id, item_ids, chunk_size=250, workers=4) -> list:
+    """
+    Download many items of one app by their item_id, with the item_id filter of the
+    filter endpoint instead of one GET /item/{item_id} per item: chunk_size items per
+    request (at most 500) and `workers` requests at the same time.
+
+        items = fetch_items_by_id(client, app_id, [1234, 1235, 1236])
+
+    Returns the item data in the order of item_ids. Items that don't exist (anymore)
+    are left out.
+    """
+    if not 0 < chunk_size <= 500:
+        raise ValueError('chunk_size must be between 1 and 500.')
+    item_ids = list(dict.fromkeys(int(item_id) for item_id in item_ids))
+    if not item_ids:
+        return []
+    url = 'https://api.podio.com/item/app/{}/filter/'.format(app_id)
+    chunks = [item_ids[start:start + chunk_size]
+              for start in range(0, len(item_ids), chunk_size)]
+
+    def fetch(chunk):
+        params = {'filters': {'item_id': chunk}, 'limit': len(chunk), 'offset': 0}
+        return _fetch_resource_page(client, url, 'POST', params)['items']
+
+    found = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(chunks)))) as executor:
+        for page in executor.map(fetch, chunks):
+            for item_data in page:
+                found[item_data['item_id']] = item_data
+    log.debug('Fetched %d of %d items in %d requests' % (len(found), len(item_ids), len(chunks)))
+    return [found[item_id] for item_id in item_ids if item_id in found]
+
+
 # We define intersection and union ourselves here,
 # so we don't have to depend on another module (e.g. fnc)
 def intersection(*args):
@@ -151,7 +394,8 @@ class SearchableList(UserList):
 
     def make_searchable(self, index: int, item: Item):
         """Create the searchable values for the item in the search index."""
-        for field in item.item_data['fields']:
+        # Slim representations (e.g. fields='items.view(micro)') come without fields
+        for field in item.item_data.get('fields', []):
             external_id = field['external_id']
             searchable_text = str(item[external_id]).strip().lower()
             try:
@@ -237,26 +481,37 @@ class SearchableList(UserList):
             return items_found[0]
 
 
-def load_complete_app(podio, app_id):
-    url = f'https://api.podio.com/item/app/{app_id}/filter/'
+def load_complete_app(podio, app_id, view_id=None, filters=None, sort_by=None, sort_desc=None,
+                      fields=None, adaptive=False):
+    """
+    All the items of an app, or only the ones of a view or that match the filters.
+    See app_filter() for the parameters and iterate_resource_pages() for adaptive.
+    """
+    url, params = app_filter(app_id, view_id, filters, sort_by, sort_desc, fields)
 
     payload = SearchableList()
-    for item in iterate_resource(podio, url, 'POST', limit=250):
+    for item in iterate_resource(podio, url, 'POST', limit=250, params=params,
+                                 adaptive=adaptive):
         payload.append(Item(item))
 
     return payload
 
 
+def load_items(podio, app_id, item_ids, chunk_size=250, workers=4):
+    """Like load_complete_app(), but only for the given items, see fetch_items_by_id()."""
+    payload = SearchableList()
+    for item_data in fetch_items_by_id(podio, app_id, item_ids, chunk_size, workers):
+        payload.append(Item(item_data))
+    return payload
+
+
 def upload_file(podio, item_id, raw_data, new_file_name):
+    """
+    Upload raw_data (bytes or a binary file object) and attach it to an item, see
+    tetrapod.files.upload_and_attach(). Returns the new file_id.
+    """
+    from tetrapod.files import upload_and_attach
+    if isinstance(raw_data, (bytes, bytearray)):
+        raw_data = io.BytesIO(raw_data)
     log.info(f'Uploading and attaching file {new_file_name} to item {item_id}')
-    files = {'source': (new_file_name, raw_data, mimetypes.guess_type(new_file_name)[0])}
-    data = {'filename': new_file_name.encode('utf-8')}
-    upload_resp = podio.post('https://api.podio.com/file', data=data, files=files)
-    log.info(f"Upload response is: {upload_resp.status_code}, "
-             f"content(-repr): {repr(upload_resp.content)}")
-    upload_resp.raise_for_status()
-    new_file_id = upload_resp.json()['file_id']
-    attach_resp = podio.post('https://api.podio.com/file/%d/attach' % new_file_id,
-                             json={'ref_type': 'item', 'ref_id': item_id})
-    log.info(f"Attach response is: {attach_resp.status_code}, "
-             f"content(-repr): {repr(attach_resp.content)}")
\ No newline at end of file
+    return upload_and_attach(podio, item_id, raw_data, new_file_name)
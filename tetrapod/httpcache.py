@@ -0,0 +1,265 @@
+"""
+An opt-in cache for the GET responses of a PodioOAuth2Session.
+
+Metadata like app configurations, spaces or the user profile rarely changes, but
+scripts read it again and again. With the cache enabled, such responses are
+served from memory (LRU) or from an optional directory on disk while they are
+fresh. Stale responses with an ETag are revalidated with If-None-Match, so they
+only cost a 304 Not Modified.
+
+>>> from tetrapod.httpcache import ResponseCache
+>>> podio.enable_response_cache(ResponseCache(directory='.tetrapod_cache'))
+>>> podio.get('https://api.podio.com/app/1234/')   # from Podio
+>>> podio.get('https://api.podio.com/app/1234/')   # from the cache
+
+Only URLs that match one of the TTL patterns are cached (DEFAULT_TTLS by default).
+Any other request (PUT, POST, DELETE) drops the cached responses of its URL and
+its parent URLs.
+The entries of a session are kept under a namespace derived from its token (the
+client id and the user or app the token belongs to), so that several accounts can
+share the same cache directory.
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+log = logging.getLogger(__name__)
+
+# (regular expression for the URL path, seconds a response is fresh). The first
+# matching pattern wins. A TTL of 0 means: revalidate every time.
+DEFAULT_TTLS = [
+    (r'/app/\d+/?', 300),
+    (r'/app/space/\d+/?', 300),
+    (r'/space/\d+/?', 3600),
+    (r'/space/org/\d+/?', 3600),
+    (r'/org/?', 3600),
+    (r'/user/profile/?', 3600),
+    (r'/user/\d+/?', 3600),
+]
+
+# Header of responses that come from the cache: 'hit' or 'revalidated'
+CACHE_HEADER = 'X-Tetrapod-Cache'
+
+API_URL_RE = re.compile(r'^https?://[^/]+(?P<path>/[^?#]*)')
+
+
+def token_namespace(client_id: str, token: dict) -> str:
+    """
+    Cache namespace of a token: a hash of the client id and the user or app that the
+    token belongs to (the 'ref' of Podio tokens), or of the token itself without one.
+    """
+    token = token or {}
+    ref = token.get('ref') or {}
+    if ref.get('type') and ref.get('id'):
+        owner = '%s:%s' % (ref['type'], ref['id'])
+    else:
+        owner = token.get('refresh_token') or token.get('access_token') or ''
+    return hashlib.sha256(('%s %s' % (client_id, owner)).encode('utf-8')).hexdigest()[:16]
+
+
+class CachedResponse(object):
+
+    def __init__(self, url: str, status_code: int, headers: dict, content: bytes,
+                 stored_at: float):
+        self.url = url
+        self.status_code = status_code
+        self.headers = dict(headers)
+        self.content = content
+        self.stored_at = stored_at
+
+    @property
+    def etag(self):
+        return self.headers.get('ETag') or self.headers.get('etag')
+
+    def to_response(self, cache_status: str) -> requests.Response:
+        response = requests.Response()
+        response.status_code = self.status_code
+        response.url = self.url
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.headers[CACHE_HEADER] = cache_status
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.reason = 'OK'
+        response._content = self.content
+        return response
+
+    def to_json(self) -> dict:
+        return {
+            'url': self.url,
+            'status_code': self.status_code,
+            'headers': self.headers,
+            'content': base64.b64encode(self.content).decode('ascii'),
+            'stored_at': self.stored_at,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict):
+        return cls(data['url'], data['status_code'], data['headers'],
+                   base64.b64decode(data['content']), data['stored_at'])
+
+
+class ResponseCache(object):
+    """
+    :param ttls: List of (URL path regex, seconds) tuples, see DEFAULT_TTLS.
+    :param max_entries: Size of the in-memory LRU.
+    :param directory: Also keep the responses in this directory, so that they
+        survive the process (e.g. between runs of the tpod command).
+    """
+
+    def __init__(self, ttls: list = None, max_entries: int = 1024, directory: str = None):
+        self.ttls = [(re.compile('^' + pattern + '$'), ttl)
+                     for pattern, ttl in (DEFAULT_TTLS if ttls is None else ttls)]
+        self.max_entries = max_entries
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._entries = OrderedDict()
+        # Guards the entries and the counters, which are updated from several threads
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+    def ttl_for(self, url: str):
+        """Seconds the response of url stays fresh, None if it is not cached at all."""
+        match = API_URL_RE.match(url)
+        if not match:
+            return None
+        path = match.group('path')
+        for pattern, ttl in self.ttls:
+            if pattern.match(path):
+                return ttl
+        return None
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        if not self.directory:
+            return None
+        try:
+            with open(self._disk_path(key), mode='r') as fh:
+                entry = CachedResponse.from_json(json.load(fh))
+        except (OSError, ValueError, KeyError):
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key: str, entry: CachedResponse):
+        self._remember(key, entry)
+        if not self.directory:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, mode='w') as fh:
+                json.dump(entry.to_json(), fh)
+            os.replace(tmp_path, self._disk_path(key))
+        except OSError as err:
+            log.warning('Could not write the response cache: %r' % err)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _remember(self, key: str, entry: CachedResponse):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, url: str, namespace: str = None):
+        """
+        Drop the cached responses of url and of its parent paths, with any query
+        parameters. E.g. a change of https://api.podio.com/app/1/field/2 drops the
+        cached https://api.podio.com/app/1/.
+        """
+        prefix = namespace + ' ' if namespace else ''
+        base = prefix + url.split('?', 1)[0].rstrip('/') + '/'
+        with self._lock:
+            keys = [key for key in self._entries
+                    if base.startswith(key.split('?', 1)[0].rstrip('/') + '/')]
+            for key in keys:
+                del self._entries[key]
+        if not self.directory:
+            return
+        # The file names are hashes, so only the URLs without parameters can be found
+        parents = set(keys)
+        parts = base[len(prefix):].rstrip('/').split('/')
+        for i in range(3, len(parts) + 1):
+            parent = '/'.join(parts[:i])
+            if self.ttl_for(parent) is not None or self.ttl_for(parent + '/') is not None:
+                parents.update([prefix + parent, prefix + parent + '/'])
+        for key in parents:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.directory:
+            for name in os.listdir(self.directory):
+                if name.endswith('.json'):
+                    os.remove(os.path.join(self.directory, name))
+
+    def request(self, send, method: str, url: str, namespace: str = None, **kwargs):
+        """
+        Answer a request from the cache or with send(method, url, **kwargs), the
+        uncached request method of the session.
+
+        :param namespace: Keeps the entries of different users or apps apart, see
+            token_namespace().
+        """
+        if method.upper() != 'GET':
+            self.invalidate(url, namespace)
+            return send(method, url, **kwargs)
+        ttl = self.ttl_for(url)
+        if ttl is None or kwargs.get('stream'):
+            return send(method, url, **kwargs)
+
+        key = requests.Request('GET', url, params=kwargs.get('params')).prepare().url
+        if namespace:
+            key = namespace + ' ' + key
+        entry = self.get(key)
+        if entry is not None and time.time() - entry.stored_at < ttl:
+            with self._lock:
+                self.hits += 1
+            return entry.to_response('hit')
+
+        if entry is not None and entry.etag:
+            headers = dict(kwargs.get('headers') or {})
+            headers['If-None-Match'] = entry.etag
+            kwargs['headers'] = headers
+        response = send(method, url, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            with self._lock:
+                self.revalidations += 1
+            entry.stored_at = time.time()
+            self.put(key, entry)
+            return entry.to_response('revalidated')
+        with self._lock:
+            self.misses += 1
+        if response.status_code == 200:
+            # The content is stored decoded
+            headers = {name: value for name, value in response.headers.items()
+                       if name.lower() not in ('content-encoding', 'transfer-encoding',
+                                               'content-length')}
+            self.put(key, CachedResponse(response.url or url, 200, headers,
+                                         response.content, time.time()))
+        return response
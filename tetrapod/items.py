@@ -1,14 +1,40 @@
 import os
 import math
 import time
-import dateutil.parser
 import datetime
+import functools
 import logging
+import threading
+from collections import OrderedDict
 from collections.abc import Mapping
+from contextlib import contextmanager
 from decimal import Decimal
 from typing import Union
 log = logging.getLogger(__name__)
 
+PODIO_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_podio_datetime(value: str) -> datetime.datetime:
+    """
+    Parse a timestamp in Podio's format 'YYYY-MM-DD HH:MM:SS'. The result is the same as
+    strptime(value, PODIO_DATETIME_FORMAT), but uses the much faster fromisoformat()
+    for well-formed values and remembers recently parsed ones.
+    """
+    if len(value) == 19 and value[4] == '-' and value[7] == '-' and value[10] == ' ':
+        try:
+            return datetime.datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    return datetime.datetime.strptime(value, PODIO_DATETIME_FORMAT)
+
+
+def parse_podio_datetimes(values) -> list:
+    """Parse a batch (e.g. a column) of Podio timestamps, None values stay None."""
+    parse = parse_podio_datetime
+    return [None if value is None else parse(value) for value in values]
+
 
 class PodioFieldMediator(object):
     """
@@ -36,6 +62,14 @@ class PodioFieldMediator(object):
     def as_podio_dict(self, field):
         raise NotImplementedError()
 
+    def compile_fetch(self, field_param=None):
+        """
+        Return a callable fetch(field) that does the same as self.fetch(field, field_param).
+        Mediators override this to resolve the field_param once instead of on every call.
+        """
+        fetch = self.fetch
+        return lambda field: fetch(field, field_param)
+
 
 class EmbedMediator(PodioFieldMediator):
     """
@@ -180,11 +214,20 @@ class DateMediator(PodioFieldMediator):
           "start_date": "2018-10-15"
         }
     """
+    START_DT_PARAMS = ('start_datetime', 'startdatetime', 'start_dt', 'startdt', 'datetime')
+    END_DT_PARAMS = ('end_datetime', 'enddatetime', 'end_dt', 'enddt')
+
     def update(self, field, value, field_param=None):
         if isinstance(value, datetime.datetime):
-            start = value.strftime('%Y-%m-%d %H:%M:%S')
+            start = value.strftime(PODIO_DATETIME_FORMAT)
         if isinstance(value, str):
-            start = dateutil.parser.parse(value).strftime('%Y-%m-%d %H:%M:%S')
+            # ISO 8601 strings (including Podio's own format) don't need dateutil
+            try:
+                parsed = datetime.datetime.fromisoformat(value)
+            except ValueError:
+                import dateutil.parser
+                parsed = dateutil.parser.parse(value)
+            start = parsed.strftime(PODIO_DATETIME_FORMAT)
 
         return [{
             'start': start
@@ -198,24 +241,39 @@ class DateMediator(PodioFieldMediator):
         if field_param == 'start':
             for value in field.get('values', []):
                 return value['start']
-        if field_param in ['start_datetime', 'startdatetime', 'start_dt', 'startdt']:
+        if field_param in self.START_DT_PARAMS:
             for value in field.get('values', []):
                 date_str = value['start']
-                return datetime.datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
+                return parse_podio_datetime(date_str)
         if field_param == 'end':
             for value in field.get('values', []):
                 return value['end']
-        if field_param in ['end_datetime', 'enddatetime', 'end_dt', 'enddt']:
+        if field_param in self.END_DT_PARAMS:
             for value in field.get('values', []):
                 date_str = value['end']
-                return datetime.datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
-        if field_param == 'datetime':
-            for value in field.get('values', []):
-                date_str = value['start']
-                return datetime.datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
+                return parse_podio_datetime(date_str)
 
         return None
 
+    def compile_fetch(self, field_param=None):
+        if field_param in (None, 'start', 'end'):
+            key = field_param or 'start'
+
+            def fetch(field):
+                for value in field.get('values', ()):
+                    return value[key]
+                return None
+        elif field_param in self.START_DT_PARAMS or field_param in self.END_DT_PARAMS:
+            key = 'end' if field_param in self.END_DT_PARAMS else 'start'
+            def fetch(field):
+                for value in field.get('values', ()):
+                    return parse_podio_datetime(value[key])
+                return None
+        else:
+            def fetch(field):
+                return None
+        return fetch
+
     def as_podio_dict(self, field):
         for value in field.get('values', []):
             return {'start': value['start']}
@@ -292,6 +350,25 @@ class NumberMediator(PodioFieldMediator):
                 return float(Decimal(value['value']))
         return None
 
+    def compile_fetch(self, field_param=None):
+        if field_param is None:
+            def convert(value):
+                return f'{Decimal(value):.4f}'
+        elif field_param == 'int':
+            def convert(value):
+                return int(Decimal(value).to_integral())
+        elif field_param == 'float':
+            def convert(value):
+                return float(Decimal(value))
+        else:
+            return lambda field: None
+
+        def fetch(field):
+            for value in field.get('values', ()):
+                return convert(value['value'])
+            return None
+        return fetch
+
     def as_podio_dict(self, field):
         return self.fetch(field)
 
@@ -319,6 +396,17 @@ class TextMediator(PodioFieldMediator):
                     return value['value']
         return None
 
+    def compile_fetch(self, field_param=None):
+        if field_param is not None:
+            return lambda field: None
+
+        def fetch(field):
+            values = field.get('values')
+            if values:
+                return values[0]['value']
+            return None
+        return fetch
+
     def as_podio_dict(self, field):
         values = field.get('values')
         if values and len(values) > 0:
@@ -328,6 +416,60 @@ class TextMediator(PodioFieldMediator):
             return []
 
 
+class CategoryOptionIndex(object):
+    """The options of a category field, indexed by text and by id."""
+
+    def __init__(self, options: list):
+        self.options = options
+        self.size = len(options)
+        self.by_text = {}
+        self.by_id = {}
+        for opt in options:
+            self.by_text.setdefault(opt['text'], []).append(opt)
+            self.by_id.setdefault(opt['id'], []).append(opt)
+        # inactive options are not show to the user
+        self.choices = [(opt['id'], opt['text']) for opt in options if opt['status'] == 'active']
+        self.choices_dict = {text: opt_id for opt_id, text in self.choices}
+
+    def lookup(self, value) -> list:
+        if isinstance(value, str):
+            return self.by_text.get(value, [])
+        if isinstance(value, int):
+            return self.by_id.get(value, [])
+        return []
+
+
+# id(options list) -> CategoryOptionIndex. The index keeps a reference to the options
+# list, so the id cannot be reused by another list while the entry exists.
+_category_option_indexes = OrderedDict()
+_category_option_indexes_lock = threading.Lock()
+CATEGORY_OPTION_INDEX_SIZE = 256
+
+
+def get_category_option_index(field) -> CategoryOptionIndex:
+    """
+    The (cached) option index of a category field. A new app config means new options
+    lists and therefore a new index; options lists changed in place are detected by
+    their length, or call clear_category_option_indexes().
+    """
+    options = field['config']['settings']['options']
+    key = id(options)
+    index = _category_option_indexes.get(key)
+    if index is not None and index.options is options and index.size == len(options):
+        return index
+    index = CategoryOptionIndex(options)
+    with _category_option_indexes_lock:
+        _category_option_indexes[key] = index
+        while len(_category_option_indexes) > CATEGORY_OPTION_INDEX_SIZE:
+            _category_option_indexes.popitem(last=False)
+    return index
+
+
+def clear_category_option_indexes():
+    with _category_option_indexes_lock:
+        _category_option_indexes.clear()
+
+
 class CategoryMediator(PodioFieldMediator):
     """
     category:
@@ -345,19 +487,26 @@ class CategoryMediator(PodioFieldMediator):
           ]
     """
     def update(self, field, value: Union[str, int, list], field_param=None):
-        opts = field['config']['settings']['options']
+        """
+        value is the text or the id of an option, or a list of those for fields that
+        allow multiple choices.
+        """
+        index = get_category_option_index(field)
         selected_opts = []
-        
+
         # single values
         if isinstance(value, str) or isinstance(value, int):
             selected_values = [value]
-            
+        elif value is None:
+            selected_values = []
+        else:
+            selected_values = list(value)
+
         for val in selected_values:
-            for opt in opts:
-                if isinstance(val, str) and opt['text'] == val:
-                    selected_opts.append(opt)
-                if isinstance(val, int) and opt['id'] == value:
-                    selected_opts.append(opt)
+            opts = index.lookup(val)
+            if not opts:
+                log.warning('Category field %s has no option %r.' % (field.get('external_id'), val))
+            selected_opts.extend(opts)
 
         # Category field values are wrapped in a dictionary with a single key
         # named 'value' (see docstring of this class) – heaven only knows why.
@@ -365,15 +514,12 @@ class CategoryMediator(PodioFieldMediator):
         
     def fetch(self, field, field_param=None):
         if field_param == 'choices':
-            options = field['config']['settings']['options']
             # inactive options are not show to the user
-            return [(opt['id'], opt['text']) for opt in options if opt['status'] == 'active']
+            return list(get_category_option_index(field).choices)
         # The same as '__choices' but instead of a list of tuples it returns a dictionary
         # that contains the choices and choice ID numbers.
         elif field_param == 'choices_dict':
-            options = field['config']['settings']['options']
-            # inactive options are not show to the user
-            return {opt['text']: opt['id'] for opt in options if opt['status'] == 'active'}
+            return dict(get_category_option_index(field).choices_dict)
         elif field_param == 'active':
             val = field.get('values', [None])[0]
             if val is not None:
@@ -401,7 +547,22 @@ class CategoryMediator(PodioFieldMediator):
                 return val['value']['text']
             else:
                 return None
-                
+
+    def compile_fetch(self, field_param=None):
+        if field_param is None:
+            def fetch(field):
+                values = field.get('values')
+                if values is None:
+                    return None
+                return values[0]['value']['text']
+            return fetch
+        elif field_param == 'labels':
+            def fetch(field):
+                return [v['value']['text'] for v in field.get('values', ())
+                        if v.get('value') is not None]
+            return fetch
+        return super().compile_fetch(field_param)
+
     def as_podio_dict(self, field):
         return [v['value']['id'] for v in field.get('values', [])]
 
@@ -446,7 +607,7 @@ class CalculationMediator(PodioFieldMediator):
         # Dates are special
         if field['config']['settings'].get('return_type') == 'date':
             for value in field.get('values', []):
-                dt = datetime.datetime.strptime(value['start'], '%Y-%m-%d %H:%M:%S')
+                dt = parse_podio_datetime(value['start'])
                 if field_param == 'datetime':
                     return dt
                 else:
@@ -522,6 +683,128 @@ def find_mediator_class(field):
     return mediator_class
 
 
+def select_fields(app_config, external_ids=(), labels=()):
+    """
+    Pick fields of an app by external_id or by label, e.g. for load_from_app() and
+    export_app(). The external_ids may carry a field param, e.g. 'due-date__start_dt'.
+    :return: (list of field descriptors, list of column names). The columns are named
+        after the labels when the fields were picked by label.
+    """
+    if len(external_ids) > 0 and len(labels) > 0:
+        raise ValueError('labels and external_ids cannot be used at the same time.')
+    wanted = [(descriptor, split_descriptor_parts(descriptor)[0]) for descriptor in external_ids]
+    field_ids = []
+    column_labels = []
+    for field in app_config.get('fields', []):
+        if field.get('label') in labels:
+            field_ids.append(field['external_id'])
+            column_labels.append(field.get('label'))
+        for descriptor, external_id in wanted:
+            if external_id == field['external_id']:
+                field_ids.append(descriptor)
+                column_labels.append(descriptor)
+    return field_ids, column_labels
+
+
+def supported_fields(app_config) -> list:
+    """The external_ids of all the fields that tetrapod can read."""
+    field_ids = []
+    for field in app_config.get('fields', []):
+        try:
+            find_mediator_class(field)
+        except NotImplementedError:
+            log.warning('Skipping field %s of the unsupported type %s'
+                        % (field['external_id'], field['type']))
+            continue
+        field_ids.append(field['external_id'])
+    return field_ids
+
+
+class FieldProfiler(object):
+    """
+    Counts the calls of fetch_field(), update_field() and fetch_podio_dict() and
+    accumulates the time spent in them, per mediator class and field_param.
+
+    >>> from tetrapod.items import profile_fields
+    >>> with profile_fields() as profiler:
+    ...     rows = [[item[d] for d in descriptors] for item in items]
+    >>> print(profiler.report())
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (function name, mediator class name, field_param) -> [calls, seconds]
+        self.stats = {}
+
+    def record(self, function, mediator_class, field_param, elapsed):
+        key = (function, mediator_class.__name__ if mediator_class else '-', field_param)
+        with self._lock:
+            entry = self.stats.get(key)
+            if entry is None:
+                self.stats[key] = [1, elapsed]
+            else:
+                entry[0] += 1
+                entry[1] += elapsed
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+
+    def by_mediator(self) -> dict:
+        """Calls and seconds per mediator class, over all functions and field params."""
+        result = {}
+        with self._lock:
+            for (_, mediator, _), (calls, seconds) in self.stats.items():
+                entry = result.setdefault(mediator, [0, 0.0])
+                entry[0] += calls
+                entry[1] += seconds
+        return result
+
+    def report(self, limit=None) -> str:
+        """A table of the recorded calls, the most expensive first."""
+        with self._lock:
+            rows = sorted(self.stats.items(), key=lambda kv: kv[1][1], reverse=True)
+        if limit:
+            rows = rows[:limit]
+        lines = ['%-18s %-22s %-16s %10s %12s %12s' % (
+            'function', 'mediator', 'field_param', 'calls', 'total [s]', 'per call [us]')]
+        for (function, mediator, field_param), (calls, seconds) in rows:
+            lines.append('%-18s %-22s %-16s %10d %12.4f %12.2f' % (
+                function, mediator, field_param or '', calls, seconds, seconds / calls * 1e6))
+        return '\n'.join(lines)
+
+
+# The active FieldProfiler, None means profiling is off.
+_profiler = None
+
+
+def enable_profiling(profiler=None) -> FieldProfiler:
+    global _profiler
+    _profiler = profiler if profiler is not None else FieldProfiler()
+    return _profiler
+
+
+def disable_profiling():
+    global _profiler
+    _profiler = None
+
+
+@contextmanager
+def profile_fields(profiler=None):
+    """Profile the field access inside the with-block."""
+    global _profiler
+    previous = _profiler
+    profiler = enable_profiling(profiler)
+    try:
+        yield profiler
+    finally:
+        _profiler = previous
+
+
+if os.environ.get('TETRAPOD_PROFILE_FIELDS'):
+    enable_profiling()
+
+
 def fetch_field(field_descriptor, item_json, app_config=None):
     """
     Fetch the first value of a field - or None if the field is empty.
@@ -529,11 +812,15 @@ def fetch_field(field_descriptor, item_json, app_config=None):
     :param item_json: The JSON representation of the Podio item.
     :return: First value or None
     """
+    profiler = _profiler
+    start = time.perf_counter() if profiler is not None else 0.0
     external_id, field_param = split_descriptor_parts(field_descriptor)
 
     # Get the only the JSON part of the desired field
     field = get_field_from_podio_json_list(item_json, external_id, app_config)
     if not field:
+        if profiler is not None:
+            profiler.record('fetch_field', None, field_param, time.perf_counter() - start)
         return None
 
     # Find and instanciate the correct PodioFieldMediator for this kind of field.
@@ -541,10 +828,15 @@ def fetch_field(field_descriptor, item_json, app_config=None):
     mediator = mediator_class()
 
     # Use the mediator to get the actual data
-    return mediator.fetch(field, field_param)
+    result = mediator.fetch(field, field_param)
+    if profiler is not None:
+        profiler.record('fetch_field', mediator_class, field_param, time.perf_counter() - start)
+    return result
 
 
 def update_field(field_descriptor, new_value, item_json, app_config=None):
+    profiler = _profiler
+    start = time.perf_counter() if profiler is not None else 0.0
     external_id, field_param = split_descriptor_parts(field_descriptor)
 
     # Get the only the JSON part of the desired field
@@ -556,6 +848,8 @@ def update_field(field_descriptor, new_value, item_json, app_config=None):
 
     # Use the mediator to get the actual data
     actual = mediator.update(field, new_value, field_param)
+    if profiler is not None:
+        profiler.record('update_field', mediator_class, field_param, time.perf_counter() - start)
 
     for field in item_json['fields']:
         if field['external_id'] == field_descriptor:
@@ -579,6 +873,8 @@ def fetch_podio_dict(field_descriptor, item_json, app_config=None):
     :param item_json: The JSON representation of the Podio item.
     :return: First value or None
     """
+    profiler = _profiler
+    start = time.perf_counter() if profiler is not None else 0.0
     external_id, field_param = split_descriptor_parts(field_descriptor)
 
     # Get the only the JSON part of the desired field
@@ -591,7 +887,78 @@ def fetch_podio_dict(field_descriptor, item_json, app_config=None):
     mediator = mediator_class()
 
     # Use the mediator to get the actual data
-    return mediator.as_podio_dict(field)
+    result = mediator.as_podio_dict(field)
+    if profiler is not None:
+        profiler.record('fetch_podio_dict', mediator_class, field_param, time.perf_counter() - start)
+    return result
+
+
+class FieldAccessor(object):
+    """
+    fetch_field() for one descriptor, compiled against an app config: the field, its
+    mediator and the field_param are resolved once, so applying it to many items only
+    costs the search for the field in the item and one call.
+
+    >>> get_due_date = FieldAccessor('due-date__start_dt', app_config)
+    >>> due_dates = [get_due_date(item_data) for item_data in items]
+
+    Fields that are empty (and therefore missing from the item JSON) are handled
+    like fetch_field() does when it gets the app_config.
+    """
+
+    def __init__(self, field_descriptor, app_config):
+        external_id, field_param = split_descriptor_parts(field_descriptor)
+        if '_' in external_id:
+            external_id = external_id.replace('_', '-')
+        for field in app_config['fields']:
+            if field['external_id'] == external_id:
+                break
+        else:
+            raise KeyError('%s' % external_id)
+        self.field_descriptor = field_descriptor
+        self.external_id = external_id
+        self.field_param = field_param
+        self.field_config = field
+        self.mediator_class = find_mediator_class(field)
+        self.fetch = self.mediator_class().compile_fetch(field_param)
+
+    def __call__(self, item_json):
+        external_id = self.external_id
+        for field in item_json.get('fields', ()):
+            if field['external_id'] == external_id:
+                return self.fetch(field)
+        return self.fetch(self.field_config)
+
+
+def compile_accessor(field_descriptor, app_config) -> FieldAccessor:
+    return FieldAccessor(field_descriptor, app_config)
+
+
+class AccessorPlan(object):
+    """
+    Compiled accessors for a list of descriptors. Turns items into rows with one
+    dictionary lookup and one call per value:
+
+    >>> plan = AccessorPlan(['title', 'due-date__start_dt', 'status'], app_config)
+    >>> rows = [plan.row(item_data) for item_data in items]
+    """
+
+    def __init__(self, field_descriptors, app_config):
+        self.field_descriptors = list(field_descriptors)
+        self.accessors = [FieldAccessor(d, app_config) for d in self.field_descriptors]
+        self._steps = [(a.external_id, a.field_config, a.fetch) for a in self.accessors]
+
+    def row(self, item_json) -> list:
+        fields = {field['external_id']: field for field in item_json.get('fields', ())}
+        return [fetch(fields.get(external_id, config))
+                for external_id, config, fetch in self._steps]
+
+    def rows(self, items):
+        for item_json in items:
+            yield self.row(item_json)
+
+    def as_dict(self, item_json) -> dict:
+        return dict(zip(self.field_descriptors, self.row(item_json)))
 
 
 class BaseItem(Mapping):
@@ -0,0 +1,80 @@
+"""
+The JSON codec used for the items: API responses, the SQLite cache and the exports.
+
+Pages of 500 items are several MB of JSON, so decoding them is a good part of a
+download, and every item is encoded again for the cache. When orjson
+(https://github.com/ijl/orjson) is installed it is used: it decodes straight from
+the bytes of the response and encodes several times faster than the json module of
+the standard library, which is the fallback:
+
+    pip install orjson
+
+>>> from tetrapod import jsoncodec
+>>> jsoncodec.CODEC
+'orjson'
+>>> item_data = jsoncodec.response_json(resp)
+>>> text = jsoncodec.dumps(item_data)
+
+Both codecs produce the same compact text with dumps().
+use_codec('json') switches back to the standard library, e.g. for comparisons.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CODEC = None
+_loads = None
+_dumps = None
+
+
+def _orjson_dumps(obj, default=None) -> str:
+    # Datetimes go through default, like with the json module, instead of becoming
+    # RFC 3339 strings.
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+    return orjson.dumps(obj, default=default, option=option).decode('utf-8')
+
+
+def _json_dumps(obj, default=None) -> str:
+    # Compact, like orjson, so that the cached text doesn't depend on the codec
+    return json.dumps(obj, default=default, separators=(',', ':'), ensure_ascii=False)
+
+
+def use_codec(name: str = None):
+    """Use 'orjson' or 'json'; without a name the fastest one that is installed."""
+    global CODEC, _loads, _dumps
+    if name is None:
+        name = 'json' if orjson is None else 'orjson'
+    if name == 'orjson':
+        if orjson is None:
+            raise ImportError("orjson is not installed. Run 'pip install orjson' to install it.")
+        _loads, _dumps = orjson.loads, _orjson_dumps
+    elif name == 'json':
+        _loads, _dumps = json.loads, _json_dumps
+    else:
+        raise ValueError('Unknown JSON codec %r' % name)
+    CODEC = name
+
+
+def loads(data):
+    """Decode JSON from bytes or str."""
+    return _loads(data)
+
+
+def dumps(obj, default=None) -> str:
+    """Encode obj as compact JSON. default is called for objects that can't be encoded."""
+    return _dumps(obj, default)
+
+
+def response_json(resp):
+    """The decoded body of a response, like resp.json() but from the raw bytes."""
+    content = getattr(resp, 'content', None)
+    if not isinstance(content, (bytes, bytearray, memoryview, str)):
+        # Not a requests.Response, but something that behaves like one
+        return resp.json()
+    return _loads(content)
+
+
+use_codec()
@@ -0,0 +1,209 @@
+"""
+Metrics for the requests made through a PodioOAuth2Session.
+
+Record the requests of one block of work:
+
+>>> from tetrapod.metrics import record_metrics
+>>> with record_metrics(podio) as metrics:
+...     items = iterate_resource(podio, url)
+>>> print(metrics.summary())
+>>> print(metrics.to_openmetrics())
+
+Or keep recording for the whole lifetime of a session:
+
+>>> metrics = podio.enable_metrics()
+
+Collected are latency histograms per endpoint (URLs with their numeric IDs
+replaced by '{id}'), request counts per status code, retries, bytes sent and
+received, and the last seen X-Rate-Limit-* values.
+"""
+import re
+import threading
+
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+NUMERIC_SEGMENT_RE = re.compile(r'/\d+(?=/|$)')
+
+
+def endpoint_template(url: str) -> str:
+    """
+    Reduce a URL to its endpoint, e.g.
+    'https://api.podio.com/item/app/123/filter/?fields=x' -> '/item/app/{id}/filter/'
+    """
+    return NUMERIC_SEGMENT_RE.sub('/{id}', urlsplit(url).path) or '/'
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.counts[i] += 1
+                break
+
+    def cumulative_counts(self) -> list:
+        result = []
+        total = 0
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+
+class RequestMetrics(object):
+    """Thread-safe collection of request metrics."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # (method, endpoint) -> Histogram
+            self.latency = {}
+            # (method, endpoint, status code) -> count, status 0 means no response
+            self.requests = {}
+            # reason -> count
+            self.retries = {}
+            self.bytes_sent = 0
+            self.bytes_received = 0
+            self.rate_limit_limit = None
+            self.rate_limit_remaining = None
+            self.rate_limit_waits = 0
+
+    def record_response(self, method: str, url: str, response, elapsed: float):
+        endpoint = endpoint_template(url)
+        bytes_received = response.headers.get('Content-Length')
+        # Don't read the body of streamed responses that nobody has consumed yet.
+        if bytes_received is None and getattr(response, '_content_consumed', True):
+            bytes_received = len(response.content or b'')
+        body = getattr(getattr(response, 'request', None), 'body', None)
+        limit = response.headers.get('X-Rate-Limit-Limit')
+        remaining = response.headers.get('X-Rate-Limit-Remaining')
+        with self._lock:
+            self._observe(method, endpoint, response.status_code, elapsed)
+            self.bytes_received += int(bytes_received or 0)
+            self.bytes_sent += len(body) if body else 0
+            if limit is not None:
+                self.rate_limit_limit = int(limit)
+            if remaining is not None:
+                self.rate_limit_remaining = int(remaining)
+
+    def record_error(self, method: str, url: str, error: Exception, elapsed: float):
+        with self._lock:
+            self._observe(method, endpoint_template(url), 0, elapsed)
+
+    def record_retry(self, reason: str):
+        with self._lock:
+            self.retries[reason] = self.retries.get(reason, 0) + 1
+
+    def record_rate_limit_wait(self):
+        with self._lock:
+            self.rate_limit_waits += 1
+
+    def _observe(self, method, endpoint, status_code, elapsed):
+        key = (method.upper(), endpoint)
+        histogram = self.latency.get(key)
+        if histogram is None:
+            histogram = self.latency[key] = Histogram(self.buckets)
+        histogram.observe(elapsed)
+        req_key = (method.upper(), endpoint, status_code)
+        self.requests[req_key] = self.requests.get(req_key, 0) + 1
+
+    def count_status(self, low: int, high: int) -> int:
+        with self._lock:
+            return sum(count for (_, _, status), count in self.requests.items()
+                       if low <= status < high)
+
+    @property
+    def total_requests(self) -> int:
+        with self._lock:
+            return sum(self.requests.values())
+
+    def summary(self) -> dict:
+        """A compact overview, e.g. for logging at the end of a script."""
+        with self._lock:
+            endpoints = {}
+            for (method, endpoint), histogram in self.latency.items():
+                endpoints[f'{method} {endpoint}'] = {
+                    'count': histogram.count,
+                    'total_seconds': histogram.sum,
+                    'mean_seconds': histogram.sum / histogram.count if histogram.count else 0.0,
+                }
+            summary = {
+                'requests': sum(self.requests.values()),
+                'retries': sum(self.retries.values()),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'rate_limit_limit': self.rate_limit_limit,
+                'rate_limit_remaining': self.rate_limit_remaining,
+                'rate_limit_waits': self.rate_limit_waits,
+                'endpoints': endpoints,
+            }
+        summary['4xx'] = self.count_status(400, 500)
+        summary['5xx'] = self.count_status(500, 600)
+        return summary
+
+    def to_openmetrics(self, prefix: str = 'tetrapod') -> str:
+        """Export the metrics in the Prometheus / OpenMetrics text format."""
+        lines = []
+        with self._lock:
+            name = f'{prefix}_request_duration_seconds'
+            lines.append(f'# TYPE {name} histogram')
+            lines.append(f'# UNIT {name} seconds')
+            for (method, endpoint), histogram in sorted(self.latency.items()):
+                labels = f'method="{method}",endpoint="{endpoint}"'
+                for upper, count in zip(histogram.buckets, histogram.cumulative_counts()):
+                    lines.append(f'{name}_bucket{{{labels},le="{upper}"}} {count}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+            name = f'{prefix}_requests'
+            lines.append(f'# TYPE {name} counter')
+            for (method, endpoint, status), count in sorted(self.requests.items()):
+                lines.append(f'{name}_total{{method="{method}",endpoint="{endpoint}",'
+                             f'status="{status}"}} {count}')
+
+            name = f'{prefix}_retries'
+            lines.append(f'# TYPE {name} counter')
+            for reason, count in sorted(self.retries.items()):
+                lines.append(f'{name}_total{{reason="{reason}"}} {count}')
+
+            for name, value in ((f'{prefix}_bytes_sent', self.bytes_sent),
+                                (f'{prefix}_bytes_received', self.bytes_received),
+                                (f'{prefix}_rate_limit_waits', self.rate_limit_waits)):
+                lines.append(f'# TYPE {name} counter')
+                lines.append(f'{name}_total {value}')
+
+            for name, value in ((f'{prefix}_rate_limit_limit', self.rate_limit_limit),
+                                (f'{prefix}_rate_limit_remaining', self.rate_limit_remaining)):
+                if value is not None:
+                    lines.append(f'# TYPE {name} gauge')
+                    lines.append(f'{name} {value}')
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def record_metrics(session, metrics: RequestMetrics = None):
+    """Record the metrics of all requests made through the session inside the with-block."""
+    metrics = metrics if metrics is not None else RequestMetrics()
+    session.metrics_recorders.append(metrics)
+    try:
+        yield metrics
+    finally:
+        session.metrics_recorders.remove(metrics)
@@ -1,5 +1,3 @@
-import cgi
-import click
 import datetime
 import json
 import logging
@@ -7,12 +5,12 @@ import os
 import requests
 import requests.exceptions
 
-from time import sleep
+from time import monotonic, sleep
 from urllib.parse import parse_qs
 from oauthlib.oauth2 import MobileApplicationClient, TokenExpiredError
 from requests_oauthlib import OAuth2Session
-from http.server import BaseHTTPRequestHandler
-from http.server import HTTPServer
+
+from tetrapod import jsoncodec
 
 AUTHORIZATION_BASE_URL = 'https://podio.com/oauth/authorize'
 TOKEN_URL = 'https://podio.com/oauth/access_token'
@@ -32,6 +30,11 @@ else:
     # Ten percent is the default
     TETRAPOD_MINIMUM_RATE_LIMIT = 0.1
 
+# Send all API requests to another server, e.g. the fake Podio server in
+# tetrapod.fakeserver. Plain http:// URLs also need OAUTHLIB_INSECURE_TRANSPORT=1.
+PODIO_API_URL = 'https://api.podio.com'
+TETRAPOD_API_URL = os.environ.get('TETRAPOD_API_URL')
+
 
 def keep_running():
     return KEEP_RUNNING
@@ -42,46 +45,68 @@ class CouldNotAcquireToken(Exception):
     pass
 
 
-class OAuth2CallbackHandler(BaseHTTPRequestHandler):
-    # These two static members will be overwritten by a (dynamically generated) subclass
-    # of OAuth2CallbackHandler.
+_callback_handler_class = None
+
 
-    def do_GET(self):
-        """Respond to a GET request that contains the 'code'."""
-        if self.path == '/':
+def get_callback_handler_class():
+    """
+    The HTTP request handler for the OAuth2 callback of authorize(). It is created on
+    first use, so that only 'tpod init' pays for importing http.server.
+    """
+    global _callback_handler_class
+    if _callback_handler_class is not None:
+        return _callback_handler_class
+
+    from http.server import BaseHTTPRequestHandler
+
+    class OAuth2CallbackHandler(BaseHTTPRequestHandler):
+        # These two static members will be overwritten by a (dynamically generated) subclass
+        # of OAuth2CallbackHandler.
+
+        def do_GET(self):
+            """Respond to a GET request that contains the 'code'."""
+            if self.path == '/':
+                self.send_response(200)
+                self.send_header(b"Content-type", b"text/html")
+                self.end_headers()
+                with open(os.path.join(os.path.dirname(__file__), 'authpage.html'), mode='r') as fh:
+                    page = fh.readlines()
+                    for line in page:
+                        self.wfile.write(line.encode('utf-8'))
+            else:
+                self.send_response(200)
+                self.send_header(b"Content-type", b"application/json")
+                self.end_headers()
+                self.wfile.write(b'{"ok": true}')
+
+        def do_POST(self):
+            """Handle POST requests that contain the fragment code we get from Podio."""
+            # http://stackoverflow.com/questions/4233218/python-basehttprequesthandler-post-variables
+            content_len = int(self.headers.get('content-length', 0))
+            post_body = self.rfile.read(content_len)
+
+            # Respond
             self.send_response(200)
             self.send_header(b"Content-type", b"text/html")
             self.end_headers()
-            with open(os.path.join(os.path.dirname(__file__), 'authpage.html'), mode='r') as fh:
-                page = fh.readlines()
-                for line in page:
-                    self.wfile.write(line.encode('utf-8'))
-        else:
-            self.send_response(200)
-            self.send_header(b"Content-type", b"application/json")
-            self.end_headers()
-            self.wfile.write(b'{"ok": true}')
+            self.wfile.write(b'Done!')
+
+            # Store the credentials outside of this object so the main thread can access it.
+            global credentials
+            credentials = parse_qs(post_body.decode('utf-8'))
 
-    def do_POST(self):
-        """Handle POST requests that contain the fragment code we get from Podio."""
-        # http://stackoverflow.com/questions/4233218/python-basehttprequesthandler-post-variables
-        ctype, pdict = cgi.parse_header(self.headers['content-type'])
-        content_len = int(self.headers.get('content-length', 0))
-        post_body = self.rfile.read(content_len)
+            # Stop the server
+            global KEEP_RUNNING
+            KEEP_RUNNING = False
 
-        # Respond
-        self.send_response(200)
-        self.send_header(b"Content-type", b"text/html")
-        self.end_headers()
-        self.wfile.write(b'Done!')
+    _callback_handler_class = OAuth2CallbackHandler
+    return _callback_handler_class
 
-        # Store the credentials outside of this object so the main thread can access it.
-        global credentials
-        credentials = parse_qs(post_body.decode('utf-8'))
 
-        # Stop the server
-        global KEEP_RUNNING
-        KEEP_RUNNING = False
+def __getattr__(name):
+    if name == 'OAuth2CallbackHandler':
+        return get_callback_handler_class()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
 
 
 def MakeHandlerClass(client_id, client_secret=None):
@@ -92,7 +117,7 @@ def MakeHandlerClass(client_id, client_secret=None):
     :param client_secret: the Podio client secret
     :return: A HTTPRequestHandler subclass that can be used with http.server().
     """
-    class CustomHandler(OAuth2CallbackHandler):
+    class CustomHandler(get_callback_handler_class()):
         def __init__(self, *args, **kwargs):
             self.client_id = client_id
             super(CustomHandler, self).__init__(*args, **kwargs)
@@ -102,31 +127,107 @@ def MakeHandlerClass(client_id, client_secret=None):
 class PodioOAuth2Session(OAuth2Session):
     def __init__(self, client_id=None, client=None, auto_refresh_url=None,
             auto_refresh_kwargs=None, scope=None, redirect_uri=None, token=None,
-            state=None, token_updater=None, enable_robustness=False, **kwargs):
+            state=None, token_updater=None, enable_robustness=False, api_url=None,
+            token_manager=None, **kwargs):
         super(PodioOAuth2Session, self).__init__(
             client_id=client_id, client=client, auto_refresh_url=auto_refresh_url,
             auto_refresh_kwargs=auto_refresh_kwargs, scope=scope, redirect_uri=redirect_uri,
             token=token, state=state, token_updater=token_updater, **kwargs
         )
         self.enable_robustness = enable_robustness
+        self.api_url = (api_url or TETRAPOD_API_URL or PODIO_API_URL).rstrip('/')
+        # Callables hook(method, url, kwargs) called before every HTTP request ...
+        self.pre_request_hooks = []
+        # ... and hook(method, url, response, elapsed_seconds) after every response.
+        self.post_request_hooks = []
+        # tetrapod.metrics.RequestMetrics objects that record every request. Recorders
+        # are added and removed while other threads make requests, so it is only
+        # iterated over as a copy.
+        self.metrics_recorders = []
+        # tetrapod.httpcache.ResponseCache, None means no caching
+        self.response_cache = None
+        # tetrapod.tokens.TokenManager that keeps the token fresh, shared with other sessions
+        self.token_manager = token_manager
+        # Robust sessions wait for an hour when the rate limit is almost used up. A
+        # tetrapod.tokenpool.AppTokenPool switches to another token instead.
+        self.rate_limit_wait = True
+
+    def enable_response_cache(self, cache=None):
+        """Cache the GET responses of metadata endpoints. Returns the ResponseCache object."""
+        from tetrapod.httpcache import ResponseCache
+        self.response_cache = cache if cache is not None else ResponseCache()
+        return self.response_cache
+
+    def enable_metrics(self, metrics=None):
+        """Record the metrics of all following requests. Returns the RequestMetrics object."""
+        from tetrapod.metrics import RequestMetrics
+        metrics = metrics if metrics is not None else RequestMetrics()
+        self.metrics_recorders.append(metrics)
+        return metrics
+
+    def _send(self, method, url, **kwargs):
+        """Make one HTTP request, surrounded by the hooks and metrics."""
+        if self.token_manager is not None:
+            token = self.token_manager.get_token()
+            if token.get('access_token') != self.access_token:
+                self.token = dict(token)
+        for hook in self.pre_request_hooks:
+            hook(method, url, kwargs)
+        start = monotonic()
+        try:
+            response = super(PodioOAuth2Session, self).request(method, url, **kwargs)
+        except requests.exceptions.RequestException as err:
+            for recorder in list(self.metrics_recorders):
+                recorder.record_error(method, url, err, monotonic() - start)
+            raise
+        elapsed = monotonic() - start
+        for recorder in list(self.metrics_recorders):
+            recorder.record_response(method, url, response, elapsed)
+        for hook in self.post_request_hooks:
+            hook(method, url, response, elapsed)
+        return response
+
+    def _record_retry(self, reason):
+        for recorder in list(self.metrics_recorders):
+            recorder.record_retry(reason)
 
     def request(self, method, url, data=None, headers=None, withhold_token=False,
-                client_id=None, client_secret=None, **kwargs):
+                client_id=None, client_secret=None, retry_server_errors=True, **kwargs):
+        """
+        :param retry_server_errors: With robustness enabled, False returns 5xx responses
+            right away instead of retrying them, e.g. to retry with a smaller page.
+        """
+        if self.api_url != PODIO_API_URL and url.startswith(PODIO_API_URL):
+            url = self.api_url + url[len(PODIO_API_URL):]
+
+        if self.response_cache is not None:
+            from tetrapod.httpcache import token_namespace
+            token = self.token_manager.get_token() if self.token_manager is not None else self.token
+            return self.response_cache.request(
+                self._request, method, url, namespace=token_namespace(self.client_id, token),
+                data=data, headers=headers, withhold_token=withhold_token,
+                client_id=client_id, client_secret=client_secret,
+                retry_server_errors=retry_server_errors, **kwargs)
+        return self._request(method, url,
+                             data=data, headers=headers, withhold_token=withhold_token,
+                             client_id=client_id, client_secret=client_secret,
+                             retry_server_errors=retry_server_errors, **kwargs)
+
+    def _request(self, method, url, data=None, headers=None, withhold_token=False,
+                 client_id=None, client_secret=None, retry_server_errors=True, **kwargs):
         # the usual way of doing requests
         if not self.enable_robustness:
-            return super(PodioOAuth2Session, self) \
-                .request(method, url,
-                         data=data, headers=headers, withhold_token=withhold_token,
-                         client_id=client_id, client_secret=client_secret, **kwargs)
+            return self._send(method, url,
+                              data=data, headers=headers, withhold_token=withhold_token,
+                              client_id=client_id, client_secret=client_secret, **kwargs)
 
         # robust way that tries to deal with most of the data
         retry_counter = 5
         while True:
             try:
-                response = super(PodioOAuth2Session, self)\
-                    .request(method, url,
-                             data=data, headers=headers, withhold_token=withhold_token,
-                             client_id=client_id, client_secret=client_secret, **kwargs)
+                response = self._send(method, url,
+                                      data=data, headers=headers, withhold_token=withhold_token,
+                                      client_id=client_id, client_secret=client_secret, **kwargs)
             except requests.exceptions.ConnectionError as err:
                 log.warning('ConnectionError while trying to access the Podio API.')
                 # Connection error means we wait one second and try again.
@@ -134,6 +235,7 @@ class PodioOAuth2Session(OAuth2Session):
                 if retry_counter < 1:
                     raise err
                 else:
+                    self._record_retry('connection_error')
                     sleep(3.0)
                     continue
 
@@ -147,9 +249,12 @@ class PodioOAuth2Session(OAuth2Session):
                 limit = response.headers.get('X-Rate-Limit-Limit')
                 remaining = response.headers.get('X-Rate-Limit-Remaining')
                 # Less than x percent => wait one hour
-                if remaining and limit and int(remaining) / int(limit) < TETRAPOD_MINIMUM_RATE_LIMIT:
+                if self.rate_limit_wait and remaining and limit \
+                        and int(remaining) / int(limit) < TETRAPOD_MINIMUM_RATE_LIMIT:
                     log.warning('X-Rate-Limit-Remaining is less than %d percent.' % TETRAPOD_MINIMUM_RATE_LIMIT)
                     log.warning('Waiting one hour for Rate-Limit to return.')
+                    for recorder in list(self.metrics_recorders):
+                        recorder.record_rate_limit_wait()
                     for i in range(12):
                         sleep(300.0)
                         mins = int((3600 - (i*300)) / 60.0)
@@ -168,9 +273,12 @@ class PodioOAuth2Session(OAuth2Session):
                 return response
 
             if 500 <= response.status_code < 600:
+                if not retry_server_errors:
+                    return response
                 # Most likely, we have encountered a 504 Gateway timeout error.
                 retry_counter -= 1
                 log.warning('Response from URL "%s" with status code %d. Retrying in 3 seconds ...' % (url, response.status_code))
+                self._record_retry('status_%d' % response.status_code)
                 sleep(3.0)
                 continue
 
@@ -181,6 +289,9 @@ def authorize(client_id, client_secret=None):
     :param client_secret:
     :return:
     """
+    import click
+    from http.server import HTTPServer
+
     # The HTTP request handler stores the credentials in a module-global
     # variable, make sure it is clean.
     global credentials
@@ -222,11 +333,19 @@ def authorize(client_id, client_secret=None):
     return token
 
 
-def make_client(client_id, token, check=True, client_token=None, enable_robustness=False):
+def make_client(client_id, token, check=True, client_token=None, enable_robustness=False,
+                token_manager=None):
+    """
+    :param token_manager: A tetrapod.tokens.TokenManager that refreshes the token before
+        it expires and shares it with the other sessions of the same credentials file.
+    """
+    token = dict(token)
     expires_at = token.get('expires_at', None)
-    if expires_at != None:
-        expires_at_dt = datetime.datetime.utcfromtimestamp(expires_at)
-        token['expires_in'] = (expires_at_dt - datetime.datetime.utcnow()).total_seconds()
+    # With a token_manager, it keeps track of the expiry and refreshes the token.
+    if expires_at != None and token_manager is None:
+        expires_at_dt = datetime.datetime.fromtimestamp(expires_at, datetime.timezone.utc)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        token['expires_in'] = (expires_at_dt - now).total_seconds()
     #client = OAuth2Session(client_id, token=token)
     extra = {
         'client_id': client_id
@@ -234,9 +353,11 @@ def make_client(client_id, token, check=True, client_token=None, enable_robustne
     if client_token != None:
         extra['client_token'] = client_token
     
+    token_updater = token_manager.save if token_manager is not None else save_token
     client = PodioOAuth2Session(client_id, token=token, auto_refresh_url=REFRESH_URL,
-                                auto_refresh_kwargs=extra, token_updater=save_token,
-                                enable_robustness=enable_robustness)
+                                auto_refresh_kwargs=extra, token_updater=token_updater,
+                                enable_robustness=enable_robustness,
+                                token_manager=token_manager)
     if check is True:
         r = client.get('https://api.podio.com/user/profile/')
         r.raise_for_status()
@@ -250,7 +371,8 @@ def make_client(client_id, token, check=True, client_token=None, enable_robustne
     return client
 
 
-def make_app_auth_client(client_id, client_secret, app_id, app_token, robust=False):
+def fetch_app_auth_token(client_id, client_secret, app_id, app_token) -> dict:
+    """Authenticate as an app, see https://developers.podio.com/authentication/app_auth"""
     token_resp = requests.post(APP_AUTH_TOKEN_URL, data={
         "grant_type": "app",
         "app_id": "%s" % app_id,
@@ -259,21 +381,22 @@ def make_app_auth_client(client_id, client_secret, app_id, app_token, robust=Fal
         "client_secret": "%s" % client_secret,
     })
     token_resp.raise_for_status()
-    token = token_resp.json()
+    return jsoncodec.response_json(token_resp)
 
+
+def make_app_auth_client(client_id, client_secret, app_id, app_token, robust=False):
+    token = fetch_app_auth_token(client_id, client_secret, app_id, app_token)
     client = PodioOAuth2Session(client_id, token=token, enable_robustness=robust)
     return client
 
 
-def save_token(token):
-    with open('.tetrapod_credentials.json', mode='w') as fh:
-        expires_at = datetime.datetime.utcnow() \
-                     + datetime.timedelta(seconds=int(token.get('expires_in', 0)))
-        # strftime depends on the platform. Windows does not support the '%s' format for
-        # unix timestamps. Therefore we need to create our own unix timestamp here.
-        epoch = datetime.datetime(1970, 1, 1)
-        token['expires_at'] = int((expires_at - epoch).total_seconds())
-        json.dump(token, fh, indent=2, sort_keys=True)
+def save_token(token, token_filename=None):
+    """
+    Write the token to the credentials file, atomically and under a lock, see
+    tetrapod.tokens.TokenManager.
+    """
+    from tetrapod.tokens import DEFAULT_CREDENTIALS_FILE, get_token_manager
+    get_token_manager(token_filename or DEFAULT_CREDENTIALS_FILE).save(token)
 
 
 def load_token(token_filename=None):
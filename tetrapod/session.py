@@ -4,8 +4,6 @@ import time
 import datetime
 import logging
 
-from . import podio_auth
-
 log = logging.getLogger(__file__)
 
 
@@ -28,21 +26,64 @@ def try_environment_token():
     }
 
 
-def create_podio_session(credentials_file=None, credentials=None, check=True, robust=False):
+def create_response_cache(response_cache):
+    """
+    A ResponseCache from the response_cache argument of create_podio_session(): a
+    ResponseCache, True for an in-memory cache or the path of a cache directory. The
+    default comes from the environment variable TETRAPOD_RESPONSE_CACHE (a directory).
+    """
+    if response_cache is None:
+        response_cache = os.environ.get('TETRAPOD_RESPONSE_CACHE')
+    if not response_cache:
+        return None
+    from tetrapod.httpcache import ResponseCache
+    if isinstance(response_cache, ResponseCache):
+        return response_cache
+    if response_cache is True:
+        return ResponseCache()
+    return ResponseCache(directory=response_cache)
+
+
+def create_podio_session(credentials_file=None, credentials=None, check=True, robust=False,
+                         response_cache=None, client_secret=None):
+    """
+    :param client_secret: Used to refresh the token of the credentials file. Defaults
+        to the one stored in the file or the environment variable TETRAPOD_CLIENT_SECRET.
+    """
+    # Imported here, so that importing this module (e.g. for the tpod command) doesn't
+    # load requests and oauthlib before they are needed.
+    from tetrapod import podio_auth
     token = None
     if credentials is not None:
         token = credentials
     else:
         token = try_environment_token()
+    token_manager = None
     if token is None:
         log.info('Loading OAuth2 token from credentials file.')
-        if credentials_file is None:
-            token = podio_auth.load_token()
-        else:
-            token = podio_auth.load_token(credentials_file)
-    podio = podio_auth.make_client(token['client_id'], token, check=check, enable_robustness=robust)
+        # All sessions of one credentials file share its token and its refreshes.
+        from tetrapod.tokens import DEFAULT_CREDENTIALS_FILE, get_token_manager
+        token_manager = get_token_manager(credentials_file or DEFAULT_CREDENTIALS_FILE,
+                                          client_secret=client_secret)
+        token = token_manager.get_token()
+    podio = podio_auth.make_client(token['client_id'], token, check=check, enable_robustness=robust,
+                                   token_manager=token_manager)
+    cache = create_response_cache(response_cache)
+    if cache is not None:
+        podio.enable_response_cache(cache)
     return podio
 
 
 def create_app_auth_session(client_id:str, client_secret:str, app_id:int, app_token:str, robust=False):
+    from tetrapod import podio_auth
     return podio_auth.make_app_auth_client(client_id, client_secret, app_id, app_token, robust=robust)
+
+
+def create_app_auth_pool(credentials, robust=False):
+    """
+    A tetrapod.tokenpool.AppTokenPool for a list of (client_id, client_secret, app_id,
+    app_token) tuples, that spreads the requests over all their rate limits.
+    """
+    from tetrapod.tokenpool import AppCredentials, AppTokenPool
+    return AppTokenPool([c if isinstance(c, AppCredentials) else AppCredentials(*c)
+                         for c in credentials], robust=robust)
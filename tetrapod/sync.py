@@ -0,0 +1,447 @@
+"""
+Mirror several Podio apps into the SQLite cache at once.
+
+The items of every app are downloaded concurrently on a pool of threads. All the
+inserts are handed over to one single writer thread that owns the only sqlite3
+connection, because sqlite3 connections can not be shared freely between threads.
+
+Example:
+>>> from tetrapod.session import create_podio_session
+>>> from tetrapod.sync import MultiAppCacheBuilder
+>>> podio = create_podio_session(robust=True)
+>>> builder = MultiAppCacheBuilder(podio, 'database.sqlite3', workers=4)
+>>> builder.add_app(12345678, extra_fields=['title'], natural_key='title')
+>>> builder.add_app(23456789)
+>>> builder.run()
+>>> print(builder.summary())
+
+Incremental runs only download the items edited since a given time (add_app(since=...)).
+Deleted items are not returned by Podio then, so after the download the IDs of all
+the items of the app are listed (a cheap micro view) and the cached items that are
+gone are removed.
+A SyncCheckpoint records how far every app got, so that an interrupted run can be
+resumed; the `tpod sync` command is built on top of both.
+"""
+import json
+import logging
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from tetrapod.backends import utcnow_str
+from tetrapod.cache import CachedItemStorage
+from tetrapod.helpers import AdaptivePageSize, app_filter, iterate_resource_pages
+
+log = logging.getLogger(__name__)
+
+# Markers for the messages that the fetching threads send to the writer thread.
+_SETUP = 'setup'
+_ITEMS = 'items'
+_PRUNE = 'prune'
+_FINISH = 'finish'
+_FAILED = 'failed'
+
+
+class _WriterStopped(Exception):
+    """Raised in the fetching threads when the writer thread has given up."""
+
+
+class AppSyncProgress(object):
+    """Progress and throughput of the synchronisation of one Podio app."""
+
+    def __init__(self, app_id: int):
+        self.app_id = app_id
+        self.items_fetched = 0
+        self.items_written = 0
+        self.api_calls = 0
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        # Of an incremental sync: The items deleted in Podio or through the cache since
+        # the last sync
+        self.deleted_item_ids = []
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    @property
+    def elapsed(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return end - self.started_at
+
+    @property
+    def items_per_second(self) -> float:
+        elapsed = self.elapsed
+        if elapsed <= 0:
+            return 0.0
+        return self.items_written / elapsed
+
+    def as_dict(self) -> dict:
+        return {
+            'app_id': self.app_id,
+            'items_fetched': self.items_fetched,
+            'items_written': self.items_written,
+            'api_calls': self.api_calls,
+            'elapsed': self.elapsed,
+            'items_per_second': self.items_per_second,
+            'done': self.done,
+            'deleted_item_ids': self.deleted_item_ids,
+            'error': repr(self.error) if self.error else None,
+        }
+
+
+class SyncCheckpoint(object):
+    """
+    The state of the sync runs, kept in a JSON file:
+
+        {"run": {"id": "2024-01-31 02:00:00", "mode": "incremental", "finished": false},
+         "apps": {"12345": {"run": "2024-01-31 02:00:00", "status": "running",
+                            "started_at": "...", "offset": 900, "since": "...",
+                            "clear": false, "last_synced": "...", "error": null}}}
+
+    offset is the number of items of the app that are safely written in the current
+    run, last_synced is the (UTC) time the last successful sync of the app started.
+    The file is rewritten atomically after every change.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.data = {'run': None, 'apps': {}}
+        if os.path.exists(path):
+            with open(path, mode='r') as fh:
+                self.data = json.load(fh)
+
+    @property
+    def run(self):
+        return self.data.get('run')
+
+    @property
+    def run_unfinished(self) -> bool:
+        return self.run is not None and not self.run.get('finished')
+
+    def app(self, app_id: int) -> dict:
+        return dict(self.data['apps'].get(str(app_id), {}))
+
+    def start_run(self, mode: str):
+        with self._lock:
+            self.data['run'] = {'id': utcnow_str(), 'mode': mode, 'finished': False}
+            self._save()
+
+    def finish_run(self):
+        with self._lock:
+            self.data['run']['finished'] = True
+            self._save()
+
+    def app_started(self, app_id: int, since: str = None, clear: bool = False,
+                    started_at: str = None):
+        with self._lock:
+            state = self.data['apps'].setdefault(str(app_id), {})
+            run_id = self.run['id'] if self.run else None
+            # Apps resumed within the same run keep their start time and offset.
+            if state.get('run') != run_id or state.get('status') == 'done':
+                state.update(run=run_id, started_at=started_at or utcnow_str(), offset=0)
+            state.update(status='running', since=since, clear=clear, error=None)
+            self._save()
+
+    def page_done(self, app_id: int, offset: int):
+        with self._lock:
+            self.data['apps'][str(app_id)]['offset'] = offset
+            self._save()
+
+    def app_done(self, app_id: int):
+        with self._lock:
+            state = self.data['apps'][str(app_id)]
+            state.update(status='done', last_synced=state['started_at'])
+            self._save()
+
+    def app_failed(self, app_id: int, error: Exception):
+        with self._lock:
+            state = self.data['apps'].setdefault(str(app_id), {})
+            state.update(status='failed', error=repr(error))
+            self._save()
+
+    def _save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.checkpoint-')
+        with os.fdopen(fd, mode='w') as fh:
+            json.dump(self.data, fh, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+class MultiAppCacheBuilder(object):
+    """
+    Create local copies of many Podio apps in one SQLite database.
+
+    :param podio: A (preferably robust) PodioOAuth2Session that is shared by the
+        fetching threads.
+    :param database: The filename of the SQLite database. The writer thread opens
+        its own connection to it.
+    :param workers: How many apps are downloaded at the same time.
+    :param limit: Page size used for the Podio filter endpoint.
+    :param adaptive: Adapt the page size to every app instead, see
+        tetrapod.helpers.AdaptivePageSize.
+    :param progress_callback: Optional callable that receives an AppSyncProgress
+        object every time a page of items has been written.
+    :param checkpoint: Optional SyncCheckpoint that is updated after every written page.
+    :param reconcile: Remove the items that have been deleted in Podio at the end of
+        an incremental sync of an app. Costs one request per 500 items.
+    :param tombstone_days: Keep the tombstones of deleted items at least this many
+        days. Without it, the tombstones that are older than the previous sync of an
+        app are purged when an incremental sync of the app has finished: they have
+        been reported as deleted_item_ids before and no page downloaded since can
+        bring the items back.
+    """
+
+    def __init__(self, podio, database: str, workers: int = 4, limit: int = 300,
+                 progress_callback=None, checkpoint: SyncCheckpoint = None,
+                 adaptive: bool = False, reconcile: bool = True,
+                 tombstone_days: float = None):
+        self.podio = podio
+        self.database = database
+        self.workers = workers
+        self.limit = limit
+        self.adaptive = adaptive
+        self.reconcile = reconcile
+        self.tombstone_days = tombstone_days
+        self.progress_callback = progress_callback
+        self.checkpoint = checkpoint
+        self.apps = {}
+        self.progress = {}
+        self.started_at = None
+        self.finished_at = None
+        # Bounded, so that fast downloads can not fill up the memory while the
+        # writer is still busy.
+        self._queue = queue.Queue(maxsize=max(2, workers * 4))
+        # Set when the writer can't go on, the fetching threads stop then.
+        self._stop = threading.Event()
+        self._writer_error = None
+
+    def add_app(self, app_id: int, extra_fields: list = None, natural_key=None,
+                since: str = None, offset: int = 0, clear: bool = False):
+        """
+        :param since: Only download the items edited since this UTC time
+            ('%Y-%m-%d %H:%M:%S'), for incremental updates of the cache.
+        :param offset: Skip this many items, e.g. to resume an interrupted download.
+        :param clear: Remove the items cached so far before the new ones are written.
+        """
+        self.apps[int(app_id)] = {
+            'app_id': int(app_id),
+            'extra_fields': list(extra_fields or []),
+            'natural_key': natural_key,
+            'since': since,
+            'offset': offset,
+            'clear': clear,
+        }
+        self.progress[int(app_id)] = AppSyncProgress(int(app_id))
+
+    def run(self) -> dict:
+        """
+        Synchronise all the added apps and return the progress objects (by app_id).
+        Errors of single apps are kept in their progress objects; an error of the
+        writer itself (e.g. the database can't be opened) is raised.
+        """
+        self.started_at = time.monotonic()
+        self._stop.clear()
+        self._writer_error = None
+        writer = threading.Thread(target=self._write_loop, name='tetrapod-cache-writer')
+        writer.start()
+        futures = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(self._fetch_app, app) for app in self.apps.values()]
+        finally:
+            # The writer keeps draining the queue until it gets this, even after an error.
+            self._queue.put(None)
+            writer.join()
+        self.finished_at = time.monotonic()
+        if self._writer_error is not None:
+            raise self._writer_error
+        for future in futures:
+            future.result()
+        return self.progress
+
+    def summary(self) -> dict:
+        """Totals over all apps, e.g. to be logged at the end of a run."""
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        elapsed = end - self.started_at if self.started_at is not None else 0.0
+        items = sum(p.items_written for p in self.progress.values())
+        return {
+            'apps': len(self.progress),
+            'apps_failed': len([p for p in self.progress.values() if p.error]),
+            'items': items,
+            'api_calls': sum(p.api_calls for p in self.progress.values()),
+            'elapsed': elapsed,
+            'items_per_second': items / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def make_storage(self) -> CachedItemStorage:
+        """Called on the writer thread to create the storage that receives all the inserts."""
+        conn = sqlite3.connect(self.database)
+        return CachedItemStorage(conn, self.podio)
+
+    def _put(self, msg):
+        """Hand a message over to the writer, or raise _WriterStopped if it gave up."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(msg, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+        raise _WriterStopped()
+
+    def _fetch_app(self, app):
+        app_id = app['app_id']
+        progress = self.progress[app_id]
+        progress.started_at = time.monotonic()
+        # Taken before the first request, so that edits made during the download
+        # are picked up by the next incremental run.
+        self._put((_SETUP, app_id, utcnow_str()))
+        url = 'https://api.podio.com/item/app/%d/filter/' % app_id
+        # The offset is checkpointed after every page, so the order must not change
+        # between runs, or resuming would skip items.
+        params = {'sort_by': 'item_id', 'sort_desc': False}
+        if app['since']:
+            params['filters'] = {'last_edit_on': {'from': app['since']}}
+        offset = app['offset']
+        try:
+            page_size = AdaptivePageSize() if self.adaptive else False
+            for page in iterate_resource_pages(self.podio, url, limit=self.limit,
+                                               offset=offset, params=params, adaptive=page_size):
+                offset += len(page)
+                progress.api_calls += 1
+                progress.items_fetched += len(page)
+                self._put((_ITEMS, app_id, page, offset))
+            if app['since'] and self.reconcile:
+                self._put((_PRUNE, app_id, self._live_item_ids(app_id)))
+        except _WriterStopped:
+            raise
+        except Exception as err:
+            log.exception('Could not download the items of app %d' % app_id)
+            self._put((_FAILED, app_id, err))
+            return
+        self._put((_FINISH, app_id))
+
+    def _live_item_ids(self, app_id: int) -> list:
+        """The IDs of all the items of an app that exist in Podio."""
+        progress = self.progress[app_id]
+        url, params = app_filter(app_id, sort_by='item_id', sort_desc=False,
+                                 fields='items.view(micro)')
+        live_item_ids = []
+        for page in iterate_resource_pages(self.podio, url, limit=500, params=params):
+            progress.api_calls += 1
+            live_item_ids.extend(item['item_id'] for item in page)
+        return live_item_ids
+
+    def _write_loop(self):
+        try:
+            storage = self.make_storage()
+        except Exception as err:
+            log.exception('Could not open the cache database %s' % self.database)
+            self._writer_failed(err)
+            storage = None
+        natural_keys = {}
+        try:
+            while True:
+                msg = self._queue.get()
+                if msg is None:
+                    break
+                if storage is None:
+                    continue
+                try:
+                    self._write_message(storage, natural_keys, msg)
+                except Exception as err:
+                    log.exception('The cache writer failed')
+                    self._writer_failed(err)
+                    storage.backend.close()
+                    storage = None
+        finally:
+            if storage is not None:
+                storage.backend.close()
+
+    def _writer_failed(self, err):
+        if self._writer_error is None:
+            self._writer_error = err
+        self._stop.set()
+
+    def _write_message(self, storage, natural_keys, msg):
+        kind, app_id = msg[0], msg[1]
+        app = self.apps[app_id]
+        progress = self.progress[app_id]
+        # Once an app has failed, the rest of its messages are dropped.
+        if progress.error is not None:
+            return
+        try:
+            if kind == _SETUP:
+                natural_keys[app_id] = storage.setup_app_cache(
+                    app_id, app['extra_fields'], app['natural_key'])
+                if app['clear']:
+                    storage.clear_app_cache(app_id)
+                    storage.commit()
+                if self.checkpoint is not None:
+                    self.checkpoint.app_started(app_id, app['since'], app['clear'],
+                                                started_at=msg[2])
+            elif kind == _ITEMS:
+                page = storage.drop_tombstoned(app_id, msg[2])
+                for item_data in page:
+                    storage.insert_item_data_into_db(
+                        app_id, item_data, app['extra_fields'],
+                        natural_keys[app_id], commit=False)
+                storage.commit()
+                progress.items_written += len(page)
+                if self.checkpoint is not None:
+                    self.checkpoint.page_done(app_id, msg[3])
+                self._report(progress)
+            elif kind == _PRUNE:
+                removed = storage.remove_missing_items(app_id, msg[2], commit=False)
+                storage.commit()
+                if removed:
+                    log.info('App %d: removed %d items that were deleted in Podio'
+                             % (app_id, len(removed)))
+            elif kind == _FINISH:
+                storage.finish_app_cache(app_id, natural_keys[app_id])
+                if app['since']:
+                    # Deleted items are not returned by the filter endpoint
+                    progress.deleted_item_ids = storage.get_tombstones(app_id, app['since'])
+                purge_before = self._purge_tombstones_before(app)
+                if purge_before is not None:
+                    storage.purge_tombstones(app_id, purge_before)
+                progress.finished_at = time.monotonic()
+                if self.checkpoint is not None:
+                    self.checkpoint.app_done(app_id)
+                log.info('App %d synchronised: %d items, %d API calls, '
+                         '%.1f items/s' % (app_id, progress.items_written,
+                                           progress.api_calls,
+                                           progress.items_per_second))
+                self._report(progress)
+            elif kind == _FAILED:
+                raise msg[2]
+        except Exception as err:
+            log.error('Synchronisation of app %d failed: %r' % (app_id, err))
+            storage.rollback()
+            progress.error = err
+            if self.checkpoint is not None:
+                self.checkpoint.app_failed(app_id, err)
+            progress.finished_at = time.monotonic()
+            self._report(progress)
+
+    def _purge_tombstones_before(self, app):
+        """The tombstones of the app older than this can be purged, or None."""
+        cutoffs = []
+        if app['since']:
+            cutoffs.append(app['since'])
+        if self.tombstone_days is not None:
+            cutoffs.append(utcnow_str(days_ago=self.tombstone_days))
+        return min(cutoffs) if cutoffs else None
+
+    def _report(self, progress):
+        if self.progress_callback is not None:
+            self.progress_callback(progress)
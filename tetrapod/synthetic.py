@@ -0,0 +1,161 @@
+"""
+Generators for synthetic Podio app configurations and items.
+
+The generated JSON has the same shape as the responses of the Podio API
+(GET /app/{app_id}/ and POST /item/app/{app_id}/filter/), so it can be used to
+test and benchmark tetrapod without access to Podio.
+
+Example:
+>>> from tetrapod.synthetic import make_app_config, make_items
+>>> app_config = make_app_config(1234, num_fields=20)
+>>> for item_data in make_items(app_config, 1000):
+...     print(item_data['item_id'])
+
+The field types rotate through the types that have a mediator in tetrapod.items.
+Field external_ids look like 'text-0', 'number-1', 'date-2' etc. The first field
+('text-0') works as the title: its value is 'Item <app_item_id>', unique per app.
+"""
+import datetime
+import random
+
+FIELD_TYPES = ['text', 'number', 'date', 'category', 'app', 'email', 'calculation', 'embed']
+
+CATEGORY_OPTIONS = ['Entered', 'Accepted', 'Rejected', 'On hold', 'Done']
+
+WORDS = ['bow', 'boat', 'stern', 'anchor', 'sail', 'mast', 'keel', 'deck', 'hull', 'rudder']
+
+BASE_DATE = datetime.datetime(2018, 1, 1)
+
+
+def make_field_config(field_id: int, field_type: str, external_id: str, label: str,
+                      num_options: int = len(CATEGORY_OPTIONS)) -> dict:
+    settings = {}
+    if field_type == 'text':
+        settings = {'format': 'plain', 'size': 'small'}
+    elif field_type == 'category':
+        settings = {
+            'multiple': False,
+            'options': [{
+                'status': 'active',
+                'text': CATEGORY_OPTIONS[i] if i < len(CATEGORY_OPTIONS) else 'Option %d' % (i + 1),
+                'id': i + 1,
+                'color': 'DCEBD8',
+            } for i in range(num_options)],
+        }
+    elif field_type == 'calculation':
+        settings = {'return_type': 'text', 'script': '"Hello"'}
+    elif field_type == 'app':
+        settings = {'multiple': True, 'referenced_apps': []}
+    return {
+        'field_id': field_id,
+        'type': field_type,
+        'external_id': external_id,
+        'label': label,
+        'status': 'active',
+        'config': {
+            'label': label,
+            'description': None,
+            'delta': field_id,
+            'required': False,
+            'mapping': None,
+            'hidden_create_view_edit': False,
+            'settings': settings,
+        },
+    }
+
+
+def make_app_config(app_id: int, num_fields: int = 10, field_types: list = None,
+                    num_options: int = len(CATEGORY_OPTIONS)) -> dict:
+    """Create the configuration of an app with num_fields fields."""
+    field_types = field_types or FIELD_TYPES
+    fields = []
+    for i in range(num_fields):
+        field_type = field_types[i % len(field_types)]
+        fields.append(make_field_config(
+            app_id * 1000 + i, field_type, f'{field_type}-{i}', f'{field_type.title()} {i}',
+            num_options=num_options))
+    return {
+        'app_id': app_id,
+        'space_id': 1,
+        'url_label': f'app-{app_id}',
+        'config': {'name': f'App {app_id}', 'item_name': 'Item'},
+        'fields': fields,
+    }
+
+
+def make_field_value(field: dict, rng: random.Random) -> list:
+    field_type = field['type']
+    if field_type == 'text':
+        return [{'value': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 6)))}]
+    elif field_type == 'number':
+        return [{'value': '%.4f' % (rng.random() * 10000)}]
+    elif field_type == 'date':
+        start = BASE_DATE + datetime.timedelta(minutes=rng.randint(0, 60 * 24 * 365 * 3))
+        end = start + datetime.timedelta(hours=rng.randint(1, 48))
+        return [{
+            'start': start.strftime('%Y-%m-%d %H:%M:%S'),
+            'start_date': start.strftime('%Y-%m-%d'),
+            'start_time': start.strftime('%H:%M:%S'),
+            'end': end.strftime('%Y-%m-%d %H:%M:%S'),
+            'end_date': end.strftime('%Y-%m-%d'),
+            'end_time': end.strftime('%H:%M:%S'),
+        }]
+    elif field_type == 'category':
+        return [{'value': rng.choice(field['config']['settings']['options'])}]
+    elif field_type == 'app':
+        return [{'value': {'item_id': rng.randint(1, 10 ** 9), 'title': rng.choice(WORDS)}}]
+    elif field_type == 'email':
+        return [{'type': 'work', 'value': '%s@example.com' % rng.choice(WORDS)}]
+    elif field_type == 'calculation':
+        return [{'value': 'Hello, %s' % rng.choice(WORDS)}]
+    elif field_type == 'embed':
+        return [{'embed': {'url': 'https://example.com/%s' % rng.choice(WORDS)}, 'file': None}]
+    return []
+
+
+def make_item(app_config: dict, item_id: int, rng: random.Random,
+              fill_rate: float = 1.0) -> dict:
+    """
+    Create the JSON of one item of the app. fill_rate is the chance that a field
+    has a value (Podio leaves empty fields out of the item JSON).
+    """
+    app_id = app_config['app_id']
+    app_item_id = item_id - app_id * 10 ** 6
+    fields = []
+    for index, field in enumerate(app_config['fields']):
+        if index == 0 and field['type'] == 'text':
+            values = [{'value': 'Item %d' % app_item_id}]
+        elif fill_rate < 1.0 and rng.random() > fill_rate:
+            continue
+        else:
+            values = make_field_value(field, rng)
+        fields.append({
+            'field_id': field['field_id'],
+            'type': field['type'],
+            'external_id': field['external_id'],
+            'label': field['label'],
+            'status': field['status'],
+            'config': field['config'],
+            'values': values,
+        })
+    return {
+        'item_id': item_id,
+        'app_item_id': app_item_id,
+        'title': 'Item %d' % app_item_id,
+        'link': f'https://podio.com/demo/{app_config["url_label"]}/apps/items/{app_item_id}',
+        'app': {'app_id': app_id},
+        'created_on': BASE_DATE.strftime('%Y-%m-%d %H:%M:%S'),
+        'last_event_on': BASE_DATE.strftime('%Y-%m-%d %H:%M:%S'),
+        'fields': fields,
+    }
+
+
+def make_items(app_config: dict, num_items: int, seed: int = 0, fill_rate: float = 1.0):
+    """
+    Generate num_items items of the app. The item IDs are app_id * 10^6 + 1, + 2 ...
+    The same seed always produces the same items.
+    """
+    rng = random.Random(seed)
+    first_item_id = app_config['app_id'] * 10 ** 6 + 1
+    for item_id in range(first_item_id, first_item_id + num_items):
+        yield make_item(app_config, item_id, rng, fill_rate=fill_rate)
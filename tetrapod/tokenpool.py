@@ -0,0 +1,264 @@
+"""
+A pool of app-auth sessions that spreads the requests over several access tokens.
+
+Podio counts the rate limit per access token. Jobs that touch many apps (or use
+several API keys for the same app) can authenticate once per app token and let
+the pool send every request with the token that has the most requests left, as
+reported by the X-Rate-Limit-Remaining header of its last response.
+
+>>> from tetrapod.tokenpool import AppCredentials, AppTokenPool
+>>> pool = AppTokenPool([
+...     AppCredentials(client_id, client_secret, 12345678, 'app token 1'),
+...     AppCredentials(other_client_id, other_client_secret, 12345678, 'app token 1'),
+...     AppCredentials(client_id, client_secret, 23456789, 'app token 2'),
+... ], robust=True)
+>>> items = iterate_resource(pool, 'https://api.podio.com/item/app/12345678/filter/')
+>>> item = pool.for_app(23456789).get('https://api.podio.com/item/%d' % item_id).json()
+
+An app token only gives access to its own app. The pool takes the app_id from
+URLs like /item/app/{app_id}/... or /app/{app_id}/...; for all other URLs (e.g.
+/item/{item_id}) use for_app(), otherwise any token of the pool is used.
+Tokens are fetched again shortly before they expire or when Podio answers with
+401. When Podio answers with 420 (rate limit reached), the request is repeated
+with the next token of the app.
+"""
+import logging
+import math
+import re
+import threading
+import time
+
+from time import monotonic, sleep
+
+from tetrapod.tokens import DEFAULT_REFRESH_MARGIN, with_expires_at
+
+log = logging.getLogger(__name__)
+
+APP_URL_RE = re.compile(r'/app/(\d+)(?:/|$)')
+
+RATE_LIMIT_STATUS = 420
+
+
+def app_id_from_url(url: str):
+    """The app_id in URLs like /item/app/{app_id}/filter/, None for other URLs."""
+    match = APP_URL_RE.search(url.split('?', 1)[0])
+    return int(match.group(1)) if match else None
+
+
+class AppCredentials(object):
+
+    def __init__(self, client_id: str, client_secret: str, app_id: int, app_token: str):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.app_id = int(app_id)
+        self.app_token = app_token
+
+
+class PooledSession(object):
+    """One token of the pool, its session and what we know about its rate limit."""
+
+    def __init__(self, credentials: AppCredentials):
+        self.credentials = credentials
+        self.session = None
+        self.expires_at = None
+        self.limit = None
+        self.remaining = None
+        self.updated_at = None
+        self.in_flight = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def app_id(self) -> int:
+        return self.credentials.app_id
+
+    def budget(self, window: float) -> float:
+        """Requests left, minus the ones on their way. Unknown budgets come first."""
+        if self.remaining is None or monotonic() - self.updated_at >= window:
+            return math.inf
+        return self.remaining - self.in_flight
+
+    def as_dict(self) -> dict:
+        return {
+            'app_id': self.app_id,
+            'client_id': self.credentials.client_id,
+            'limit': self.limit,
+            'remaining': self.remaining,
+            'requests': self.requests,
+        }
+
+
+class AppTokenPool(object):
+    """
+    :param credentials: AppCredentials, any number per app.
+    :param robust: Use robust sessions (retries on 5xx and connection errors). When
+        every token of an app is almost out of requests, the pool waits for the rate
+        limit window to pass, like a single robust session does.
+    :param refresh_margin: Seconds before the expiry of a token at which it is renewed.
+    :param rate_limit_window: Seconds after which Podio has reset the rate limit.
+    :param token_func: Callable(client_id, client_secret, app_id, app_token) -> token,
+        tetrapod.podio_auth.fetch_app_auth_token() by default.
+    """
+
+    def __init__(self, credentials, robust: bool = False,
+                 refresh_margin: float = DEFAULT_REFRESH_MARGIN,
+                 rate_limit_window: float = 3600.0, token_func=None, api_url: str = None):
+        self.entries = [PooledSession(c) for c in credentials]
+        if not self.entries:
+            raise ValueError('The pool needs at least one app token.')
+        self.robust = robust
+        self.refresh_margin = refresh_margin
+        self.rate_limit_window = rate_limit_window
+        self.api_url = api_url
+        if token_func is None:
+            from tetrapod.podio_auth import fetch_app_auth_token
+            token_func = fetch_app_auth_token
+        self.token_func = token_func
+        self._lock = threading.Lock()
+
+    @property
+    def enable_robustness(self) -> bool:
+        return self.robust
+
+    @property
+    def app_ids(self) -> list:
+        return sorted(set(entry.app_id for entry in self.entries))
+
+    def _candidates(self, app_id=None, exclude=()) -> list:
+        candidates = [e for e in self.entries if app_id is None or e.app_id == app_id]
+        if not candidates:
+            raise KeyError('No app token for app %d in the pool.' % app_id)
+        return [e for e in candidates if e not in exclude]
+
+    def _pick(self, app_id=None, exclude=()):
+        """The entry with the biggest budget (None if all are excluded), marked as in use."""
+        from tetrapod.podio_auth import TETRAPOD_MINIMUM_RATE_LIMIT
+        while True:
+            with self._lock:
+                candidates = self._candidates(app_id, exclude)
+                if not candidates:
+                    return None
+                best = max(candidates, key=lambda e: e.budget(self.rate_limit_window))
+                budget = best.budget(self.rate_limit_window)
+                if not self.robust or not best.limit or budget == math.inf \
+                        or budget / best.limit >= TETRAPOD_MINIMUM_RATE_LIMIT:
+                    best.in_flight += 1
+                    return best
+            log.warning('All tokens of the pool are almost out of requests, waiting 5 minutes.')
+            sleep(300.0)
+
+    def _session(self, entry: PooledSession, force_new_token: bool = False):
+        with entry.lock:
+            expires_soon = entry.expires_at is not None and \
+                float(entry.expires_at) - time.time() < self.refresh_margin
+            if entry.session is None or expires_soon or force_new_token:
+                c = entry.credentials
+                log.info('Authenticating as app %d' % c.app_id)
+                token = with_expires_at(self.token_func(c.client_id, c.client_secret,
+                                                        c.app_id, c.app_token))
+                entry.expires_at = token.get('expires_at')
+                if entry.session is None:
+                    from tetrapod.podio_auth import PodioOAuth2Session
+                    session = PodioOAuth2Session(c.client_id, token=token,
+                                                 enable_robustness=self.robust,
+                                                 api_url=self.api_url)
+                    session.rate_limit_wait = False
+                    session.post_request_hooks.append(
+                        lambda method, url, response, elapsed: self._update_budget(entry, response))
+                    entry.session = session
+                else:
+                    entry.session.token = token
+            return entry.session
+
+    def _update_budget(self, entry: PooledSession, response):
+        limit = response.headers.get('X-Rate-Limit-Limit')
+        remaining = response.headers.get('X-Rate-Limit-Remaining')
+        with self._lock:
+            entry.requests += 1
+            if response.status_code == RATE_LIMIT_STATUS:
+                entry.remaining = 0
+                entry.updated_at = monotonic()
+            elif remaining is not None:
+                entry.remaining = int(remaining)
+                entry.limit = int(limit) if limit is not None else entry.limit
+                entry.updated_at = monotonic()
+
+    def request(self, method, url, app_id: int = None, **kwargs):
+        """Like PodioOAuth2Session.request(), sent with the best token for app_id or the URL."""
+        if app_id is None:
+            app_id = app_id_from_url(url)
+        tried = []
+        response = None
+        while True:
+            entry = self._pick(app_id, exclude=tried)
+            if entry is None:
+                # Every token got a 420, return the last one.
+                return response
+            try:
+                response = self._session(entry).request(method, url, **kwargs)
+                if response.status_code == 401:
+                    log.info('Token of app %d was rejected, authenticating again.' % entry.app_id)
+                    response = self._session(entry, force_new_token=True).request(
+                        method, url, **kwargs)
+            finally:
+                with self._lock:
+                    entry.in_flight -= 1
+            if response.status_code != RATE_LIMIT_STATUS:
+                return response
+            log.warning('Rate limit of a token of app %d reached, trying the next token.'
+                        % entry.app_id)
+            tried.append(entry)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request('POST', url, data=data, json=json, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('PUT', url, data=data, **kwargs)
+
+    def patch(self, url, data=None, **kwargs):
+        return self.request('PATCH', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def for_app(self, app_id: int) -> 'AppTokenPoolView':
+        """The part of the pool that can access app_id, usable like a session."""
+        self._candidates(int(app_id))
+        return AppTokenPoolView(self, int(app_id))
+
+    def summary(self) -> list:
+        with self._lock:
+            return [entry.as_dict() for entry in self.entries]
+
+
+class AppTokenPoolView(object):
+    """The tokens of one app of an AppTokenPool, usable like a session."""
+
+    def __init__(self, pool: AppTokenPool, app_id: int):
+        self.pool = pool
+        self.app_id = app_id
+
+    @property
+    def enable_robustness(self) -> bool:
+        return self.pool.robust
+
+    def request(self, method, url, **kwargs):
+        return self.pool.request(method, url, app_id=self.app_id, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request('POST', url, data=data, json=json, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('PUT', url, data=data, **kwargs)
+
+    def patch(self, url, data=None, **kwargs):
+        return self.request('PATCH', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
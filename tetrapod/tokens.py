@@ -0,0 +1,220 @@
+"""
+Shared OAuth2 tokens for many sessions, threads and processes.
+
+A TokenManager owns the token of one credentials file. All the sessions that use
+the same file share one manager (see get_token_manager()), so a refresh done for
+one of them is seen by all of them:
+
+>>> from tetrapod.tokens import get_token_manager
+>>> manager = get_token_manager('.tetrapod_credentials.json')
+>>> podio = make_client(client_id, manager.get_token(), token_manager=manager)
+
+The token is refreshed before it expires (refresh_margin), not after a request
+failed. Only one thread refreshes at a time, the others wait and then use the
+new token. Between processes the same is done with a lock file: a process that
+gets the lock after another one refreshed finds the new token in the file and
+doesn't refresh again. The file itself is replaced atomically.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+
+from tetrapod import jsoncodec
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CREDENTIALS_FILE = '.tetrapod_credentials.json'
+
+# Podio's token endpoint, also used for the refresh_token grant
+TOKEN_REFRESH_URL = 'https://podio.com/oauth/token'
+
+# Refresh the token when it expires in less than this many seconds
+DEFAULT_REFRESH_MARGIN = 300
+
+
+@contextmanager
+def file_lock(path: str):
+    """An exclusive lock on path (created if needed) across processes."""
+    fh = open(path, mode='a+')
+    try:
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None
+        if fcntl is not None:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        else:
+            import msvcrt
+            fh.seek(0)
+            # Blocks (retrying for 10 seconds at a time) until the lock is free.
+            while True:
+                try:
+                    msvcrt.locking(fh.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        yield
+    finally:
+        # Closing the file releases the lock
+        fh.close()
+
+
+def with_expires_at(token: dict) -> dict:
+    """The token with an absolute 'expires_at' (unix time), computed from 'expires_in'."""
+    token = dict(token)
+    if token.get('expires_in') is not None:
+        token['expires_at'] = int(time.time() + float(token['expires_in']))
+    return token
+
+
+def refresh_podio_token(token: dict, client_secret: str = None) -> dict:
+    """Get a new access token from Podio with the refresh_token of token."""
+    import requests
+    data = {
+        'grant_type': 'refresh_token',
+        'client_id': token['client_id'],
+        'refresh_token': token['refresh_token'],
+    }
+    if client_secret:
+        data['client_secret'] = client_secret
+    resp = requests.post(TOKEN_REFRESH_URL, data=data)
+    resp.raise_for_status()
+    new_token = jsoncodec.response_json(resp)
+    new_token.setdefault('client_id', token['client_id'])
+    new_token.setdefault('refresh_token', token['refresh_token'])
+    return new_token
+
+
+class TokenManager(object):
+    """
+    :param path: The credentials file, e.g. written by 'tpod init'.
+    :param refresh_margin: Seconds before the expiry at which the token is refreshed.
+    :param refresh_func: Callable(token) -> new token, refresh_podio_token() by default.
+    :param client_secret: Sent along with the refresh_token grant. Defaults to the
+        'client_secret' of the credentials file or the environment variable
+        TETRAPOD_CLIENT_SECRET.
+    :param retry_delay: Seconds to wait before trying again after a failed refresh.
+        Until the token has really expired it is still used in the meantime.
+    """
+
+    def __init__(self, path: str = DEFAULT_CREDENTIALS_FILE,
+                 refresh_margin: float = DEFAULT_REFRESH_MARGIN, refresh_func=None,
+                 client_secret: str = None, retry_delay: float = 30.0):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.refresh_margin = refresh_margin
+        self.client_secret = client_secret
+        self.refresh_func = refresh_func or (
+            lambda token: refresh_podio_token(token, self.secret_for(token)))
+        self.retry_delay = retry_delay
+        self._token = None
+        self._retry_at = None
+        self._refresh_lock = threading.Lock()
+        self.refreshes = 0
+
+    def _load(self) -> dict:
+        with open(self.path, mode='r') as fh:
+            return json.load(fh)
+
+    def _write(self, token: dict):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tetrapod-token-')
+        try:
+            with os.fdopen(fd, mode='w') as fh:
+                json.dump(token, fh, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def secret_for(self, token: dict):
+        """The client secret to refresh token with, or None."""
+        return self.client_secret or token.get('client_secret') \
+            or os.environ.get('TETRAPOD_CLIENT_SECRET')
+
+    def needs_refresh(self, token: dict) -> bool:
+        expires_at = token.get('expires_at')
+        if expires_at is None or not token.get('refresh_token'):
+            return False
+        return float(expires_at) - time.time() < self.refresh_margin
+
+    @staticmethod
+    def expired(token: dict) -> bool:
+        expires_at = token.get('expires_at')
+        return expires_at is not None and float(expires_at) <= time.time()
+
+    def _usable(self, token) -> bool:
+        if token is None:
+            return False
+        if not self.needs_refresh(token):
+            return True
+        # A refresh failed a moment ago, keep using the token while it is still valid.
+        return self._retry_at is not None and time.monotonic() < self._retry_at \
+            and not self.expired(token)
+
+    def get_token(self) -> dict:
+        """
+        The current token, refreshed first if it is about to expire. If the refresh
+        fails, the old token is returned for as long as it is still valid.
+        """
+        token = self._token
+        if self._usable(token):
+            return token
+        with self._refresh_lock:
+            # Another thread may have done the work while we were waiting.
+            token = self._token
+            if self._usable(token):
+                return token
+            with file_lock(self.lock_path):
+                # ... or another process.
+                token = self._load()
+                if self.needs_refresh(token):
+                    log.info('Refreshing the OAuth2 token of %s' % self.path)
+                    try:
+                        new_token = with_expires_at(self.refresh_func(token))
+                        if token.get('client_secret'):
+                            new_token.setdefault('client_secret', token['client_secret'])
+                    except Exception as err:
+                        if self.expired(token):
+                            raise
+                        log.warning('Refreshing the OAuth2 token of %s failed (%r), using the '
+                                    'old one until it expires' % (self.path, err))
+                        self._retry_at = time.monotonic() + self.retry_delay
+                        self._token = token
+                        return token
+                    token = new_token
+                    self._write(token)
+                    self.refreshes += 1
+                self._retry_at = None
+                self._token = token
+            return token
+
+    def save(self, token: dict):
+        """Store a token that was obtained elsewhere (e.g. by 'tpod init')."""
+        token = with_expires_at(token)
+        with self._refresh_lock:
+            with file_lock(self.lock_path):
+                self._write(token)
+            self._token = token
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_token_manager(path: str = DEFAULT_CREDENTIALS_FILE, **kwargs) -> TokenManager:
+    """The TokenManager of a credentials file, shared by everybody in this process."""
+    key = os.path.abspath(path)
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is None:
+            manager = _managers[key] = TokenManager(path, **kwargs)
+        elif kwargs.get('client_secret') and manager.client_secret is None:
+            manager.client_secret = kwargs['client_secret']
+        return manager
@@ -0,0 +1,248 @@
+"""
+Keep the SQLite cache fresh with Podio webhooks.
+
+Register a hook for every cached app in Podio (item.create, item.update and
+item.delete) that points to http://<your-host>:<port>/hook/<app_id>/ and run:
+
+>>> import sqlite3
+>>> from tetrapod.cache import CachedItemStorage
+>>> from tetrapod.session import create_podio_session
+>>> from tetrapod.webhooks import WebhookReceiver
+>>> storage = CachedItemStorage(sqlite3.connect('database.sqlite3'), create_podio_session())
+>>> storage.init_cache()
+>>> WebhookReceiver(storage, port=8080).serve()
+
+The item IDs of incoming hooks are collected and refreshed after a short quiet
+period (debounce), so that a burst of changes to the same item only results
+in one refresh. When a refresh fails (e.g. Podio answers with a 5xx or the rate
+limit is reached), the items are queued again and retried with a growing delay.
+
+See https://developers.podio.com/doc/hooks
+"""
+import logging
+import re
+import threading
+import time
+
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+
+log = logging.getLogger(__name__)
+
+ITEM_EVENTS = ('item.create', 'item.update', 'item.delete')
+
+HOOK_PATH_RE = re.compile(r'^/hook/(?P<app_id>\d+)/?$')
+
+
+class ItemChangeQueue(object):
+    """
+    Collects the changed item IDs per app and decides when they are due for a refresh.
+
+    :param debounce: Seconds without new events for an app before its items are due.
+    :param max_delay: Seconds after which the items of an app are due even if the
+        events keep coming in.
+    :param retry_delay: Seconds before the first retry of a failed refresh, doubled
+        after every further failure of the same app up to max_retry_delay.
+    """
+
+    def __init__(self, debounce: float = 5.0, max_delay: float = 60.0,
+                 retry_delay: float = 10.0, max_retry_delay: float = 600.0):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._lock = threading.Lock()
+        # app_id -> {item_id: event_type}
+        self._pending = {}
+        # app_id -> (time of first pending event, time of last event)
+        self._times = {}
+        # app_id -> (number of failed refreshes in a row, not due before this time)
+        self._retries = {}
+
+    def add(self, app_id: int, item_id: int, event_type: str, now: float = None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            # The most recent event wins, e.g. update after create is still an update
+            # and a delete makes any pending update obsolete.
+            self._pending.setdefault(app_id, {})[item_id] = event_type
+            first, _ = self._times.get(app_id, (now, now))
+            self._times[app_id] = (first, now)
+
+    def requeue(self, app_id: int, changed, deleted, now: float = None) -> float:
+        """
+        Put back the items of a failed refresh. Events that arrived in the meantime
+        win. Returns the delay before the app is due again.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            failures = self._retries.get(app_id, (0, now))[0] + 1
+            delay = min(self.max_retry_delay, self.retry_delay * 2 ** (failures - 1))
+            self._retries[app_id] = (failures, now + delay)
+            events = self._pending.setdefault(app_id, {})
+            for item_id in changed:
+                events.setdefault(item_id, 'item.update')
+            for item_id in deleted:
+                events.setdefault(item_id, 'item.delete')
+            first, last = self._times.get(app_id, (now, now))
+            self._times[app_id] = (first, last)
+        return delay
+
+    def succeeded(self, app_id: int):
+        """The refresh of an app worked, forget its failures."""
+        with self._lock:
+            self._retries.pop(app_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(items) for items in self._pending.values())
+
+    def pop_due(self, now: float = None, force: bool = False) -> dict:
+        """
+        Remove and return the pending changes of all apps that are due as
+        {app_id: (set of changed item_ids, set of deleted item_ids)}.
+        """
+        now = time.monotonic() if now is None else now
+        due = {}
+        with self._lock:
+            for app_id in list(self._pending.keys()):
+                first, last = self._times[app_id]
+                not_before = self._retries.get(app_id, (0, now))[1]
+                if not force and now < not_before:
+                    continue
+                if force or now - last >= self.debounce or now - first >= self.max_delay:
+                    events = self._pending.pop(app_id)
+                    del self._times[app_id]
+                    changed = {i for i, e in events.items() if e != 'item.delete'}
+                    deleted = {i for i, e in events.items() if e == 'item.delete'}
+                    due[app_id] = (changed, deleted)
+        return due
+
+
+def hook_item_id(data: dict):
+    """The item_id of an item hook, or None if it is missing or not a number."""
+    try:
+        return int(data['item_id'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class PodioWebhookHandler(BaseHTTPRequestHandler):
+    """Handles the POST requests that Podio sends to /hook/<app_id>/."""
+
+    def do_POST(self):
+        match = HOOK_PATH_RE.match(self.path)
+        if not match:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        content_len = int(self.headers.get('content-length', 0))
+        post_body = self.rfile.read(content_len)
+        data = {k: v[0] for k, v in parse_qs(post_body.decode('utf-8')).items()}
+        app_id = int(match.group('app_id'))
+
+        if data.get('type') in ITEM_EVENTS and hook_item_id(data) is None:
+            log.warning('Hook %s for app %d without item_id' % (data.get('type'), app_id))
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header(b"Content-type", b"application/json")
+        self.end_headers()
+        self.wfile.write(b'{"ok": true}')
+
+        self.server.receiver.handle_hook(app_id, data)
+
+    def log_message(self, format, *args):
+        log.debug('%s - %s' % (self.address_string(), format % args))
+
+
+class WebhookReceiver(object):
+    """
+    Small HTTP server that receives Podio hooks and refreshes the affected items
+    in a CachedItemStorage.
+
+    Everything, including the cache updates, happens on the thread that calls
+    serve(), because the sqlite3 connection of the storage belongs to that thread.
+    """
+
+    def __init__(self, storage, host: str = '', port: int = 8080,
+                 debounce: float = 5.0, max_delay: float = 60.0, retry_delay: float = 10.0):
+        self.storage = storage
+        self.queue = ItemChangeQueue(debounce=debounce, max_delay=max_delay,
+                                     retry_delay=retry_delay)
+        self.server = HTTPServer((host, port), PodioWebhookHandler)
+        self.server.receiver = self
+        # Wake up regularly, even if no hooks arrive, to flush the queue.
+        self.server.timeout = min(1.0, debounce) if debounce > 0 else 0.1
+        self.keep_running = True
+
+    @property
+    def port(self) -> int:
+        return self.server.socket.getsockname()[1]
+
+    def handle_hook(self, app_id: int, data: dict):
+        hook_type = data.get('type')
+        if hook_type == 'hook.verify':
+            self.verify_hook(int(data['hook_id']), data['code'])
+        elif hook_type in ITEM_EVENTS:
+            item_id = hook_item_id(data)
+            if item_id is None:
+                log.warning('Ignoring %s for app %d without item_id' % (hook_type, app_id))
+                return
+            log.debug('Received %s for item %d in app %d' % (hook_type, item_id, app_id))
+            self.queue.add(app_id, item_id, hook_type)
+        else:
+            log.info('Ignoring hook of type %s for app %d' % (hook_type, app_id))
+
+    def verify_hook(self, hook_id: int, code: str):
+        resp = self.storage.podio.post(
+            f'https://api.podio.com/hook/{hook_id:d}/verify/validate',
+            json={'code': code}
+        )
+        resp.raise_for_status()
+        log.info('Verified hook %d' % hook_id)
+
+    def flush(self, force: bool = False) -> int:
+        """
+        Refresh the items that are due. Returns the number of touched items.
+        The items of an app whose refresh fails are queued again for a later retry.
+        """
+        touched = 0
+        for app_id, (changed, deleted) in self.queue.pop_due(force=force).items():
+            try:
+                for item_id in deleted:
+                    self.storage.remove_item_from_db(app_id, item_id, commit=False)
+                self.storage.commit()
+                if changed:
+                    refreshed = self.storage.refresh_items(app_id, sorted(changed))
+                else:
+                    refreshed = 0
+            except Exception:
+                self.storage.rollback()
+                delay = self.queue.requeue(app_id, changed, deleted)
+                log.exception('App %d: refreshing %d items failed, retrying in %.0f s'
+                              % (app_id, len(changed) + len(deleted), delay))
+                continue
+            self.queue.succeeded(app_id)
+            touched += len(deleted) + refreshed
+            log.info('App %d: refreshed %d and removed %d cached items'
+                     % (app_id, len(changed), len(deleted)))
+        return touched
+
+    def serve(self):
+        try:
+            while self.keep_running:
+                self.server.handle_request()
+                self.flush()
+        finally:
+            self.flush(force=True)
+            if len(self.queue):
+                log.warning('%d changed items could not be refreshed before the shutdown'
+                            % len(self.queue))
+            self.server.server_close()
+
+    def stop(self):
+        self.keep_running = False